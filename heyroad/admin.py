@@ -1,8 +1,19 @@
 from django.contrib import admin
 
-from .models import Route, LatLng, Friendship, Comment
+from .models import Route, LatLng, TrackLevel, Friendship, Comment, \
+                    UserStats, StatsBucket, RouteMetrics, RouteJob, \
+                    TimelineEntry, UploadKey, LiveRoute, ChangeLog
 
 admin.site.register(Route)
 admin.site.register(LatLng)
+admin.site.register(TrackLevel)
+admin.site.register(RouteMetrics)
+admin.site.register(RouteJob)
 admin.site.register(Friendship)
-admin.site.register(Comment)
\ No newline at end of file
+admin.site.register(Comment)
+admin.site.register(UserStats)
+admin.site.register(StatsBucket)
+admin.site.register(TimelineEntry)
+admin.site.register(UploadKey)
+admin.site.register(LiveRoute)
+admin.site.register(ChangeLog)
@@ -3,3 +3,8 @@ from django.apps import AppConfig
 
 class HeyroadConfig(AppConfig):
     name = 'heyroad'
+
+    def ready(self):
+        from django.db.backends.signals import connection_created
+        from heyroad import db, signals  # noqa: F401
+        connection_created.connect(db.configure_connection)
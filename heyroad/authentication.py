@@ -0,0 +1,61 @@
+"""
+Token authentication with an in-process cache of tokens.
+
+Looking a token up joins the token and user tables on every API request.
+CachedTokenAuthentication keeps recently used tokens with their users in
+a bounded LRU map, so repeated calls from one device (live tracking,
+sync polling) authenticate without a query. Entries are dropped when
+their token is deleted or their user saved (deactivated, made staff,
+...); other server processes find out within HEYROAD_TOKEN_CACHE_TTL
+seconds.
+"""
+import copy
+
+from django.conf import settings
+from rest_framework.authentication import TokenAuthentication
+
+from heyroad import instrumentation
+from heyroad.caching import LRUCache
+
+DEFAULT_MAX_ENTRIES = 10000
+# seconds
+DEFAULT_TTL = 300
+
+token_cache = LRUCache(
+    max_entries=getattr(settings, 'HEYROAD_TOKEN_CACHE_ENTRIES',
+                        DEFAULT_MAX_ENTRIES),
+    ttl=getattr(settings, 'HEYROAD_TOKEN_CACHE_TTL', DEFAULT_TTL))
+
+instrumentation.REGISTRY.counter_function(
+    'heyroad_token_cache_hits_total',
+    'API requests authenticated from the token cache.',
+    lambda: token_cache.hits)
+instrumentation.REGISTRY.counter_function(
+    'heyroad_token_cache_misses_total',
+    'API requests whose token was looked up in the database.',
+    lambda: token_cache.misses)
+instrumentation.REGISTRY.gauge(
+    'heyroad_token_cache_entries', 'Tokens in the token cache.',
+    lambda: len(token_cache))
+
+
+def forget_token(key):
+    token_cache.delete(key)
+
+
+def forget_user(user_id):
+    token_cache.delete_where(lambda key, value: value[0].pk == user_id)
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+
+    def authenticate_credentials(self, key):
+        cached = token_cache.get(key)
+        if cached is None:
+            # raises AuthenticationFailed for unknown keys and inactive
+            # users, neither is cached
+            cached = super().authenticate_credentials(key)
+            token_cache.set(key, cached)
+        user, token = cached
+        # requests may change their user, they must not share it
+        return copy.copy(user), token
@@ -0,0 +1,185 @@
+"""
+Conditional GET helpers and a bounded in-process LRU cache.
+
+Routes carry a `version` that is bumped whenever their API representation
+changes (comments, processing). ETags are built from such versions, so a
+matching If-None-Match is answered with 304 before anything is
+serialized, and serialized payloads are cached per version, bounded by
+an estimate of their size as JSON.
+"""
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db.models import F
+from django.utils import timezone
+from django.utils.cache import get_conditional_response, \
+                               patch_vary_headers
+from django.utils.http import http_date, quote_etag
+
+from heyroad.models import Route
+
+DEFAULT_PAYLOAD_CACHE_BYTES = 32 * 1024 * 1024
+# items of a list measured by estimate_size(), the rest are taken as alike
+SAMPLE_ITEMS = 8
+
+
+class LRUCache:
+    """
+    Thread-safe least-recently-used cache bounded by entry count and/or
+    total size (as measured by `sizeof`), with an optional TTL in seconds.
+    """
+
+    def __init__(self, max_entries=None, max_bytes=None, ttl=None,
+                 sizeof=len):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.sizeof = sizeof
+        self.hits = 0
+        self.misses = 0
+        self._bytes = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    @property
+    def size(self):
+        return self._bytes
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and self.ttl is not None \
+                    and entry[2] < time.monotonic():
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value):
+        size = self.sizeof(value) if self.max_bytes is not None else 0
+        if self.max_bytes is not None and size > self.max_bytes:
+            return
+        expires = time.monotonic() + self.ttl if self.ttl is not None \
+            else None
+        with self._lock:
+            self._remove(key)
+            self._data[key] = (value, size, expires)
+            self._bytes += size
+            while (self.max_entries is not None
+                   and len(self._data) > self.max_entries) \
+                    or (self.max_bytes is not None
+                        and self._bytes > self.max_bytes):
+                self._remove(next(iter(self._data)))
+
+    def delete(self, key):
+        with self._lock:
+            self._remove(key)
+
+    def delete_where(self, predicate):
+        """
+        Drop every entry whose key and value match predicate(key, value).
+        """
+        with self._lock:
+            for key in [key for key, entry in self._data.items()
+                        if predicate(key, entry[0])]:
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._bytes = 0
+
+    def _remove(self, key):
+        entry = self._data.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry[1]
+
+
+def estimate_size(data):
+    """
+    Rough size of `data` as JSON. Only the first items of a list are
+    measured, so a route's points are not walked (or rendered) just to
+    weigh them.
+    """
+    if isinstance(data, dict):
+        return 2 + sum(len(str(key)) + 4 + estimate_size(value)
+                       for key, value in data.items())
+    if isinstance(data, (list, tuple)):
+        if not data:
+            return 2
+        sample = data[:SAMPLE_ITEMS]
+        measured = sum(estimate_size(item) + 1 for item in sample)
+        return 2 + measured * len(data) // len(sample)
+    if isinstance(data, str):
+        return len(data) + 2
+    return len(str(data))
+
+
+payload_cache = LRUCache(
+    max_bytes=getattr(settings, 'HEYROAD_PAYLOAD_CACHE_BYTES',
+                      DEFAULT_PAYLOAD_CACHE_BYTES),
+    sizeof=estimate_size)
+
+
+def touch_route(route_id):
+    """
+    Mark the API representation of a route as changed.
+    """
+    Route.objects.filter(pk=route_id).update(version=F('version') + 1,
+                                             updated=timezone.now())
+
+
+def make_etag(*parts):
+    return quote_etag(hashlib.md5(
+        '|'.join(str(part) for part in parts).encode('utf-8')).hexdigest())
+
+
+def negotiated_etag(request, *parts):
+    """
+    make_etag() for an API response: the negotiated format is part of
+    the tag, as JSON and msgpack bodies of one URL differ.
+    """
+    return make_etag(request.accepted_renderer.format, *parts)
+
+
+def not_modified(request, etag, last_modified=None):
+    """
+    A 304 response if the request's validators match, otherwise None.
+    """
+    timestamp = None
+    if last_modified is not None:
+        timestamp = int(last_modified.timestamp())
+    return get_conditional_response(request, etag=etag,
+                                    last_modified=timestamp)
+
+
+def set_validators(response, etag, last_modified=None, negotiated=False):
+    response['ETag'] = etag
+    if last_modified is not None:
+        response['Last-Modified'] = http_date(last_modified.timestamp())
+    if negotiated:
+        # so caches keep a copy per format
+        patch_vary_headers(response, ['Accept'])
+    return response
+
+
+def cached_data(key, build):
+    """
+    Return the serialized data cached under `key`, calling `build()` on a
+    miss. `key` must identify a version of the data.
+    """
+    data = payload_cache.get(key)
+    if data is None:
+        data = build()
+        payload_cache.set(key, data)
+    return data
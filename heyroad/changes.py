@@ -0,0 +1,201 @@
+"""
+Delta sync: what changed for a user since their last sync.
+
+Every save and delete of a route, comment or friendship appends a
+ChangeLog entry; deletions are kept as tombstones. The entry ids form one
+monotonic sequence, and clients hold a signed sync token naming the last
+id they have seen. A sync reads the entries after it that the user may
+see, keeps the last one per object and returns those objects as they are
+now, the ids of the deleted ones, and a new token.
+
+Friendships change what is visible: the routes and comments of a new
+friend are sent whole, and the ids of users who are no longer friends
+are listed so clients can drop what they own.
+
+`manage.py compact_changes` keeps the log from growing forever: it drops
+the entries superseded by a later one of the same object and the
+tombstones older than HEYROAD_SYNC_HORIZON. Tokens older than the horizon
+may have missed such a tombstone, so their clients must sync again from
+scratch.
+"""
+import threading
+from datetime import timedelta
+
+from django.conf import settings
+from django.core import signing
+from django.db.models import Max, Q
+from django.utils import timezone
+
+from heyroad import friends
+from heyroad.models import ChangeLog, Comment, Friendship, Route
+
+SALT = 'heyroad.sync'
+# log entries per sync response; clients ask again while 'more' is true
+DEFAULT_LIMIT = 500
+# objects per IN query, below SQLite's bound parameter limit
+CHUNK_SIZE = 500
+# seconds tombstones are kept, and sync tokens stay valid
+DEFAULT_HORIZON = 30 * 24 * 60 * 60
+
+_local = threading.local()
+
+
+class InvalidToken(ValueError):
+    pass
+
+
+class ResyncRequired(InvalidToken):
+    pass
+
+
+def horizon():
+    return getattr(settings, 'HEYROAD_SYNC_HORIZON', DEFAULT_HORIZON)
+
+
+def _deleting():
+    # owners of the routes being deleted, by route id
+    if not hasattr(_local, 'owners'):
+        _local.owners = {}
+    return _local.owners
+
+
+def route_deleting(route):
+    """
+    Note the owner of `route` for the comments deleted along with it.
+    """
+    _deleting()[route.pk] = route.user_id
+
+
+def route_deleted(route):
+    _deleting().pop(route.pk, None)
+
+
+def record(kind, instance, deleted=False):
+    if kind == ChangeLog.FRIENDSHIP:
+        owner, other = instance.user1_id, instance.user2_id
+    elif kind == ChangeLog.COMMENT:
+        owner = _deleting().get(instance.route_id)
+        if owner is None:
+            owner = Route.objects.filter(pk=instance.route_id) \
+                                 .values_list('user_id', flat=True).first()
+        if owner is None:
+            # deleted with its route, whose tombstone covers it
+            return
+        other = None
+    else:
+        owner, other = instance.user_id, None
+    ChangeLog.objects.create(kind=kind, object_id=instance.pk,
+                             deleted=deleted, owner=owner, other=other)
+
+
+def make_token(user, seq):
+    return signing.dumps({'user': user.pk, 'seq': seq}, salt=SALT)
+
+
+def read_token(user, token):
+    """
+    The sequence number in a sync token issued to `user`. Raises
+    ResyncRequired for a token older than the horizon.
+    """
+    try:
+        data = signing.loads(token, salt=SALT, max_age=horizon())
+    except signing.SignatureExpired:
+        raise ResyncRequired('sync token expired, sync without a token')
+    except signing.BadSignature:
+        raise InvalidToken('invalid sync token')
+    if not isinstance(data, dict) or data.get('user') != user.pk \
+            or not isinstance(data.get('seq'), int):
+        raise InvalidToken('invalid sync token')
+    return data['seq']
+
+
+def compact():
+    """
+    Delete the entries superseded by a later entry of the same object and
+    the tombstones older than the horizon. Returns the numbers of both.
+    """
+    latest = ChangeLog.objects.values('kind', 'object_id') \
+                              .annotate(last=Max('id')).values('last')
+    superseded, _ = ChangeLog.objects.exclude(id__in=latest).delete()
+    expired, _ = ChangeLog.objects.filter(
+        deleted=True,
+        date__lt=timezone.now() - timedelta(seconds=horizon())).delete()
+    return superseded, expired
+
+
+def _visible_entries(user):
+    # routes and comments go by the route owner, friendships to both users
+    content = Q(kind__in=(ChangeLog.ROUTE, ChangeLog.COMMENT)) \
+        & friends.visible_q(user, field='owner')
+    mine = Q(kind=ChangeLog.FRIENDSHIP) \
+        & (Q(owner=user.pk) | Q(other=user.pk))
+    return ChangeLog.objects.filter(content | mine)
+
+
+def _fetch(queryset, ids):
+    ids = sorted(ids)
+    objects = []
+    for start in range(0, len(ids), CHUNK_SIZE):
+        objects.extend(queryset.filter(pk__in=ids[start:start + CHUNK_SIZE]))
+    return objects
+
+
+def changes(user, seq=0, limit=None):
+    """
+    What changed for `user` after the entry `seq`, as a dict of:
+    routes, comments and friendships (the objects created or changed),
+    deleted (ids by the same keys), removed_users (ids of users no longer
+    visible), seq (the last entry covered) and more (whether entries
+    are left for another call). At most `limit` entries are read,
+    HEYROAD_SYNC_LIMIT by default.
+    """
+    if limit is None:
+        limit = getattr(settings, 'HEYROAD_SYNC_LIMIT', DEFAULT_LIMIT)
+    last = ChangeLog.objects.aggregate(last=Max('id'))['last'] or 0
+    entries = list(_visible_entries(user).filter(id__gt=seq, id__lte=last)
+                                         .order_by('id')[:limit + 1])
+    more = len(entries) > limit
+    if more:
+        entries = entries[:limit]
+        last = entries[-1].pk
+
+    latest = {}
+    for entry in entries:
+        latest[(entry.kind, entry.object_id)] = entry
+    upserts = {kind: set() for kind, _ in ChangeLog.KIND_CHOICES}
+    deleted = {kind: set() for kind, _ in ChangeLog.KIND_CHOICES}
+    # the other users of friendships made and ended
+    made, ended = set(), set()
+    for (kind, object_id), entry in latest.items():
+        (deleted if entry.deleted else upserts)[kind].add(object_id)
+        if kind == ChangeLog.FRIENDSHIP:
+            other = entry.other if entry.owner == user.pk else entry.owner
+            (ended if entry.deleted else made).add(other)
+
+    visible = friends.visible_user_ids(user)
+    routes = friends.visible_routes(user).defer(
+        'track', 'times', 'elevations', 'thumbnail', 'thumbnail_png')
+    comments = Comment.objects.filter(
+        friends.visible_q(user, field='route__user'))
+    route_list = _fetch(routes, upserts[ChangeLog.ROUTE])
+    comment_list = _fetch(comments, upserts[ChangeLog.COMMENT])
+    # a whole sync already has everything of every friend
+    added = made & visible if seq else set()
+    if added:
+        seen = upserts[ChangeLog.ROUTE] | deleted[ChangeLog.ROUTE]
+        route_list.extend(route for route in routes.filter(user__in=added)
+                          if route.pk not in seen)
+        seen = upserts[ChangeLog.COMMENT] | deleted[ChangeLog.COMMENT]
+        comment_list.extend(
+            comment for comment in comments.filter(route__user__in=added)
+            if comment.pk not in seen)
+    friendships = Friendship.objects.filter(Q(user1=user) | Q(user2=user))
+    return {
+        'routes': route_list,
+        'comments': comment_list,
+        'friendships': _fetch(friendships, upserts[ChangeLog.FRIENDSHIP]),
+        'deleted': {kind + 's': sorted(ids) for kind, ids in deleted.items()},
+        'removed_users': sorted(ended - visible),
+        'seq': last,
+        'more': more,
+    }
@@ -0,0 +1,118 @@
+"""
+SQLite tuning and read/write splitting.
+
+configure_connection() runs the HEYROAD_SQLITE_PRAGMAS on every new
+SQLite connection, and ReadReplicaRouter sends the queries of read-only
+requests to the aliases in HEYROAD_DATABASE_REPLICAS while writes stay
+on the default database. heyroad_site/settings_production.py puts both
+together. process_pool() gives management commands worker processes to
+read and compute in.
+"""
+import multiprocessing
+import random
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+# WAL lets readers run alongside the single writer; with it NORMAL
+# synchronous is still safe against corruption, it may only lose the
+# last transactions on power loss
+RECOMMENDED_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    # negative: KiB
+    'cache_size': -64000,
+    'mmap_size': 256 * 1024 * 1024,
+    'temp_store': 'MEMORY',
+    # milliseconds a connection waits for a lock before failing
+    'busy_timeout': 5000,
+}
+# methods whose requests only read
+READ_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+_local = threading.local()
+
+
+def replicas():
+    return list(getattr(settings, 'HEYROAD_DATABASE_REPLICAS', []))
+
+
+def pragma_statements(pragmas):
+    return ['PRAGMA {} = {}'.format(name, value)
+            for name, value in pragmas.items()]
+
+
+def configure_connection(sender, connection, **kwargs):
+    """
+    connection_created receiver applying HEYROAD_SQLITE_PRAGMAS, replicas
+    are also made read-only.
+    """
+    if connection.vendor != 'sqlite':
+        return
+    pragmas = dict(getattr(settings, 'HEYROAD_SQLITE_PRAGMAS', None) or {})
+    if connection.alias in replicas():
+        pragmas['query_only'] = 'ON'
+    with connection.cursor() as cursor:
+        for statement in pragma_statements(pragmas):
+            cursor.execute(statement)
+
+
+@contextmanager
+def reading():
+    """
+    Route the reads of the current thread to a replica.
+    """
+    previous = getattr(_local, 'reading', False)
+    _local.reading = True
+    try:
+        yield
+    finally:
+        _local.reading = previous
+
+
+class ReadReplicaRouter:
+    """
+    Reads made within reading() go to a random replica, unless the
+    default database is in a transaction, whose writes the replica would
+    not see yet. Everything else uses the default database.
+    """
+
+    def db_for_read(self, model, **hints):
+        names = replicas()
+        if not names or not getattr(_local, 'reading', False) \
+                or connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return DEFAULT_DB_ALIAS
+        return random.choice(names)
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # replicas hold the same rows
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db not in replicas()
+
+
+def _close_connections():
+    # a forked worker must not use the connections it inherited
+    connections.close_all()
+
+
+def process_pool(workers):
+    """
+    A ProcessPoolExecutor of `workers` processes for commands that spread
+    reading and computing over several cores. Workers only read; their
+    results come back to the calling process, which does all the writes
+    since SQLite allows a single writer anyway. The processes are forked,
+    whatever the platform default, so they start with Django set up; the
+    parent's connections are closed first so none is shared.
+    """
+    connections.close_all()
+    return ProcessPoolExecutor(
+        max_workers=workers, mp_context=multiprocessing.get_context('fork'),
+        initializer=_close_connections)
@@ -0,0 +1,167 @@
+"""
+Streaming export of routes as GPX, GeoJSON or CSV.
+
+Writers are generators over an iterable of routes. Routes are read from
+the database a few at a time and their points decoded one by one, so
+memory use does not grow with the size of the export.
+"""
+import csv
+import json
+from datetime import timedelta
+from xml.sax.saxutils import escape, quoteattr
+
+from django.http import StreamingHttpResponse
+from django.utils import timezone
+
+from heyroad.geometry import iter_points, unpack_values
+from heyroad.models import Route
+
+# routes fetched per database round trip when exporting an account
+ROUTE_CHUNK_SIZE = 20
+# LatLng rows fetched per round trip for routes stored as rows
+POINT_CHUNK_SIZE = 2000
+# bytes collected before a piece of the response is sent
+BUFFER_SIZE = 64 * 1024
+
+
+def _timestamp(value):
+    value = value.astimezone(timezone.utc)
+    return '{}.{:03d}Z'.format(value.strftime('%Y-%m-%dT%H:%M:%S'),
+                               value.microsecond // 1000)
+
+
+def _track(route):
+    """
+    Yield (latitude, longitude, time, elevation) for every point of
+    `route`; time and elevation are None when they were not recorded.
+    """
+    if route.track is not None:
+        points = iter_points(route.track)
+    else:
+        points = route.coords.order_by('id') \
+                             .values_list('latitude', 'longitude') \
+                             .iterator(chunk_size=POINT_CHUNK_SIZE)
+    times = elevations = ()
+    if route.times is not None:
+        times = unpack_values(route.times, 'i')
+    if route.elevations is not None:
+        elevations = unpack_values(route.elevations)
+    for i, (latitude, longitude) in enumerate(points):
+        time = elevation = None
+        if i < len(times):
+            time = route.date + timedelta(milliseconds=times[i])
+        if i < len(elevations):
+            elevation = elevations[i]
+        yield latitude, longitude, time, elevation
+
+
+def gpx(routes):
+    yield '<?xml version="1.0" encoding="UTF-8"?>\n' \
+          '<gpx version="1.1" creator="heyroad" ' \
+          'xmlns="http://www.topografix.com/GPX/1/1">\n'
+    for route in routes:
+        yield '<trk><name>{}</name><desc>{:.3f} km</desc><trkseg>\n'.format(
+            escape('Route {} {}'.format(route.pk, _timestamp(route.date))),
+            route.distance)
+        for latitude, longitude, time, elevation in _track(route):
+            point = '<trkpt lat={} lon={}>'.format(
+                quoteattr('{:.6f}'.format(latitude)),
+                quoteattr('{:.6f}'.format(longitude)))
+            if elevation is not None:
+                point += '<ele>{:.1f}</ele>'.format(elevation)
+            if time is not None:
+                point += '<time>{}</time>'.format(_timestamp(time))
+            yield point + '</trkpt>\n'
+        yield '</trkseg></trk>\n'
+    yield '</gpx>\n'
+
+
+def geojson(routes):
+    yield '{"type":"FeatureCollection","features":['
+    separator = '\n'
+    for route in routes:
+        properties = {
+            'id': route.pk,
+            'user': route.user_id,
+            'date': _timestamp(route.date),
+            'distance': route.distance,
+            'duration': route.duration.total_seconds(),
+        }
+        yield '{}{{"type":"Feature","properties":{},' \
+              '"geometry":{{"type":"LineString","coordinates":['.format(
+                  separator, json.dumps(properties))
+        comma = ''
+        for latitude, longitude, _, elevation in _track(route):
+            if elevation is None:
+                yield '{}[{:.6f},{:.6f}]'.format(comma, longitude, latitude)
+            else:
+                yield '{}[{:.6f},{:.6f},{:.1f}]'.format(
+                    comma, longitude, latitude, elevation)
+            comma = ','
+        yield ']}}'
+        separator = ',\n'
+    yield ']}\n'
+
+
+class _Echo:
+    def write(self, value):
+        return value
+
+
+def csv_rows(routes):
+    writer = csv.writer(_Echo())
+    yield writer.writerow(['route', 'point', 'latitude', 'longitude',
+                           'time', 'elevation'])
+    for route in routes:
+        for i, (latitude, longitude, time, elevation) in \
+                enumerate(_track(route)):
+            yield writer.writerow([
+                route.pk, i,
+                '{:.6f}'.format(latitude), '{:.6f}'.format(longitude),
+                _timestamp(time) if time is not None else '',
+                '{:.1f}'.format(elevation) if elevation is not None else '',
+            ])
+
+
+FORMATS = {
+    'gpx': (gpx, 'application/gpx+xml', 'gpx'),
+    'geojson': (geojson, 'application/geo+json', 'geojson'),
+    'csv': (csv_rows, 'text/csv', 'csv'),
+}
+
+
+def _buffered(pieces):
+    buffer, size = [], 0
+    for piece in pieces:
+        buffer.append(piece)
+        size += len(piece)
+        if size >= BUFFER_SIZE:
+            yield ''.join(buffer).encode('utf-8')
+            buffer, size = [], 0
+    if buffer:
+        yield ''.join(buffer).encode('utf-8')
+
+
+def account_routes(user):
+    """
+    All routes of `user`, oldest first, fetched ROUTE_CHUNK_SIZE at a time.
+    """
+    return Route.objects.filter(user=user).order_by('date', 'id') \
+                        .iterator(chunk_size=ROUTE_CHUNK_SIZE)
+
+
+def export_response(routes, fmt, name):
+    """
+    A streaming download of `routes` in format `fmt`, saved as
+    `name`.<extension>. Raises ValueError for an unknown format.
+    """
+    if fmt not in FORMATS:
+        raise ValueError('fmt must be one of {}'.format(
+            ', '.join(sorted(FORMATS))))
+    writer, content_type, extension = FORMATS[fmt]
+    response = StreamingHttpResponse(
+        _buffered(writer(routes)),
+        content_type='{}; charset=utf-8'.format(content_type))
+    response['Content-Disposition'] = \
+        'attachment; filename="{}.{}"'.format(name, extension)
+    return response
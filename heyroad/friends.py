@@ -0,0 +1,107 @@
+"""
+Friend graph lookups.
+
+Accepted friend ids are cached per user and dropped whenever one of the
+user's friendships is saved or deleted (see heyroad.signals), so checking
+whether someone may see a route is a set lookup instead of a query. The
+drop only reaches processes sharing the cache; with the default per-process
+cache others see the change once HEYROAD_FRIENDS_CACHE_TIMEOUT expires.
+"""
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Case, When, F, Q, IntegerField
+
+from heyroad.models import Route, Friendship
+
+CACHE_TIMEOUT = 60
+# above this many ids filters use a subquery instead of a literal IN list,
+# which would otherwise hit SQLite's bound parameter limit
+MAX_INLINE_IDS = 500
+
+
+def _cache_key(user_id):
+    return 'heyroad:friends:{}'.format(user_id)
+
+
+def friend_ids(user):
+    """
+    Return the ids of users who accepted a friendship with `user`.
+    """
+    key = _cache_key(user.pk)
+    ids = cache.get(key)
+    if ids is None:
+        pairs = Friendship.objects.filter(
+            Q(user1=user) | Q(user2=user),
+            is_accepted=True
+        ).values_list('user1', 'user2')
+        ids = frozenset(user2 if user1 == user.pk else user1
+                        for user1, user2 in pairs)
+        cache.set(key, ids, getattr(settings, 'HEYROAD_FRIENDS_CACHE_TIMEOUT',
+                                    CACHE_TIMEOUT))
+    return ids
+
+
+def visible_user_ids(user):
+    """
+    Ids of users whose routes `user` may see: their friends and themselves.
+    """
+    return friend_ids(user) | {user.pk}
+
+
+def invalidate(*user_ids):
+    keys = [_cache_key(user_id) for user_id in user_ids]
+    cache.delete_many(keys)
+    # again once committed: a request may have cached the old friends
+    # while the transaction was open
+    transaction.on_commit(lambda: cache.delete_many(keys))
+
+
+def are_friends(user, other_id):
+    return other_id in friend_ids(user)
+
+
+def can_view(user, owner_id):
+    """
+    Whether `user` may see content owned by the user with id `owner_id`.
+    """
+    return (user.is_superuser or owner_id == user.pk
+            or are_friends(user, owner_id))
+
+
+def friends_subquery(user):
+    """
+    A values() queryset of friend ids, usable as `field__in=` subquery.
+    """
+    return Friendship.objects.filter(
+        Q(user1=user) | Q(user2=user),
+        is_accepted=True
+    ).annotate(
+        friend=Case(When(user1=user, then=F('user2')),
+                    default=F('user1'),
+                    output_field=IntegerField())
+    ).values('friend')
+
+
+def visible_q(user, field='user'):
+    """
+    A Q object matching rows whose `field` is `user` or one of their friends.
+    """
+    ids = visible_user_ids(user)
+    if len(ids) <= MAX_INLINE_IDS:
+        return Q(**{field + '__in': ids})
+    return (Q(**{field: user.pk})
+            | Q(**{field + '__in': friends_subquery(user)}))
+
+
+def visible_routes(user):
+    if user.is_superuser:
+        return Route.objects.all()
+    return Route.objects.filter(visible_q(user))
+
+
+def visible_users(user):
+    if user.is_superuser:
+        return User.objects.all()
+    return User.objects.filter(visible_q(user, field='pk'))
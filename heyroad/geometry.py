@@ -0,0 +1,91 @@
+"""
+Compact storage for route geometry.
+
+A track is packed into a single binary blob of little-endian int32
+micro-degrees, interleaved as latitude, longitude pairs. One micro-degree
+is roughly 0.1 m, well below GPS accuracy.
+"""
+import sys
+from array import array
+
+import numpy
+
+SCALE = 1000000
+ITEMSIZE = 4
+LITTLE_ENDIAN = sys.byteorder == 'little'
+
+
+def pack_points(points):
+    """
+    Pack an iterable of (latitude, longitude) pairs into bytes.
+    """
+    packed = array('i')
+    for latitude, longitude in points:
+        packed.append(int(round(latitude * SCALE)))
+        packed.append(int(round(longitude * SCALE)))
+    if not LITTLE_ENDIAN:
+        packed.byteswap()
+    return packed.tobytes()
+
+
+def point_view(data):
+    """
+    Return the packed int32 micro-degree values of a track.
+
+    On little-endian hosts this is a zero-copy memoryview over `data`.
+    """
+    if LITTLE_ENDIAN:
+        return memoryview(data).cast('B').cast('i')
+    values = array('i')
+    values.frombytes(bytes(data))
+    values.byteswap()
+    return values
+
+
+def numpy_view(data):
+    """
+    Return a read-only (n, 2) int32 NumPy view of a packed track without
+    copying it.
+    """
+    return numpy.frombuffer(data, dtype='<i4').reshape(-1, 2)
+
+
+def unpack_points(data):
+    """
+    Decode a packed track into a list of (latitude, longitude) tuples.
+    """
+    values = point_view(data)
+    return [(values[i] / SCALE, values[i + 1] / SCALE)
+            for i in range(0, len(values), 2)]
+
+
+def iter_points(data):
+    """
+    Yield the (latitude, longitude) pairs of a packed track one at a time.
+    """
+    values = point_view(data)
+    for i in range(0, len(values), 2):
+        yield values[i] / SCALE, values[i + 1] / SCALE
+
+
+def point_count(data):
+    return len(data) // (2 * ITEMSIZE)
+
+
+def pack_values(values, typecode='f'):
+    """
+    Pack a sequence of numbers (per-point times, elevations, ...) as a
+    little-endian array of `typecode`.
+    """
+    packed = array(typecode, values)
+    if not LITTLE_ENDIAN:
+        packed.byteswap()
+    return packed.tobytes()
+
+
+def unpack_values(data, typecode='f'):
+    values = array(typecode)
+    values.frombytes(bytes(data))
+    if not LITTLE_ENDIAN:
+        values.byteswap()
+    return values
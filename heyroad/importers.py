@@ -0,0 +1,389 @@
+"""
+Import of routes from GPX and GeoJSON files and zip archives of them.
+
+GPX is parsed incrementally with iterparse, releasing every element once
+it has been read. Each track becomes one route, cleaned into the same
+fields as heyroad.ingest.parse_route_payload returns, so storing it goes
+through heyroad.ingest.store_route like any other upload.
+
+Uploads are bounded: an archive may hold HEYROAD_MAX_IMPORT_FILES files,
+each may inflate to HEYROAD_MAX_IMPORT_FILE_SIZE bytes and all of them
+together to HEYROAD_MAX_IMPORT_SIZE bytes. Sizes are checked against the
+archive headers before anything is inflated and again while reading.
+"""
+import json
+import math
+import os
+import zipfile
+from datetime import timedelta
+from xml.etree import ElementTree
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from heyroad.ingest import InvalidRoutePayload, MAX_POINT_SECONDS, \
+                           store_route
+from heyroad.metrics import compute_metrics
+
+EXTENSIONS = ('.gpx', '.geojson', '.json')
+# routes stored per transaction
+DEFAULT_BATCH_SIZE = 50
+DEFAULT_MAX_FILES = 1000
+DEFAULT_MAX_FILE_SIZE = 64 * 1024 * 1024
+DEFAULT_MAX_SIZE = 256 * 1024 * 1024
+
+
+class ImportTooLarge(ValueError):
+    pass
+
+
+def max_files():
+    return getattr(settings, 'HEYROAD_MAX_IMPORT_FILES', DEFAULT_MAX_FILES)
+
+
+def max_file_size():
+    return getattr(settings, 'HEYROAD_MAX_IMPORT_FILE_SIZE',
+                   DEFAULT_MAX_FILE_SIZE)
+
+
+def max_size():
+    return getattr(settings, 'HEYROAD_MAX_IMPORT_SIZE', DEFAULT_MAX_SIZE)
+
+
+class LimitedReader:
+    """
+    A binary file object reading from `fileobj` that raises ImportTooLarge
+    once more than `limit` bytes come out of it.
+    """
+
+    def __init__(self, fileobj, limit):
+        self.fileobj = fileobj
+        self.limit = limit
+        self.count = 0
+
+    def read(self, size=-1):
+        left = self.limit - self.count
+        if size is None or size < 0 or size > left:
+            size = left + 1
+        data = self.fileobj.read(size)
+        self.count += len(data)
+        if self.count > self.limit:
+            raise ImportTooLarge('file inflates to more than {} bytes'
+                                 .format(self.limit))
+        return data
+
+
+def _local(tag):
+    return tag.rsplit('}', 1)[-1]
+
+
+def _coordinate(latitude, longitude):
+    try:
+        latitude, longitude = float(latitude), float(longitude)
+    except (TypeError, ValueError):
+        raise InvalidRoutePayload('invalid coordinate: {!r}'.format(
+            (latitude, longitude)))
+    if not (-90.0 <= latitude <= 90.0 and -180.0 <= longitude <= 180.0):
+        raise InvalidRoutePayload('coordinate out of range: {!r}'.format(
+            (latitude, longitude)))
+    return latitude, longitude
+
+
+def _timestamp(value):
+    try:
+        date = parse_datetime(value)
+    except (TypeError, ValueError):
+        date = None
+    if date is None:
+        raise InvalidRoutePayload('invalid point time: {!r}'.format(value))
+    if timezone.is_naive(date):
+        date = timezone.make_aware(date, timezone.utc)
+    return date
+
+
+def _elevation(value):
+    try:
+        elevation = float(value)
+    except (TypeError, ValueError):
+        elevation = None
+    if elevation is None or not math.isfinite(elevation):
+        raise InvalidRoutePayload('invalid elevation: {!r}'.format(value))
+    return elevation
+
+
+def clean_track(points, times=None, elevations=None, date=None):
+    """
+    Route fields for a track of (latitude, longitude) points with optional
+    per-point datetimes and elevations, each list either complete or None.
+    The distance is measured along the track.
+    """
+    if times is not None and times:
+        date = times[0]
+        seconds = [(time - date).total_seconds() for time in times]
+        if any(abs(value) > MAX_POINT_SECONDS for value in seconds):
+            raise InvalidRoutePayload('point time out of range')
+        duration = timedelta(seconds=max(seconds[-1], 0))
+    else:
+        seconds = None
+        duration = timedelta(0)
+    return {
+        'distance': compute_metrics(points)['distance'],
+        'date': date or timezone.now(),
+        'duration': duration,
+        'points': points,
+        'times': seconds,
+        'elevations': elevations,
+    }
+
+
+def _complete(values, size):
+    # per-point series are all-or-none, like in uploads
+    return values if len(values) == size and None not in values else None
+
+
+def parse_gpx(fileobj):
+    """
+    Yield the cleaned fields of every track and route in a GPX file.
+    """
+    date = None
+    points, times, elevations = [], [], []
+    root = None
+    path = []
+    for event, element in ElementTree.iterparse(fileobj,
+                                                events=('start', 'end')):
+        tag = _local(element.tag)
+        if event == 'start':
+            if root is None:
+                root = element
+            path.append(tag)
+            continue
+        path.pop()
+        if tag in ('trkpt', 'rtept'):
+            points.append(_coordinate(element.get('lat'),
+                                      element.get('lon')))
+            time = elevation = None
+            for child in element:
+                name = _local(child.tag)
+                if name == 'time':
+                    time = _timestamp(child.text)
+                elif name == 'ele':
+                    elevation = _elevation(child.text)
+            times.append(time)
+            elevations.append(elevation)
+            element.clear()
+        elif tag == 'time' and path == ['gpx', 'metadata']:
+            date = _timestamp(element.text)
+        elif tag in ('trk', 'rte'):
+            if points:
+                yield clean_track(points,
+                                  _complete(times, len(points)),
+                                  _complete(elevations, len(points)),
+                                  date)
+            points, times, elevations = [], [], []
+            # drop the finished track from the tree
+            root.clear()
+
+
+def _geojson_lines(geometry):
+    if not isinstance(geometry, dict):
+        return []
+    if geometry.get('type') == 'LineString':
+        return [geometry.get('coordinates') or []]
+    if geometry.get('type') == 'MultiLineString':
+        return geometry.get('coordinates') or []
+    return []
+
+
+def parse_geojson(fileobj):
+    """
+    Yield the cleaned fields of every (Multi)LineString feature. Point
+    times are read from a 'coordTimes' or 'times' property.
+    """
+    try:
+        data = json.load(fileobj)
+    except ValueError as e:
+        raise InvalidRoutePayload('invalid GeoJSON: {}'.format(e))
+    if isinstance(data, dict) and data.get('type') == 'FeatureCollection':
+        features = data.get('features') or []
+    else:
+        features = [data]
+    if not isinstance(features, list):
+        raise InvalidRoutePayload('GeoJSON features must be a list')
+    for feature in features:
+        if not isinstance(feature, dict):
+            continue
+        properties = feature.get('properties') or {}
+        if not isinstance(properties, dict):
+            raise InvalidRoutePayload('GeoJSON properties must be an object')
+        geometry = feature.get('geometry', feature)
+        try:
+            positions = [position
+                         for line in _geojson_lines(geometry)
+                         for position in line]
+            if not all(isinstance(position, list) for position in positions):
+                raise TypeError
+            points = [_coordinate(position[1], position[0])
+                      for position in positions]
+            elevations = [_elevation(position[2]) if len(position) > 2
+                          else None for position in positions]
+        except (IndexError, KeyError, TypeError, AttributeError):
+            raise InvalidRoutePayload('invalid position in GeoJSON')
+        if not positions:
+            continue
+        times = properties.get('coordTimes') or properties.get('times')
+        if isinstance(times, list) and len(times) == len(points):
+            times = [_timestamp(time) for time in times]
+        else:
+            times = None
+        date = properties.get('date') or properties.get('time')
+        yield clean_track(points, times,
+                          _complete(elevations, len(points)),
+                          _timestamp(date) if date else None)
+
+
+def _parser(name):
+    extension = os.path.splitext(name.lower())[1]
+    if extension == '.gpx':
+        return parse_gpx
+    if extension in ('.geojson', '.json'):
+        return parse_geojson
+    raise InvalidRoutePayload('unsupported file type: {}'.format(name))
+
+
+def sources(path):
+    """
+    (path, member) pairs to import from a file, a zip archive or a
+    directory; member is the file's name inside an archive, else None.
+    """
+    if os.path.isdir(path):
+        for directory, _, names in sorted(os.walk(path)):
+            for name in sorted(names):
+                yield from sources(os.path.join(directory, name))
+    elif zipfile.is_zipfile(path):
+        with zipfile.ZipFile(path) as archive:
+            for member in archive.namelist():
+                if member.lower().endswith(EXTENSIONS):
+                    yield path, member
+    elif path.lower().endswith(EXTENSIONS):
+        yield path, None
+
+
+def parse_file(fileobj, name):
+    """
+    Yield the cleaned routes of one GPX or GeoJSON file object.
+    """
+    parser = _parser(name)
+    try:
+        yield from parser(fileobj)
+    except ElementTree.ParseError as e:
+        raise InvalidRoutePayload('invalid GPX: {}'.format(e))
+
+
+def _members(archive):
+    """
+    The ZipInfo of the importable files of `archive`, refused with
+    ImportTooLarge if the headers already exceed the limits.
+    """
+    members = [info for info in archive.infolist()
+               if info.filename.lower().endswith(EXTENSIONS)]
+    if len(members) > max_files():
+        raise ImportTooLarge('archive holds more than {} files'.format(
+            max_files()))
+    for info in members:
+        if info.file_size > max_file_size():
+            raise ImportTooLarge('{} inflates to more than {} bytes'.format(
+                info.filename, max_file_size()))
+    if sum(info.file_size for info in members) > max_size():
+        raise ImportTooLarge('archive inflates to more than {} bytes'.format(
+            max_size()))
+    return members
+
+
+def parse_source(source):
+    """
+    Parse one (path, member) pair from sources(). Returns
+    (name, routes, error) and never raises, so it can run in a pool; the
+    routes are listed since they are sent back to the parent process.
+    """
+    path, member = source
+    name = path if member is None else '{}:{}'.format(path, member)
+    try:
+        if member is None:
+            with open(path, 'rb') as fileobj:
+                reader = LimitedReader(fileobj, max_file_size())
+                return name, list(parse_file(reader, path)), None
+        with zipfile.ZipFile(path) as archive:
+            info = archive.getinfo(member)
+            if info.file_size > max_file_size():
+                raise ImportTooLarge('inflates to more than {} bytes'.format(
+                    max_file_size()))
+            with archive.open(info) as fileobj:
+                reader = LimitedReader(fileobj, max_file_size())
+                return name, list(parse_file(reader, member)), None
+    except (InvalidRoutePayload, ImportTooLarge, OSError,
+            zipfile.BadZipFile) as e:
+        return name, [], str(e)
+
+
+def parse_upload(upload):
+    """
+    Yield (name, routes) for an uploaded file, which may be a zip archive
+    of GPX and GeoJSON files. `routes` is parsed while it is iterated, so
+    it must be consumed before the next file is asked for; it raises
+    InvalidRoutePayload for an invalid file. ImportTooLarge is raised once
+    the upload exceeds the limits.
+    """
+    if zipfile.is_zipfile(upload):
+        upload.seek(0)
+        with zipfile.ZipFile(upload) as archive:
+            left = max_size()
+            for info in _members(archive):
+                with archive.open(info) as fileobj:
+                    reader = LimitedReader(
+                        fileobj, min(info.file_size, left))
+                    yield info.filename, parse_file(reader, info.filename)
+                left -= reader.count
+        return
+    upload.seek(0)
+    yield upload.name, parse_file(LimitedReader(upload, max_file_size()),
+                                  upload.name)
+
+
+def import_upload(user, upload):
+    """
+    Store the routes of an uploaded file for `user`, each file in its own
+    savepoint so an invalid one leaves nothing behind. Returns the ids of
+    the new routes and a list of {'file', 'detail'} errors.
+    """
+    ids, errors = [], []
+    for name, routes in parse_upload(upload):
+        try:
+            with transaction.atomic():
+                ids.extend(store_routes(user, routes))
+        except (InvalidRoutePayload, zipfile.BadZipFile) as e:
+            errors.append({'file': name, 'detail': str(e)})
+    return ids, errors
+
+
+def store_routes(user, routes, batch_size=None):
+    """
+    Store cleaned routes for `user`, `batch_size` routes per transaction.
+    Returns the ids of the new routes.
+    """
+    batch_size = batch_size or DEFAULT_BATCH_SIZE
+    stored, batch = [], []
+    for cleaned in routes:
+        batch.append(cleaned)
+        if len(batch) >= batch_size:
+            stored.extend(_store_batch(user, batch))
+            batch = []
+    if batch:
+        stored.extend(_store_batch(user, batch))
+    return stored
+
+
+def _store_batch(user, batch):
+    with transaction.atomic():
+        return [store_route(user, cleaned).pk for cleaned in batch]
@@ -0,0 +1,322 @@
+"""
+Route ingestion: validates an uploaded route payload once and writes the
+route together with its coordinates in a single transaction.
+"""
+import math
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import IntegrityError, transaction
+from django.utils.dateparse import parse_datetime, parse_duration
+
+from heyroad import polyline, processing
+from heyroad.geometry import pack_points, pack_values
+from heyroad.models import Route, LatLng, UploadKey
+
+DEFAULT_BATCH_SIZE = 2000
+MAX_KEY_LENGTH = UploadKey._meta.get_field('key').max_length
+# keys per lookup query, below SQLite's bound parameter limit
+KEY_CHUNK_SIZE = 500
+# point times are stored as int32 milliseconds
+MAX_POINT_SECONDS = (2 ** 31 - 1) // 1000
+ROUTE_STORAGES = ('rows', 'packed')
+
+
+class InvalidRoutePayload(ValueError):
+    pass
+
+
+def _parse_coordinate(coordinate):
+    try:
+        latitude = float(coordinate['latitude'])
+        longitude = float(coordinate['longitude'])
+    except (KeyError, TypeError, ValueError):
+        raise InvalidRoutePayload(
+            'invalid coordinate: {!r}'.format(coordinate))
+    if not (-90.0 <= latitude <= 90.0 and -180.0 <= longitude <= 180.0):
+        raise InvalidRoutePayload(
+            'coordinate out of range: {!r}'.format(coordinate))
+    return latitude, longitude
+
+
+def _parse_time(value, start):
+    """
+    Seconds since `start` of a point's 'time', given either as a number of
+    seconds or as an ISO 8601 timestamp.
+    """
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        seconds = float(value)
+    else:
+        try:
+            seconds = (parse_datetime(value) - start).total_seconds()
+        except (TypeError, ValueError):
+            raise InvalidRoutePayload(
+                'invalid point time: {!r}'.format(value))
+    if not -MAX_POINT_SECONDS <= seconds <= MAX_POINT_SECONDS:
+        raise InvalidRoutePayload(
+            'point time out of range: {!r}'.format(value))
+    return seconds
+
+
+def _parse_series(coords, key, parse):
+    """
+    Optional per-point values: either every point has `key` or none does.
+    """
+    present = sum(1 for coordinate in coords if key in coordinate)
+    if not present:
+        return None
+    if present != len(coords):
+        raise InvalidRoutePayload(
+            "'{}' must be given for all points or none".format(key))
+    return [parse(coordinate[key]) for coordinate in coords]
+
+
+def _parse_elevation(value):
+    try:
+        elevation = float(value)
+    except (TypeError, ValueError):
+        elevation = None
+    if elevation is None or not math.isfinite(elevation):
+        raise InvalidRoutePayload('invalid elevation: {!r}'.format(value))
+    return elevation
+
+
+def _parse_polyline(value):
+    try:
+        points = polyline.decode(value)
+    except ValueError as e:
+        raise InvalidRoutePayload('invalid polyline: {}'.format(e))
+    for latitude, longitude in points:
+        if not (-90.0 <= latitude <= 90.0 and -180.0 <= longitude <= 180.0):
+            raise InvalidRoutePayload('coordinate out of range: {!r}'.format(
+                (latitude, longitude)))
+    return points
+
+
+def _parse_list(body, key, size, parse):
+    """
+    Optional per-point values given as a list parallel to the points.
+    """
+    values = body.get(key)
+    if values is None:
+        return None
+    if not isinstance(values, list) or len(values) != size:
+        raise InvalidRoutePayload(
+            "'{}' must be a list with a value per point".format(key))
+    return [parse(value) for value in values]
+
+
+def parse_route_payload(body):
+    """
+    Validate a decoded route upload and return its cleaned fields.
+
+    Coordinates are returned as a list of (latitude, longitude) tuples.
+    Points may carry a 'time' and an 'elevation', which are returned as
+    separate lists (or None when absent).
+
+    `coords` may also be a Google encoded polyline, with the optional
+    per-point values given as top-level 'times' and 'elevations' lists.
+    """
+    if not isinstance(body, dict):
+        raise InvalidRoutePayload('payload must be an object')
+    try:
+        distance = float(body['distance'])
+        date = parse_datetime(body['date'])
+        duration = parse_duration(body['duration'])
+    except (KeyError, TypeError, ValueError) as e:
+        raise InvalidRoutePayload('invalid route field: {}'.format(e))
+    if date is None:
+        raise InvalidRoutePayload('invalid date: {!r}'.format(body['date']))
+    if duration is None:
+        raise InvalidRoutePayload(
+            'invalid duration: {!r}'.format(body['duration']))
+    if not math.isfinite(distance):
+        raise InvalidRoutePayload('distance must be a finite number')
+    if distance < 0:
+        raise InvalidRoutePayload('distance must not be negative')
+
+    points, times, elevations = parse_track(body, date)
+    return {
+        'distance': distance,
+        'date': date,
+        'duration': duration,
+        'points': points,
+        'times': times,
+        'elevations': elevations,
+    }
+
+
+def parse_track(body, date):
+    """
+    The (points, times, elevations) of the 'coords' of an upload, times in
+    seconds since `date`; see parse_route_payload().
+    """
+    if 'coords' not in body:
+        raise InvalidRoutePayload("'coords' is required")
+    coords = body['coords']
+    if isinstance(coords, str):
+        points = _parse_polyline(coords)
+        times = _parse_list(body, 'times', len(points),
+                            lambda value: _parse_time(value, date))
+        elevations = _parse_list(body, 'elevations', len(points),
+                                 _parse_elevation)
+    elif isinstance(coords, list):
+        points = [_parse_coordinate(coordinate) for coordinate in coords]
+        times = _parse_series(coords, 'time',
+                              lambda value: _parse_time(value, date))
+        elevations = _parse_series(coords, 'elevation', _parse_elevation)
+    else:
+        raise InvalidRoutePayload('coords must be a list or a polyline')
+    return points, times, elevations
+
+
+def route_storage():
+    storage = getattr(settings, 'HEYROAD_ROUTE_STORAGE', 'rows')
+    if storage not in ROUTE_STORAGES:
+        raise ImproperlyConfigured(
+            'HEYROAD_ROUTE_STORAGE must be one of {}'.format(ROUTE_STORAGES))
+    return storage
+
+
+def pack_times(times):
+    if times is None:
+        return None
+    return pack_values([int(round(seconds * 1000)) for seconds in times],
+                       'i')
+
+
+def pack_elevations(elevations):
+    if elevations is None:
+        return None
+    return pack_values(elevations, 'f')
+
+
+def write_route(user, distance, date, duration, points, times=None,
+                elevations=None, batch_size=None, storage=None):
+    """
+    Create a route and its coordinates atomically.
+
+    With the 'packed' storage the track goes into Route.track, otherwise
+    coordinates are written as LatLng rows using batched inserts.
+    """
+    if storage is None:
+        storage = route_storage()
+    if batch_size is None:
+        batch_size = getattr(settings, 'HEYROAD_INGEST_BATCH_SIZE',
+                             DEFAULT_BATCH_SIZE)
+    track = pack_points(points) if storage == 'packed' else None
+    with transaction.atomic():
+        route = Route.objects.create(user=user,
+                                     distance=distance,
+                                     duration=duration,
+                                     date=date,
+                                     track=track,
+                                     times=pack_times(times),
+                                     elevations=pack_elevations(elevations))
+        if track is None:
+            for start in range(0, len(points), batch_size):
+                LatLng.objects.bulk_create([
+                    LatLng(route=route, latitude=latitude,
+                           longitude=longitude)
+                    for latitude, longitude in points[start:start + batch_size]
+                ])
+    return route
+
+
+def ingest_route(user, body, batch_size=None):
+    """
+    Validate a decoded upload body and store it as a new route of `user`,
+    queued for processing.
+    """
+    return store_route(user, parse_route_payload(body), batch_size)
+
+
+def store_route(user, cleaned, batch_size=None):
+    """
+    Store already validated route fields (as returned by
+    parse_route_payload) as a new route of `user`, queued for processing.
+    """
+    with transaction.atomic():
+        route = write_route(user, batch_size=batch_size, **cleaned)
+        processing.enqueue(route, points=cleaned['points'],
+                           times=cleaned['times'],
+                           elevations=cleaned['elevations'])
+    return route
+
+
+def _parse_key(item):
+    key = item.get('key') if isinstance(item, dict) else None
+    if not isinstance(key, str) or not 0 < len(key) <= MAX_KEY_LENGTH:
+        raise InvalidRoutePayload(
+            "'key' must be a string of 1 to {} characters".format(
+                MAX_KEY_LENGTH))
+    return key
+
+
+def _stored_keys(user, keys):
+    keys = list(keys)
+    stored = {}
+    for start in range(0, len(keys), KEY_CHUNK_SIZE):
+        stored.update(UploadKey.objects.filter(
+            user=user, key__in=keys[start:start + KEY_CHUNK_SIZE]
+        ).values_list('key', 'route'))
+    return stored
+
+
+def ingest_batch(user, items, batch_size=None):
+    """
+    Store many uploaded routes of `user` in one transaction. Each item is
+    a route payload with a client-chosen idempotency 'key'; items whose
+    key was already stored are skipped, so a retried batch stores
+    nothing twice. Items are written in savepoints, an invalid one does
+    not undo the others.
+
+    Returns a result dict per item: 'created' or 'duplicate' with the
+    route id, or a 'failed_...' result with a detail.
+    """
+    keys = []
+    for item in items:
+        try:
+            keys.append(_parse_key(item))
+        except InvalidRoutePayload as e:
+            keys.append(e)
+    results = []
+    with transaction.atomic():
+        stored = _stored_keys(
+            user, {key for key in keys if isinstance(key, str)})
+        for item, key in zip(items, keys):
+            if isinstance(key, InvalidRoutePayload):
+                results.append({'result': 'failed_invalid_key',
+                                'detail': str(key)})
+                continue
+            if key in stored:
+                results.append({'key': key, 'result': 'duplicate',
+                                'id': stored[key]})
+                continue
+            try:
+                cleaned = parse_route_payload(item)
+                with transaction.atomic():
+                    route = store_route(user, cleaned, batch_size)
+                    UploadKey.objects.create(user=user, key=key,
+                                             route=route)
+            except InvalidRoutePayload as e:
+                results.append({'key': key,
+                                'result': 'failed_invalid_payload',
+                                'detail': str(e)})
+                continue
+            except IntegrityError as e:
+                # stored by a concurrent upload of the same batch, or a
+                # value the database refused
+                stored.update(_stored_keys(user, [key]))
+                if key in stored:
+                    results.append({'key': key, 'result': 'duplicate',
+                                    'id': stored[key]})
+                else:
+                    results.append({'key': key,
+                                    'result': 'failed_invalid_payload',
+                                    'detail': str(e)})
+                continue
+            stored[key] = route.pk
+            results.append({'key': key, 'result': 'created',
+                            'id': route.pk})
+    return results
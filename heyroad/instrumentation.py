@@ -0,0 +1,274 @@
+"""
+In-process metrics in the Prometheus text format.
+
+Counters and histograms live in the memory of each server process; a
+scraper sees the numbers of whichever process answered, so every worker
+should be scraped separately (or the numbers summed by the scraper).
+
+The time of a request is also split into phases (SQL, serializing,
+rendering API responses, rendering templates), measured by code running in them
+through phase() while the request's Phases are current.
+"""
+import threading
+import time
+from contextlib import contextmanager
+
+# seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0)
+QUERY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+DB = 'db'
+SERIALIZE = 'serialize'
+RENDER = 'render'
+TEMPLATE = 'template'
+PHASES = (DB, SERIALIZE, RENDER, TEMPLATE)
+
+_local = threading.local()
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n') \
+                     .replace('"', '\\"')
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, _escape(value))
+                          for name, value in pairs) + '}'
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.documentation),
+                 '# TYPE {} {}'.format(self.name, self.kind)]
+        with self._lock:
+            lines.extend(self._samples())
+        return lines
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+    def _samples(self):
+        return ['{}{} {}'.format(self.name,
+                                 _labels(self.label_names, key),
+                                 _number(value))
+                for key, value in sorted(self._values.items())]
+
+
+class Gauge(Metric):
+    """
+    A value read from `function` whenever the metrics are rendered.
+    """
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, function):
+        super().__init__(name, documentation)
+        self.function = function
+
+    def _samples(self):
+        return ['{} {}'.format(self.name, _number(self.function()))]
+
+
+class CounterFunction(Gauge):
+    """
+    A counter kept elsewhere, read from `function`.
+    """
+    kind = 'counter'
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(),
+                 buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets) + (float('inf'),)
+        self._values = {}
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(
+                key, ([0] * len(self.buckets), 0.0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            self._values[key] = (counts, total + value)
+
+    def count(self, **labels):
+        counts, _ = self._values.get(self._key(labels), ([0], 0.0))
+        return sum(counts)
+
+    def _samples(self):
+        samples = []
+        for key, (counts, total) in sorted(self._values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                samples.append('{}_bucket{} {}'.format(
+                    self.name,
+                    _labels(self.label_names, key, [('le', _number(bound))]),
+                    cumulative))
+            labels = _labels(self.label_names, key)
+            samples.append('{}_sum{} {}'.format(self.name, labels,
+                                                _number(total)))
+            samples.append('{}_count{} {}'.format(self.name, labels,
+                                                  cumulative))
+        return samples
+
+
+class Registry:
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, documentation, labels=()):
+        return self.register(Counter(name, documentation, labels))
+
+    def gauge(self, name, documentation, function):
+        return self.register(Gauge(name, documentation, function))
+
+    def counter_function(self, name, documentation, function):
+        return self.register(CounterFunction(name, documentation, function))
+
+    def histogram(self, name, documentation, labels=(),
+                  buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, documentation, labels,
+                                       buckets))
+
+    def render(self):
+        with self._lock:
+            metrics = sorted(self._metrics.values(),
+                             key=lambda metric: metric.name)
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+class Phases:
+    """
+    Seconds spent in each phase of one request. A phase started within
+    another counts for the inner one only, and a phase nested in itself
+    (serializers within serializers) is measured once.
+    """
+
+    def __init__(self):
+        self.seconds = dict.fromkeys(PHASES, 0.0)
+        # [name, seconds spent in inner phases] of the open phases
+        self._stack = []
+
+    @property
+    def current(self):
+        return self._stack[-1][0] if self._stack else None
+
+    @contextmanager
+    def phase(self, name):
+        if self.current == name:
+            yield
+            return
+        frame = [name, 0.0]
+        self._stack.append(frame)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self._stack.pop()
+            self.seconds[name] = self.seconds.get(name, 0.0) \
+                + elapsed - frame[1]
+            if self._stack:
+                self._stack[-1][1] += elapsed
+
+
+def start_phases():
+    _local.phases = Phases()
+    return _local.phases
+
+
+def stop_phases():
+    _local.phases = None
+
+
+def current_phases():
+    return getattr(_local, 'phases', None)
+
+
+@contextmanager
+def phase(name):
+    """
+    Count the time of the block for phase `name` of the current request.
+    """
+    phases = current_phases()
+    if phases is None:
+        yield
+        return
+    with phases.phase(name):
+        yield
+
+
+REGISTRY = Registry()
+
+requests_total = REGISTRY.counter(
+    'heyroad_requests_total', 'Requests handled, by view and status.',
+    labels=('view', 'method', 'status'))
+request_seconds = REGISTRY.histogram(
+    'heyroad_request_duration_seconds', 'Total time spent in a request.',
+    labels=('view', 'method'))
+db_seconds = REGISTRY.histogram(
+    'heyroad_request_db_seconds', 'Time spent in SQL queries per request.',
+    labels=('view',))
+db_queries = REGISTRY.histogram(
+    'heyroad_request_db_queries', 'SQL queries run per request.',
+    labels=('view',), buckets=QUERY_BUCKETS)
+serialize_seconds = REGISTRY.histogram(
+    'heyroad_request_serialize_seconds',
+    'Time spent in API serializers per request.',
+    labels=('view',))
+render_seconds = REGISTRY.histogram(
+    'heyroad_request_render_seconds',
+    'Time spent rendering API responses per request.',
+    labels=('view',))
+template_seconds = REGISTRY.histogram(
+    'heyroad_request_template_seconds',
+    'Time spent rendering templates per request.',
+    labels=('view',))
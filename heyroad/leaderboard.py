@@ -0,0 +1,105 @@
+"""
+Friend leaderboards.
+
+A leaderboard ranks a user and their friends by their StatsBucket totals
+of one week or month, which heyroad.stats keeps up to date, so building
+one reads a bucket per participant. Boards are cached under a key made of
+the stats versions of all participants, so one is served from the cache
+until a participant's totals change or the friends change, and checking
+that costs a single cache get_many. A change only reaches processes that
+share the cache; with the default per-process cache the others keep their
+boards until HEYROAD_LEADERBOARD_CACHE_TIMEOUT expires.
+"""
+import hashlib
+from datetime import datetime, time, timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+
+from heyroad import friends, stats
+from heyroad.models import StatsBucket
+
+METRICS = ('distance', 'duration', 'route_count')
+CACHE_TIMEOUT = 60
+
+
+class InvalidLeaderboard(ValueError):
+    pass
+
+
+def _timeout():
+    return getattr(settings, 'HEYROAD_LEADERBOARD_CACHE_TIMEOUT',
+                   CACHE_TIMEOUT)
+
+
+def _ranked(user, period, start, metric):
+    rows = StatsBucket.objects.filter(
+        friends.visible_q(user), period=period, start=start,
+        route_count__gt=0
+    ).values_list('user_id', 'user__username', 'route_count', 'distance',
+                  'duration_seconds')
+    board = [{'user': user_id, 'username': username, 'route_count': count,
+              'distance': distance, 'duration': timedelta(seconds=seconds)}
+             for user_id, username, count, distance, seconds in rows]
+    # highest first, ties by name
+    board.sort(key=lambda entry: entry['username'])
+    board.sort(key=lambda entry: entry[metric], reverse=True)
+    rank, previous = 0, None
+    for position, entry in enumerate(board, 1):
+        if entry[metric] != previous:
+            rank, previous = position, entry[metric]
+        entry['rank'] = rank
+    return board
+
+
+def parse_period(value):
+    period = value or StatsBucket.WEEK
+    if period not in stats.PERIODS:
+        raise InvalidLeaderboard(
+            'period must be one of: {}'.format(', '.join(stats.PERIODS)))
+    return period
+
+
+def parse_metric(value):
+    metric = value or 'distance'
+    if metric not in METRICS:
+        raise InvalidLeaderboard(
+            'metric must be one of: {}'.format(', '.join(METRICS)))
+    return metric
+
+
+def parse_day(value):
+    """
+    A YYYY-MM-DD date as a datetime at noon, None for no date.
+    """
+    if not value:
+        return None
+    try:
+        day = parse_date(value)
+    except ValueError:
+        day = None
+    if day is None:
+        raise InvalidLeaderboard('date must be YYYY-MM-DD')
+    return timezone.make_aware(datetime.combine(day, time(12)))
+
+
+def leaderboard(user, period=StatsBucket.WEEK, metric='distance',
+                date=None):
+    """
+    `user` and their friends ranked by `metric` over the week or month
+    containing `date` (now by default). Users without a route in it are
+    left out; 'rank' is 1-based and shared by equal totals.
+    """
+    start = stats.period_start(period, date or timezone.now())
+    versions = stats.versions(friends.visible_user_ids(user))
+    digest = hashlib.md5(repr(versions).encode('utf-8')).hexdigest()
+    key = 'heyroad:leaderboard:{}:{}:{}:{}'.format(period, start, metric,
+                                                   digest)
+    board = cache.get(key)
+    if board is None:
+        board = _ranked(user, period, start, metric)
+        cache.set(key, board, _timeout())
+    return {'period': period, 'start': start, 'metric': metric,
+            'entries': board}
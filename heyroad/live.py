@@ -0,0 +1,339 @@
+"""
+Live tracking of rides in progress.
+
+A rider starts a LiveRoute, appends chunks of points while riding and
+finishes it into a regular Route. Friends follow the ride by long-polling
+or through Server-Sent Events, both served from HUB: it keeps the latest
+HEYROAD_LIVE_CHUNKS_KEPT chunks of every watched ride in memory, so
+however many watchers wait on one ride the database is read at most once
+per HEYROAD_LIVE_POLL_INTERVAL, and chunks appended through the same
+process reach its watchers without any read. Watchers further behind
+read their chunks from the database, and a finished ride keeps no chunks,
+watchers then only need the id of its route.
+"""
+import json
+import math
+import threading
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from heyroad.caching import LRUCache
+from heyroad.geometry import pack_points, unpack_points, unpack_values
+from heyroad.ingest import InvalidRoutePayload, pack_elevations, \
+                           pack_times, parse_track, store_route
+from heyroad.metrics import compute_metrics
+from heyroad.models import LiveRoute, LiveChunk
+
+# seconds between database reads of a watched ride
+POLL_INTERVAL = 1.0
+# rides whose chunks are kept in memory
+MAX_CHANNELS = 1000
+# latest chunks of a ride kept in memory
+CHUNKS_KEPT = 100
+# longest long-poll, seconds
+MAX_WAIT = 30
+# seconds between keep-alive comments of an event stream
+KEEPALIVE = 15
+# an event stream ends after this many seconds, freeing its server
+# worker; clients reconnect with Last-Event-ID
+STREAM_SECONDS = 60
+
+
+def poll_interval():
+    return getattr(settings, 'HEYROAD_LIVE_POLL_INTERVAL', POLL_INTERVAL)
+
+
+def chunks_kept():
+    return getattr(settings, 'HEYROAD_LIVE_CHUNKS_KEPT', CHUNKS_KEPT)
+
+
+def chunk_data(chunk):
+    """
+    A LiveChunk as sent to watchers, times in seconds since the start.
+    """
+    times = elevations = None
+    if chunk.times is not None:
+        times = [value / 1000 for value in unpack_values(chunk.times, 'i')]
+    if chunk.elevations is not None:
+        elevations = list(unpack_values(chunk.elevations, 'f'))
+    return {'seq': chunk.seq, 'coords': unpack_points(chunk.track),
+            'times': times, 'elevations': elevations}
+
+
+class _Channel:
+
+    def __init__(self, live_id):
+        self.live_id = live_id
+        self.condition = threading.Condition()
+        self.owner_id = None
+        # number of the latest chunk
+        self.seq = 0
+        # data of the latest chunks in order, ending with chunk self.seq
+        self.chunks = []
+        self.finished = False
+        self.route_id = None
+        # time.monotonic() of the last database read, None forces one
+        self.checked = None
+
+    def add(self, chunks):
+        for chunk in chunks:
+            if chunk['seq'] != self.seq + 1:
+                # the chunks in between were never kept
+                self.chunks = []
+            self.chunks.append(chunk)
+            self.seq = chunk['seq']
+        kept = chunks_kept()
+        if len(self.chunks) > kept:
+            del self.chunks[:len(self.chunks) - kept]
+
+    def finish(self):
+        self.finished = True
+        self.chunks = []
+
+    def behind(self, after):
+        """
+        Whether chunks after the `after`th are no longer kept.
+        """
+        return not self.finished and after < self.seq - len(self.chunks)
+
+    def snapshot(self, after):
+        return {'id': self.live_id, 'seq': self.seq,
+                'chunks': [chunk for chunk in self.chunks
+                           if chunk['seq'] > after],
+                'finished': self.finished, 'route': self.route_id}
+
+
+class Hub:
+    """
+    In-process fan-out of live rides to their watchers.
+    """
+
+    def __init__(self, max_channels=MAX_CHANNELS):
+        self._channels = LRUCache(max_entries=max_channels)
+        self._lock = threading.Lock()
+        # database reads, to check the coalescing
+        self.reads = 0
+
+    def _channel(self, live_id, create=True):
+        with self._lock:
+            channel = self._channels.get(live_id)
+            if channel is None and create:
+                channel = _Channel(live_id)
+                self._channels.set(live_id, channel)
+            return channel
+
+    def _refresh(self, channel):
+        # called with channel.condition held, so watchers of the same ride
+        # wait for this read instead of making their own
+        self.reads += 1
+        row = LiveRoute.objects.filter(pk=channel.live_id).values_list(
+            'user', 'seq', 'finished', 'route').first()
+        channel.checked = time.monotonic()
+        if row is None:
+            channel.owner_id = None
+            channel.finish()
+        else:
+            channel.owner_id, seq, finished, channel.route_id = row
+            if finished is not None:
+                # its chunks are deleted
+                channel.finish()
+            elif seq > channel.seq:
+                chunks = LiveChunk.objects.filter(
+                    live=channel.live_id,
+                    seq__gt=max(channel.seq, seq - chunks_kept()))
+                channel.add(chunk_data(chunk) for chunk in chunks)
+        channel.condition.notify_all()
+
+    def _stale(self, channel):
+        return channel.checked is None \
+            or time.monotonic() - channel.checked >= poll_interval()
+
+    def owner(self, live_id):
+        """
+        Id of the rider of a live ride, None if there is no such ride.
+        """
+        channel = self._channel(live_id)
+        with channel.condition:
+            if channel.checked is None:
+                self._refresh(channel)
+            return channel.owner_id
+
+    def wait(self, live_id, after=0, timeout=0):
+        """
+        The state of a live ride with its chunks after the `after`th,
+        waiting up to `timeout` seconds for one when there is none yet.
+        """
+        if not math.isfinite(timeout):
+            raise ValueError('timeout must be finite')
+        channel = self._channel(live_id)
+        deadline = time.monotonic() + timeout
+        with channel.condition:
+            while True:
+                if self._stale(channel):
+                    self._refresh(channel)
+                if channel.seq > after or channel.finished:
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                channel.condition.wait(min(
+                    remaining,
+                    channel.checked + poll_interval() - time.monotonic()))
+            state = channel.snapshot(after)
+            behind = channel.behind(after)
+        if behind:
+            # read outside the lock, the watchers that are up to date
+            # need not wait for it
+            self.reads += 1
+            chunks = LiveChunk.objects.filter(
+                live=live_id, seq__gt=after,
+                seq__lte=state['seq'])[:chunks_kept()]
+            state['chunks'] = [chunk_data(chunk) for chunk in chunks]
+            if state['chunks']:
+                state['seq'] = state['chunks'][-1]['seq']
+        return state
+
+    def publish(self, live_id, chunk=None):
+        """
+        Hand a chunk just stored to the watchers of the ride, or with no
+        chunk make them read the ride again.
+        """
+        channel = self._channel(live_id, create=False)
+        if channel is None:
+            return
+        with channel.condition:
+            if chunk is not None and chunk['seq'] == channel.seq + 1 \
+                    and not channel.finished:
+                channel.add([chunk])
+            else:
+                channel.checked = None
+            channel.condition.notify_all()
+
+    def clear(self):
+        self._channels.clear()
+
+
+HUB = Hub()
+
+
+def start(user, date=None):
+    return LiveRoute.objects.create(user=user, started=date or timezone.now())
+
+
+def append(live, body):
+    """
+    Store a chunk of points, given like the 'coords' of a route upload.
+    A client may number its chunks with 'seq' so that a retried chunk is
+    not stored twice; returns None for such a retry.
+    """
+    if live.finished is not None:
+        raise InvalidRoutePayload('the ride is finished')
+    if not isinstance(body, dict):
+        raise InvalidRoutePayload('payload must be an object')
+    seq = body.get('seq')
+    if seq is not None:
+        if not isinstance(seq, int) or isinstance(seq, bool):
+            raise InvalidRoutePayload("'seq' must be an integer")
+        if seq <= live.seq:
+            return None
+        if seq != live.seq + 1:
+            raise InvalidRoutePayload(
+                'expected chunk {}, got {}'.format(live.seq + 1, seq))
+    points, times, elevations = parse_track(
+        dict(body, coords=body.get('coords', [])), live.started)
+    if not points:
+        raise InvalidRoutePayload('a chunk needs at least one point')
+    chunk = LiveChunk(live=live, seq=live.seq + 1, track=pack_points(points),
+                      times=pack_times(times),
+                      elevations=pack_elevations(elevations))
+    with transaction.atomic():
+        chunk.save()
+        LiveRoute.objects.filter(pk=live.pk).update(
+            seq=chunk.seq, updated=timezone.now())
+        data = chunk_data(chunk)
+        transaction.on_commit(lambda: HUB.publish(live.pk, data))
+    live.seq = chunk.seq
+    return chunk
+
+
+def _joined(chunks, field, typecode, scale=1):
+    values = []
+    for chunk in chunks:
+        data = getattr(chunk, field)
+        # a series is kept only if every chunk has it
+        if data is None:
+            return None
+        values.extend(value / scale for value in unpack_values(data,
+                                                               typecode))
+    return values
+
+
+def finish(live, distance=None):
+    """
+    Store the appended chunks as a Route of the rider. The distance is
+    measured along the track unless given.
+    """
+    chunks = list(live.chunks.all())
+    if not chunks:
+        raise InvalidRoutePayload('no points were appended')
+    points = [point for chunk in chunks
+              for point in unpack_points(chunk.track)]
+    times = _joined(chunks, 'times', 'i', 1000)
+    elevations = _joined(chunks, 'elevations', 'f')
+    if times:
+        duration = timedelta(seconds=max(times[-1], 0))
+    else:
+        duration = timezone.now() - live.started
+    if distance is None:
+        distance = compute_metrics(points)['distance']
+    with transaction.atomic():
+        route = store_route(live.user, {
+            'distance': distance,
+            'date': live.started,
+            'duration': duration,
+            'points': points,
+            'times': times,
+            'elevations': elevations,
+        })
+        live.route = route
+        live.finished = timezone.now()
+        live.save(update_fields=['route', 'finished'])
+        live.chunks.all().delete()
+        transaction.on_commit(lambda: HUB.publish(live.pk))
+    return route
+
+
+def discard(live):
+    live_id = live.pk
+    live.delete()
+    transaction.on_commit(lambda: HUB.publish(live_id))
+
+
+def events(live_id, after=0, duration=None):
+    """
+    Server-Sent Events of a live ride: a 'chunk' event per chunk after
+    the `after`th, then 'finished' with the id of the stored route.
+    """
+    if duration is None:
+        duration = getattr(settings, 'HEYROAD_LIVE_STREAM_SECONDS',
+                           STREAM_SECONDS)
+    end = time.monotonic() + duration
+    while True:
+        remaining = end - time.monotonic()
+        if remaining <= 0:
+            return
+        state = HUB.wait(live_id, after, min(KEEPALIVE, remaining))
+        for chunk in state['chunks']:
+            yield 'id: {}\nevent: chunk\ndata: {}\n\n'.format(
+                chunk['seq'], json.dumps(chunk))
+            after = chunk['seq']
+        if state['finished']:
+            yield 'event: finished\ndata: {}\n\n'.format(
+                json.dumps({'route': state['route']}))
+            return
+        if not state['chunks']:
+            yield ': keepalive\n\n'
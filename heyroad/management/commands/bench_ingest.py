@@ -0,0 +1,106 @@
+import random
+from functools import partial
+import time
+from datetime import timedelta
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.utils import timezone
+
+from heyroad.ingest import parse_route_payload, write_route, ROUTE_STORAGES
+from heyroad.models import Route, LatLng
+
+
+class Rollback(Exception):
+    pass
+
+
+class QueryCounter:
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+def make_payload(size, seed=0):
+    rng = random.Random(seed)
+    latitude, longitude = 52.2297, 21.0122
+    coords = []
+    for _ in range(size):
+        latitude += rng.uniform(-0.0001, 0.0001)
+        longitude += rng.uniform(-0.0001, 0.0001)
+        coords.append({'latitude': latitude, 'longitude': longitude})
+    return {
+        'distance': size * 0.005,
+        'date': timezone.now().isoformat(),
+        'duration': str(timedelta(seconds=size)),
+        'coords': coords,
+    }
+
+
+def legacy_write(user, distance, date, duration, points, **kwargs):
+    # per-point create()+save(), as RouteViewSet.create used to do
+    route = Route.objects.create(user=user, distance=distance,
+                                 duration=duration, date=date)
+    route.save()
+    for latitude, longitude in points:
+        latlng = LatLng.objects.create(route=route, latitude=latitude,
+                                       longitude=longitude)
+        latlng.save()
+    return route
+
+
+class Command(BaseCommand):
+    help = 'Measure the cost of uploading routes of various sizes. ' \
+           'Everything written is rolled back.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', nargs='+', type=int,
+                            default=[1000, 10000, 100000])
+        parser.add_argument('--repeat', type=int, default=3)
+        parser.add_argument('--storage', nargs='+', choices=ROUTE_STORAGES,
+                            default=list(ROUTE_STORAGES))
+        parser.add_argument('--legacy', action='store_true',
+                            help='also time the old per-point writes')
+
+    def handle(self, *args, **options):
+        writers = [(storage, partial(write_route, storage=storage))
+                   for storage in options['storage']]
+        if options['legacy']:
+            writers.append(('legacy', legacy_write))
+
+        self.stdout.write('{:>8} {:>8} {:>10} {:>10} {:>12} {:>8}'.format(
+            'writer', 'points', 'parse ms', 'write ms', 'points/s',
+            'queries'))
+        for size in options['sizes']:
+            payload = make_payload(size)
+            for name, writer in writers:
+                parse_times, write_times, queries = [], [], 0
+                for _ in range(options['repeat']):
+                    start = time.perf_counter()
+                    cleaned = parse_route_payload(payload)
+                    parse_times.append(time.perf_counter() - start)
+                    try:
+                        with transaction.atomic():
+                            user = User.objects.create(
+                                username='bench-ingest-user')
+                            counter = QueryCounter()
+                            with connection.execute_wrapper(counter):
+                                start = time.perf_counter()
+                                writer(user, **cleaned)
+                                write_times.append(
+                                    time.perf_counter() - start)
+                            queries = counter.count
+                            raise Rollback
+                    except Rollback:
+                        pass
+                parse_s = min(parse_times)
+                write_s = min(write_times)
+                self.stdout.write(
+                    '{:>8} {:>8} {:>10.1f} {:>10.1f} {:>12.0f} {:>8}'.format(
+                        name, size, parse_s * 1000, write_s * 1000,
+                        size / (parse_s + write_s), queries))
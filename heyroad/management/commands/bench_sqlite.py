@@ -0,0 +1,163 @@
+import os
+import random
+import sqlite3
+import tempfile
+import threading
+import time
+
+from django.core.management.base import BaseCommand
+
+from heyroad.db import RECOMMENDED_PRAGMAS, pragma_statements
+from heyroad.management.commands.bench_web import percentile
+
+PROFILES = {
+    # what the development settings do: rollback journal, default
+    # pragmas and a new connection for every request
+    'default': {'pragmas': {}, 'persistent': False},
+    # heyroad_site.settings_production
+    'production': {'pragmas': RECOMMENDED_PRAGMAS, 'persistent': True},
+}
+
+SCHEMA = '''
+CREATE TABLE route (id INTEGER PRIMARY KEY, user_id INTEGER NOT NULL,
+                    date REAL NOT NULL, distance REAL NOT NULL,
+                    track BLOB NOT NULL);
+CREATE INDEX route_user_date ON route (user_id, date);
+'''
+
+
+class Worker(threading.Thread):
+
+    def __init__(self, path, profile, operation, deadline, seed):
+        super().__init__(daemon=True)
+        self.path = path
+        self.profile = profile
+        self.operation = operation
+        self.deadline = deadline
+        self.rng = random.Random(seed)
+        self.latencies = []
+        self.errors = 0
+        self.connection = None
+
+    def connect(self):
+        connection = sqlite3.connect(self.path, timeout=20,
+                                     isolation_level=None)
+        for statement in pragma_statements(self.profile['pragmas']):
+            connection.execute(statement)
+        return connection
+
+    def run(self):
+        while time.perf_counter() < self.deadline:
+            start = time.perf_counter()
+            try:
+                if self.connection is None:
+                    self.connection = self.connect()
+                self.operation(self.connection, self.rng)
+            except sqlite3.OperationalError:
+                self.errors += 1
+            finally:
+                if not self.profile['persistent'] \
+                        and self.connection is not None:
+                    self.connection.close()
+                    self.connection = None
+            self.latencies.append(time.perf_counter() - start)
+        if self.connection is not None:
+            self.connection.close()
+
+
+def read_feed(connection, rng):
+    # a page of the routes of a few users, then one of their tracks
+    users = rng.sample(range(200), 5)
+    rows = connection.execute(
+        'SELECT id, user_id, date, distance FROM route '
+        'WHERE user_id IN (?, ?, ?, ?, ?) ORDER BY date DESC LIMIT 20',
+        users).fetchall()
+    if rows:
+        connection.execute('SELECT track FROM route WHERE id = ?',
+                           (rows[0][0],)).fetchone()
+
+
+def make_writer(points):
+    track = os.urandom(8 * points)
+
+    def upload(connection, rng):
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            connection.execute(
+                'INSERT INTO route (user_id, date, distance, track) '
+                'VALUES (?, ?, ?, ?)',
+                (rng.randrange(200), time.time(), rng.uniform(1, 100),
+                 track))
+            connection.execute('COMMIT')
+        except sqlite3.Error:
+            connection.execute('ROLLBACK')
+            raise
+    return upload
+
+
+class Command(BaseCommand):
+    help = 'Compare mixed read/write throughput of SQLite with the ' \
+           'default and the production database profile.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--readers', type=int, default=8)
+        parser.add_argument('--writers', type=int, default=2)
+        parser.add_argument('--seconds', type=float, default=5.0)
+        parser.add_argument('--points', type=int, default=1000,
+                            help='points per uploaded route')
+        parser.add_argument('--rows', type=int, default=5000,
+                            help='routes in the database to start with')
+        parser.add_argument('--profiles', nargs='+', choices=PROFILES,
+                            default=list(PROFILES))
+
+    def _prepare(self, path, profile, options):
+        connection = sqlite3.connect(path, isolation_level=None)
+        for statement in pragma_statements(profile['pragmas']):
+            connection.execute(statement)
+        connection.executescript(SCHEMA)
+        rng = random.Random(0)
+        track = os.urandom(8 * options['points'])
+        connection.execute('BEGIN')
+        connection.executemany(
+            'INSERT INTO route (user_id, date, distance, track) '
+            'VALUES (?, ?, ?, ?)',
+            ((rng.randrange(200), rng.uniform(0, 1e9), rng.uniform(1, 100),
+              track) for _ in range(options['rows'])))
+        connection.execute('COMMIT')
+        connection.close()
+
+    def handle(self, *args, **options):
+        self.stdout.write('{:>10} {:>9} {:>9} {:>12} {:>12} {:>7}'.format(
+            'profile', 'reads/s', 'writes/s', 'read p99 ms',
+            'write p99 ms', 'errors'))
+        writer = make_writer(options['points'])
+        for name in options['profiles']:
+            profile = PROFILES[name]
+            with tempfile.TemporaryDirectory() as directory:
+                path = os.path.join(directory, 'bench.sqlite3')
+                self._prepare(path, profile, options)
+                deadline = time.perf_counter() + options['seconds']
+                workers = [
+                    Worker(path, profile, read_feed, deadline, seed)
+                    for seed in range(options['readers'])
+                ] + [
+                    Worker(path, profile, writer, deadline, -seed)
+                    for seed in range(1, options['writers'] + 1)
+                ]
+                for worker in workers:
+                    worker.start()
+                for worker in workers:
+                    worker.join()
+            readers = workers[:options['readers']]
+            writers = workers[options['readers']:]
+            reads = [value for worker in readers
+                     for value in worker.latencies]
+            writes = [value for worker in writers
+                      for value in worker.latencies]
+            self.stdout.write(
+                '{:>10} {:>9.0f} {:>9.0f} {:>12.1f} {:>12.1f} {:>7}'.format(
+                    name, len(reads) / options['seconds'],
+                    len(writes) / options['seconds'],
+                    percentile(reads, 0.99) * 1000 if reads else 0,
+                    percentile(writes, 0.99) * 1000 if writes else 0,
+                    sum(worker.errors for worker in workers)))
@@ -0,0 +1,157 @@
+import json
+import math
+import time
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.db.models import Count, Q
+from django.test import Client, override_settings
+from rest_framework.authtoken.models import Token
+
+from heyroad import friends
+from heyroad.management.commands.bench_ingest import QueryCounter
+from heyroad.models import Route
+
+ENDPOINTS = (
+    ('api-routes', '/api/route/'),
+    ('api-users', '/api/user/'),
+    ('home', '/'),
+    ('route', '/route/{route}/'),
+    ('friends', '/friends/'),
+)
+
+
+def percentile(values, fraction):
+    """
+    Nearest-rank percentile of `values`.
+    """
+    values = sorted(values)
+    rank = max(1, math.ceil(fraction * len(values)))
+    return values[rank - 1]
+
+
+def summarize(latencies, queries):
+    return {
+        'p50': percentile(latencies, 0.5),
+        'p90': percentile(latencies, 0.9),
+        'p99': percentile(latencies, 0.99),
+        'max': max(latencies),
+        'queries': max(queries),
+    }
+
+
+def regressions(results, baseline, tolerance):
+    """
+    Messages for the endpoints slower than their baseline p90 by more
+    than `tolerance`, or running more queries than the baseline.
+    """
+    messages = []
+    for name, result in sorted(results.items()):
+        if name not in baseline:
+            continue
+        expected = baseline[name]
+        if result['queries'] > expected['queries']:
+            messages.append('{}: {} queries, baseline {}'.format(
+                name, result['queries'], expected['queries']))
+        if result['p90'] > expected['p90'] * (1 + tolerance):
+            messages.append('{}: p90 {:.1f} ms, baseline {:.1f} ms'.format(
+                name, result['p90'] * 1000, expected['p90'] * 1000))
+    return messages
+
+
+class Command(BaseCommand):
+    help = 'Measure latency and query counts of the main pages and API ' \
+           'endpoints through the test client, e.g. on data from ' \
+           'seed_data.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user',
+                            help='username to browse as; by default the '
+                                 'user with the most friends')
+        parser.add_argument('--requests', type=int, default=50)
+        parser.add_argument('--warmup', type=int, default=5)
+        parser.add_argument('--endpoints', nargs='+',
+                            choices=[name for name, _ in ENDPOINTS],
+                            default=[name for name, _ in ENDPOINTS])
+        parser.add_argument('--save-baseline', metavar='PATH')
+        parser.add_argument('--compare', metavar='PATH',
+                            help='fail if slower or running more queries '
+                                 'than this baseline')
+        parser.add_argument('--tolerance', type=float, default=0.25,
+                            help='allowed p90 slowdown over the baseline')
+
+    def _user(self, username):
+        if username:
+            try:
+                return User.objects.get(username=username)
+            except User.DoesNotExist:
+                raise CommandError('No user {}.'.format(username))
+        user = User.objects.annotate(
+            degree=Count('user_1', filter=Q(user_1__is_accepted=True),
+                         distinct=True)
+            + Count('user_2', filter=Q(user_2__is_accepted=True),
+                    distinct=True)
+        ).order_by('-degree', 'pk').first()
+        if user is None:
+            raise CommandError('No users, run seed_data first.')
+        return user
+
+    def handle(self, *args, **options):
+        user = self._user(options['user'])
+        route = Route.objects.filter(friends.visible_q(user)) \
+                             .order_by('-date', '-id') \
+                             .values_list('pk', flat=True).first()
+        if route is None:
+            raise CommandError('{} sees no routes.'.format(user))
+        token, _ = Token.objects.get_or_create(user=user)
+        client = Client(HTTP_AUTHORIZATION='Token ' + token.key)
+        client.force_login(user)
+
+        results = {}
+        hosts = list(settings.ALLOWED_HOSTS) + ['testserver']
+        with override_settings(ALLOWED_HOSTS=hosts):
+            for name, path in ENDPOINTS:
+                if name not in options['endpoints']:
+                    continue
+                path = path.format(route=route)
+                for _ in range(options['warmup']):
+                    client.get(path)
+                latencies, queries = [], []
+                for _ in range(options['requests']):
+                    counter = QueryCounter()
+                    with ExitStack() as stack:
+                        # reads may go to a replica, see heyroad.db
+                        for connection in connections.all():
+                            stack.enter_context(
+                                connection.execute_wrapper(counter))
+                        start = time.perf_counter()
+                        response = client.get(path)
+                        latencies.append(time.perf_counter() - start)
+                    if response.status_code != 200:
+                        raise CommandError('{} returned {}.'.format(
+                            path, response.status_code))
+                    queries.append(counter.count)
+                results[name] = summarize(latencies, queries)
+
+        self.stdout.write('{:>12} {:>9} {:>9} {:>9} {:>9} {:>8}'.format(
+            'endpoint', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms', 'queries'))
+        for name, result in results.items():
+            self.stdout.write(
+                '{:>12} {:>9.1f} {:>9.1f} {:>9.1f} {:>9.1f} {:>8}'.format(
+                    name, result['p50'] * 1000, result['p90'] * 1000,
+                    result['p99'] * 1000, result['max'] * 1000,
+                    result['queries']))
+
+        if options['save_baseline']:
+            with open(options['save_baseline'], 'w') as f:
+                json.dump(results, f, indent=2, sort_keys=True)
+        if options['compare']:
+            with open(options['compare']) as f:
+                baseline = json.load(f)
+            messages = regressions(results, baseline, options['tolerance'])
+            if messages:
+                raise CommandError('Regressions against {}:\n{}'.format(
+                    options['compare'], '\n'.join(messages)))
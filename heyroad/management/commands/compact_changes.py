@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+
+from heyroad import changes
+
+
+class Command(BaseCommand):
+    help = 'Drop superseded delta sync log entries and old tombstones.'
+
+    def handle(self, *args, **options):
+        superseded, expired = changes.compact()
+        self.stdout.write('Deleted {} superseded entries and {} tombstones.'
+                          .format(superseded, expired))
@@ -0,0 +1,53 @@
+import os
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from heyroad import importers
+from heyroad.db import process_pool
+
+
+class Command(BaseCommand):
+    help = 'Import routes from GPX/GeoJSON files, zip archives of them ' \
+           'or directories.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('username', help='owner of the imported routes')
+        parser.add_argument('paths', nargs='+')
+        parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                            help='processes parsing files in parallel')
+        parser.add_argument('--batch-size', type=int,
+                            default=importers.DEFAULT_BATCH_SIZE,
+                            help='routes stored per transaction')
+
+    def handle(self, *args, **options):
+        try:
+            user = User.objects.get(username=options['username'])
+        except User.DoesNotExist:
+            raise CommandError('No user {!r}.'.format(options['username']))
+        sources = [source for path in options['paths']
+                   for source in importers.sources(path)]
+
+        workers = max(1, options['workers'] or 1)
+        if workers == 1:
+            self._store(user, map(importers.parse_source, sources), options)
+        else:
+            with process_pool(workers) as pool:
+                self._store(user, pool.map(importers.parse_source, sources),
+                            options)
+
+    def _store(self, user, results, options):
+        self.failed = 0
+        ids = importers.store_routes(user, self._routes(results),
+                                     options['batch_size'])
+        self.stdout.write('Imported {} routes, {} files failed.'.format(
+            len(ids), self.failed))
+
+    def _routes(self, results):
+        # batches may span files, many exports hold one ride per file
+        for name, routes, error in results:
+            if error is not None:
+                self.failed += 1
+                self.stderr.write('{}: {}'.format(name, error))
+                continue
+            yield from routes
@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from heyroad.models import Route
+from heyroad.spatial import index_route
+
+
+class Command(BaseCommand):
+    help = 'Build the bounding boxes and grid cells of existing routes.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true',
+                            help='reindex routes that are already indexed')
+
+    def handle(self, *args, **options):
+        routes = Route.objects.all()
+        if not options['all']:
+            routes = routes.filter(min_latitude__isnull=True)
+        count = 0
+        for route in routes.iterator():
+            with transaction.atomic():
+                index_route(route, route.get_points())
+            count += 1
+        self.stdout.write('Indexed {} routes.'.format(count))
@@ -0,0 +1,83 @@
+import logging
+import threading
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from heyroad import processing
+from heyroad.models import Route, RouteJob
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Run workers processing uploaded routes.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=2,
+                            help='worker threads in this process')
+        parser.add_argument('--poll', type=float, default=2.0,
+                            help='seconds to sleep when the queue is empty')
+        parser.add_argument('--once', action='store_true',
+                            help='exit once the queue is empty')
+        parser.add_argument('--enqueue-missing', action='store_true',
+                            help='first queue routes that were never '
+                                 'processed')
+
+    def handle(self, *args, **options):
+        if options['enqueue_missing']:
+            routes = Route.objects.filter(job__isnull=True)
+            RouteJob.objects.bulk_create(
+                [RouteJob(route_id=pk)
+                 for pk in routes.values_list('pk', flat=True)],
+                batch_size=500)
+
+        self.stop = threading.Event()
+        self.processed = 0
+        self.lock = threading.Lock()
+        workers = max(1, options['workers'])
+        if workers == 1:
+            self.run_worker(options)
+        else:
+            self.run_threads(workers, options)
+        self.stdout.write('Processed {} routes.'.format(self.processed))
+
+    def run_threads(self, workers, options):
+        threads = [threading.Thread(target=self.thread_main, args=(options,),
+                                    daemon=True)
+                   for _ in range(workers)]
+        for thread in threads:
+            thread.start()
+        try:
+            for thread in threads:
+                while thread.is_alive():
+                    thread.join(timeout=1)
+        except KeyboardInterrupt:
+            self.stop.set()
+            for thread in threads:
+                thread.join()
+
+    def thread_main(self, options):
+        try:
+            self.run_worker(options)
+        finally:
+            connection.close()
+
+    def run_worker(self, options):
+        try:
+            while not self.stop.is_set():
+                try:
+                    count = processing.run_pending(limit=10)
+                except Exception:
+                    # one bad row must not end the worker
+                    logger.exception('Processing routes failed')
+                    self.stop.wait(options['poll'])
+                    continue
+                with self.lock:
+                    self.processed += count
+                if not count:
+                    if options['once']:
+                        return
+                    self.stop.wait(options['poll'])
+        except KeyboardInterrupt:
+            self.stop.set()
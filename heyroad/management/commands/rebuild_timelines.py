@@ -0,0 +1,28 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+
+from heyroad import timeline
+
+
+class Command(BaseCommand):
+    help = 'Backfill or repair the home feed timelines of users.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', nargs='+', type=int,
+                            help='only rebuild these user ids')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='only report how far timelines drifted')
+
+    def handle(self, *args, **options):
+        users = User.objects.order_by('pk')
+        if options['users']:
+            users = users.filter(pk__in=options['users'])
+        added = removed = count = 0
+        for user in users.iterator():
+            missing, extra = timeline.rebuild(user, options['dry_run'])
+            added += missing
+            removed += extra
+            count += 1
+        verb = 'Would add' if options['dry_run'] else 'Added'
+        self.stdout.write('{} {} and remove {} entries in {} timelines.'
+                          .format(verb, added, removed, count))
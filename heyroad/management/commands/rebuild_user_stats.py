@@ -0,0 +1,37 @@
+import os
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+
+from heyroad.db import process_pool
+from heyroad.stats import compute_user_stats, save_user_stats
+
+
+class Command(BaseCommand):
+    help = 'Recompute UserStats and StatsBucket rows from all routes.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                            help='processes aggregating users in parallel')
+        parser.add_argument('--users', nargs='+', type=int,
+                            help='only rebuild these user ids')
+
+    def handle(self, *args, **options):
+        user_ids = User.objects.values_list('pk', flat=True)
+        if options['users']:
+            user_ids = user_ids.filter(pk__in=options['users'])
+        user_ids = list(user_ids)
+
+        workers = max(1, options['workers'] or 1)
+        if workers == 1:
+            results = map(compute_user_stats, user_ids)
+            self._save(results)
+        else:
+            with process_pool(workers) as pool:
+                self._save(pool.map(compute_user_stats, user_ids,
+                                    chunksize=64))
+        self.stdout.write('Rebuilt stats of {} users.'.format(len(user_ids)))
+
+    def _save(self, results):
+        for user_id, totals, buckets in results:
+            save_user_stats(user_id, totals, buckets)
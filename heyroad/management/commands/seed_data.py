@@ -0,0 +1,147 @@
+import math
+import random
+from datetime import timedelta
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from heyroad import friends, processing
+from heyroad.ingest import write_route
+from heyroad.models import ChangeLog, Comment, Friendship
+
+
+def power_law_edges(count, degree, rng):
+    """
+    Friendships between `count` users by preferential attachment
+    (Barabasi-Albert): each new user befriends `degree` existing users,
+    picked with probability proportional to their number of friends.
+    """
+    edges = set()
+    # every endpoint of every edge, so a uniform pick is degree-weighted
+    endpoints = []
+    for new in range(degree, count):
+        chosen = set()
+        while len(chosen) < degree:
+            if endpoints:
+                chosen.add(rng.choice(endpoints))
+            else:
+                chosen.add(rng.randrange(new))
+        for other in chosen:
+            edges.add((other, new))
+            endpoints.extend((other, new))
+    return edges
+
+
+def make_track(points, rng):
+    """
+    A random ride around Warsaw: (points, times, elevations, km).
+    """
+    latitude = 52.2297 + rng.uniform(-0.2, 0.2)
+    longitude = 21.0122 + rng.uniform(-0.3, 0.3)
+    elevation = rng.uniform(80, 120)
+    heading = rng.uniform(0, 2 * math.pi)
+    track, times, elevations = [], [], []
+    distance = 0.0
+    for i in range(points):
+        heading += rng.gauss(0, 0.2)
+        # ~5-8 m between fixes taken every second
+        step = rng.uniform(5, 8)
+        distance += step
+        latitude += step * math.cos(heading) / 111320
+        longitude += step * math.sin(heading) / (
+            111320 * math.cos(math.radians(latitude)))
+        elevation += rng.gauss(0, 0.3)
+        track.append((latitude, longitude))
+        times.append(float(i))
+        elevations.append(elevation)
+    return track, times, elevations, distance / 1000
+
+
+class Command(BaseCommand):
+    help = 'Fill the database with a reproducible synthetic dataset.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=200)
+        parser.add_argument('--friends', type=int, default=3,
+                            help='friendships each new user makes; the '
+                                 'degrees follow a power law')
+        parser.add_argument('--routes', type=int, default=10,
+                            help='mean routes per user')
+        parser.add_argument('--points', type=int, default=500,
+                            help='mean points per route')
+        parser.add_argument('--comments', type=float, default=0.5,
+                            help='mean comments per route')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--prefix', default='seed',
+                            help='username prefix of generated users')
+        parser.add_argument('--password', default='seed-password',
+                            help='password of every generated user')
+        parser.add_argument('--clear', action='store_true',
+                            help='first delete users with the prefix')
+
+    def _count(self, rng, mean):
+        # exponentially distributed, a few heavy users and many light ones
+        return int(round(rng.expovariate(1 / mean))) if mean > 0 else 0
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        prefix = options['prefix']
+        if options['clear']:
+            deleted = User.objects.filter(
+                username__startswith=prefix + '-').delete()[0]
+            self.stdout.write('Deleted {} objects.'.format(deleted))
+
+        # hashing is slow on purpose, so every user shares one hash
+        password = make_password(options['password'])
+        User.objects.bulk_create([
+            User(username='{}-{}'.format(prefix, i), password=password,
+                 email='{}-{}@example.com'.format(prefix, i))
+            for i in range(options['users'])
+        ], batch_size=500)
+        users = list(User.objects.filter(
+            username__startswith=prefix + '-').order_by('pk'))
+
+        edges = power_law_edges(len(users), min(options['friends'],
+                                                len(users) - 1), rng)
+        Friendship.objects.bulk_create([
+            Friendship(user1=users[a], user2=users[b], is_accepted=True)
+            for a, b in sorted(edges)
+        ], batch_size=500)
+        # bulk_create sends no signals, log the friendships for delta sync
+        ChangeLog.objects.bulk_create([
+            ChangeLog(kind=ChangeLog.FRIENDSHIP, object_id=pk, owner=user1,
+                      other=user2)
+            for pk, user1, user2 in Friendship.objects.filter(
+                user1__username__startswith=prefix + '-'
+            ).values_list('pk', 'user1', 'user2')
+        ], batch_size=500)
+        friends.invalidate(*[user.pk for user in users])
+
+        now = timezone.now()
+        routes = comments = 0
+        for user in users:
+            visible = friends.visible_user_ids(user)
+            with transaction.atomic():
+                for _ in range(self._count(rng, options['routes'])):
+                    size = max(2, int(rng.gauss(options['points'],
+                                                options['points'] / 4)))
+                    points, times, elevations, km = make_track(size, rng)
+                    route = write_route(
+                        user, km, now - timedelta(days=rng.uniform(0, 365)),
+                        timedelta(seconds=size), points, times, elevations,
+                        storage='packed')
+                    processing.enqueue(route, points=points, times=times,
+                                       elevations=elevations)
+                    routes += 1
+                    for _ in range(self._count(rng, options['comments'])):
+                        Comment.objects.create(
+                            user_id=rng.choice(sorted(visible)), route=route,
+                            date=route.date + timedelta(hours=1),
+                            text='Nice ride!')
+                        comments += 1
+        self.stdout.write(
+            'Created {} users, {} friendships, {} routes and {} comments.'
+            .format(len(users), len(edges), routes, comments))
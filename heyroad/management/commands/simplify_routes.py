@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from heyroad.models import Route
+from heyroad.simplify import build_levels
+
+
+class Command(BaseCommand):
+    help = 'Build simplified track levels for existing routes.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true',
+                            help='rebuild routes that already have levels')
+
+    def handle(self, *args, **options):
+        routes = Route.objects.all()
+        if not options['all']:
+            routes = routes.filter(levels__isnull=True)
+        count = 0
+        for route in routes.iterator():
+            with transaction.atomic():
+                build_levels(route, route.get_points())
+            count += 1
+        self.stdout.write('Simplified {} routes.'.format(count))
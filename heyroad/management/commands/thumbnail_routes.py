@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+
+from heyroad.caching import touch_route
+from heyroad.models import Route
+from heyroad.thumbnails import render_thumbnail
+
+
+class Command(BaseCommand):
+    help = 'Render thumbnails for existing routes.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true',
+                            help='render routes that already have one')
+
+    def handle(self, *args, **options):
+        routes = Route.objects.all()
+        if not options['all']:
+            routes = routes.filter(thumbnail='')
+        count = 0
+        for route in routes.iterator():
+            render_thumbnail(route, route.get_points())
+            # a new URL for the PNG
+            touch_route(route.pk)
+            count += 1
+        self.stdout.write('Rendered {} thumbnails.'.format(count))
@@ -0,0 +1,135 @@
+"""
+Route metrics derived from the track itself.
+
+Everything is computed over whole NumPy arrays at once: segment lengths
+with the haversine formula, then moving time, speeds, per-km splits and
+elevation gain from the optional per-point times and elevations.
+"""
+import numpy as np
+
+from heyroad.geometry import pack_values, unpack_values
+from heyroad.models import RouteMetrics
+
+EARTH_RADIUS = 6371008.8
+# slower than this (m/s) between two fixes counts as standing still
+MOVING_SPEED = 0.5
+# fixes the max speed is averaged over, to smooth out GPS jitter
+SPEED_WINDOW = 5
+# points in the moving average applied to elevations before summing climbs
+ELEVATION_WINDOW = 5
+
+
+def segment_lengths(latitudes, longitudes):
+    """
+    Haversine distance in metres between consecutive points.
+    """
+    lat = np.radians(latitudes)
+    lng = np.radians(longitudes)
+    dlat = np.diff(lat)
+    dlng = np.diff(lng)
+    a = np.sin(dlat / 2) ** 2 \
+        + np.cos(lat[:-1]) * np.cos(lat[1:]) * np.sin(dlng / 2) ** 2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+def _max_speed(cumulative, times):
+    window = min(SPEED_WINDOW, len(times) - 1)
+    distance = cumulative[window:] - cumulative[:-window]
+    elapsed = times[window:] - times[:-window]
+    valid = elapsed > 0
+    if not valid.any():
+        return None
+    return float((distance[valid] / elapsed[valid]).max())
+
+
+def _splits(cumulative, times):
+    marks = np.arange(1000.0, cumulative[-1] + 1e-9, 1000.0)
+    if not len(marks):
+        return np.empty(0)
+    # cumulative distance never decreases, so np.interp can map it to time
+    at_marks = np.interp(marks, cumulative, times)
+    return np.diff(np.concatenate(([times[0]], at_marks)))
+
+
+def _elevation_gain(elevations):
+    if len(elevations) >= ELEVATION_WINDOW:
+        kernel = np.ones(ELEVATION_WINDOW) / ELEVATION_WINDOW
+        elevations = np.convolve(elevations, kernel, mode='valid')
+    climbs = np.diff(elevations)
+    return float(climbs[climbs > 0].sum())
+
+
+def compute_metrics(points, times=None, elevations=None):
+    """
+    Compute metrics of a track of (latitude, longitude) points.
+
+    `times` are seconds since the start of the route, `elevations` metres;
+    either may be None. Distances are returned in km, speeds in km/h and
+    splits as a NumPy array of seconds per full kilometre.
+    """
+    result = {
+        'distance': 0.0,
+        'elapsed_seconds': None,
+        'moving_seconds': None,
+        'average_speed': None,
+        'max_speed': None,
+        'elevation_gain': None,
+        'splits': None,
+    }
+    if elevations is not None and len(elevations) > 1:
+        result['elevation_gain'] = _elevation_gain(
+            np.asarray(elevations, dtype=np.float64))
+    if len(points) < 2:
+        return result
+
+    coords = np.asarray(points, dtype=np.float64)
+    lengths = segment_lengths(coords[:, 0], coords[:, 1])
+    cumulative = np.concatenate(([0.0], np.cumsum(lengths)))
+    result['distance'] = float(cumulative[-1]) / 1000
+
+    if times is not None:
+        times = np.asarray(times, dtype=np.float64)
+        durations = np.diff(times)
+        moving = (durations > 0) & (lengths >= MOVING_SPEED * durations)
+        moving_seconds = float(durations[moving].sum())
+        result['elapsed_seconds'] = float(times[-1] - times[0])
+        result['moving_seconds'] = moving_seconds
+        if moving_seconds > 0:
+            result['average_speed'] = \
+                float(lengths[moving].sum()) / moving_seconds * 3.6
+        max_speed = _max_speed(cumulative, times)
+        if max_speed is not None:
+            result['max_speed'] = max_speed * 3.6
+        result['splits'] = _splits(cumulative, times)
+    return result
+
+
+def store_metrics(route, points, times=None, elevations=None):
+    """
+    Compute and save the RouteMetrics of `route`.
+    """
+    values = compute_metrics(points, times, elevations)
+    splits = values.pop('splits')
+    if splits is not None:
+        splits = pack_values(splits.tolist())
+    metrics, _ = RouteMetrics.objects.update_or_create(
+        route=route, defaults=dict(values, splits=splits))
+    return metrics
+
+
+def route_series(route):
+    """
+    The per-point times (seconds) and elevations stored with `route`.
+    """
+    times = elevations = None
+    if route.times is not None:
+        times = np.frombuffer(route.times, dtype='<i4') / 1000.0
+    if route.elevations is not None:
+        elevations = np.frombuffer(route.elevations, dtype='<f4')
+    return times, elevations
+
+
+def split_list(metrics):
+    if metrics.splits is None:
+        return None
+    return list(unpack_values(metrics.splits))
@@ -0,0 +1,186 @@
+"""
+Middleware of the heyroad app.
+"""
+import time
+import zlib
+from contextlib import ExitStack
+from io import BytesIO
+
+from django.conf import settings
+from django.db import connections
+from django.http import JsonResponse
+from django.middleware.gzip import GZipMiddleware
+
+from heyroad import db, instrumentation
+
+API_PREFIX = '/api/'
+EVENT_STREAM = 'text/event-stream'
+# limit on the size of a decompressed request body
+DEFAULT_MAX_INFLATED_BODY = 64 * 1024 * 1024
+
+
+class BodyTooLarge(ValueError):
+    pass
+
+
+def gunzip(data, limit):
+    """
+    Decompress gzip `data`, refusing to produce more than `limit` bytes.
+    """
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    body = decompressor.decompress(data, limit + 1)
+    if len(body) > limit:
+        raise BodyTooLarge('decompressed body exceeds {} bytes'.format(limit))
+    if not decompressor.eof:
+        raise ValueError('truncated gzip body')
+    return body
+
+
+class GZipAPIMiddleware(GZipMiddleware):
+    """
+    Accept gzip compressed request bodies on the API and compress its
+    responses for clients that accept gzip. HTML pages are left alone,
+    they embed CSRF tokens.
+    """
+
+    def process_request(self, request):
+        if not request.path.startswith(API_PREFIX):
+            return None
+        encoding = request.META.get('HTTP_CONTENT_ENCODING', '')
+        if encoding.strip().lower() != 'gzip':
+            return None
+        limit = getattr(settings, 'HEYROAD_MAX_INFLATED_BODY',
+                        DEFAULT_MAX_INFLATED_BODY)
+        try:
+            body = gunzip(request.body, limit)
+        except BodyTooLarge as e:
+            return JsonResponse({'result': 'failed_body_too_large',
+                                 'detail': str(e)}, status=413)
+        except (ValueError, zlib.error) as e:
+            return JsonResponse({'result': 'failed_invalid_encoding',
+                                 'detail': str(e)}, status=400)
+        # parsers downstream read the plain body
+        request._body = body
+        request._stream = BytesIO(body)
+        request.META['CONTENT_LENGTH'] = str(len(body))
+        del request.META['HTTP_CONTENT_ENCODING']
+        return None
+
+    def process_response(self, request, response):
+        if not request.path.startswith(API_PREFIX):
+            return response
+        # compressed events would sit in the gzip buffer
+        if response.get('Content-Type', '').startswith(EVENT_STREAM):
+            return response
+        return super().process_response(request, response)
+
+
+def view_name(request):
+    """
+    'RouteViewSet.retrieve', 'RouteList', ... for the view that handled
+    `request`.
+    """
+    match = getattr(request, 'resolver_match', None)
+    if match is None:
+        return 'unresolved'
+    func = match.func
+    cls = getattr(func, 'cls', None) or getattr(func, 'view_class', None)
+    if cls is None:
+        return '{}.{}'.format(func.__module__, func.__name__)
+    name = cls.__name__
+    action = (getattr(func, 'actions', None) or {}).get(
+        request.method.lower())
+    if action:
+        name = '{}.{}'.format(name, action)
+    return name
+
+
+class _QueryTimer:
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            with instrumentation.phase(instrumentation.DB):
+                return execute(sql, params, many, context)
+        finally:
+            self.seconds += time.perf_counter() - start
+            self.count += 1
+
+
+class PerformanceMiddleware:
+    """
+    Time every request: SQL queries, serializers, rendering of API
+    responses and of templates, and the total. The numbers go to the
+    histograms of heyroad.instrumentation and, with HEYROAD_SERVER_TIMING,
+    into a Server-Timing response header.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        start = time.perf_counter()
+        queries = _QueryTimer()
+        phases = instrumentation.start_phases()
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(queries))
+                response = self.get_response(request)
+        finally:
+            instrumentation.stop_phases()
+        total = time.perf_counter() - start
+        serialize = phases.seconds[instrumentation.SERIALIZE]
+        render = phases.seconds[instrumentation.RENDER]
+        template = phases.seconds[instrumentation.TEMPLATE]
+
+        view = view_name(request)
+        instrumentation.requests_total.inc(
+            view=view, method=request.method, status=response.status_code)
+        instrumentation.request_seconds.observe(
+            total, view=view, method=request.method)
+        instrumentation.db_seconds.observe(queries.seconds, view=view)
+        instrumentation.db_queries.observe(queries.count, view=view)
+        instrumentation.serialize_seconds.observe(serialize, view=view)
+        instrumentation.render_seconds.observe(render, view=view)
+        instrumentation.template_seconds.observe(template, view=view)
+
+        if getattr(settings, 'HEYROAD_SERVER_TIMING', True):
+            app = max(total - queries.seconds - serialize - render
+                      - template, 0.0)
+            response['Server-Timing'] = ', '.join([
+                'db;dur={:.1f};desc="{} queries"'.format(
+                    queries.seconds * 1000, queries.count),
+                'serialize;dur={:.1f}'.format(serialize * 1000),
+                'render;dur={:.1f}'.format(render * 1000),
+                'template;dur={:.1f}'.format(template * 1000),
+                'app;dur={:.1f}'.format(app * 1000),
+                'total;dur={:.1f}'.format(total * 1000),
+            ])
+        return response
+
+    def process_template_response(self, request, response):
+        # render here to time it; Django skips rendering it again
+        with instrumentation.phase(instrumentation.RENDER):
+            response.render()
+        return response
+
+
+class ReadReplicaMiddleware:
+    """
+    Serve the reads of GET, HEAD and OPTIONS requests from the read
+    replicas, see heyroad.db.ReadReplicaRouter.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if request.method not in db.READ_METHODS:
+            return self.get_response(request)
+        with db.reading():
+            return self.get_response(request)
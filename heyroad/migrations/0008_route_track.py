@@ -0,0 +1,22 @@
+# Generated by Django 2.2.28 on 2026-10-18 12:04
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('heyroad', '0007_comment'),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='comment',
+            options={'ordering': ['date']},
+        ),
+        migrations.AddField(
+            model_name='route',
+            name='track',
+            field=models.BinaryField(null=True),
+        ),
+    ]
@@ -0,0 +1,44 @@
+from django.conf import settings
+from django.db import migrations
+
+from heyroad.geometry import pack_points, unpack_points
+
+BATCH_SIZE = 2000
+
+
+def pack_coords(apps, schema_editor):
+    # routes stay in LatLng rows unless packed storage is configured
+    if getattr(settings, 'HEYROAD_ROUTE_STORAGE', 'rows') != 'packed':
+        return
+    Route = apps.get_model('heyroad', 'Route')
+    LatLng = apps.get_model('heyroad', 'LatLng')
+    routes = Route.objects.filter(track__isnull=True).only('id')
+    for route in routes.iterator():
+        points = LatLng.objects.filter(route=route).order_by('id') \
+                               .values_list('latitude', 'longitude')
+        Route.objects.filter(pk=route.pk).update(track=pack_points(points))
+        LatLng.objects.filter(route=route).delete()
+
+
+def unpack_coords(apps, schema_editor):
+    Route = apps.get_model('heyroad', 'Route')
+    LatLng = apps.get_model('heyroad', 'LatLng')
+    routes = Route.objects.filter(track__isnull=False)
+    for route in routes.iterator():
+        LatLng.objects.bulk_create(
+            [LatLng(route=route, latitude=latitude, longitude=longitude)
+             for latitude, longitude in unpack_points(route.track)],
+            batch_size=BATCH_SIZE
+        )
+        Route.objects.filter(pk=route.pk).update(track=None)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('heyroad', '0008_route_track'),
+    ]
+
+    operations = [
+        migrations.RunPython(pack_coords, unpack_coords),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 2.2.28 on 2026-10-18 12:05
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('heyroad', '0009_pack_route_coords'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TrackLevel',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('tolerance', models.FloatField()),
+                ('track', models.BinaryField()),
+                ('route', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='levels', to='heyroad.Route')),
+            ],
+            options={
+                'unique_together': {('route', 'tolerance')},
+            },
+        ),
+    ]
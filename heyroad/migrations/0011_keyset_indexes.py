@@ -0,0 +1,21 @@
+# Generated by Django 2.2.28 on 2026-10-18 12:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('heyroad', '0010_tracklevel'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='comment',
+            index=models.Index(fields=['date', 'id'], name='heyroad_com_date_cb7990_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='route',
+            index=models.Index(fields=['date', 'id'], name='heyroad_rou_date_c6be65_idx'),
+        ),
+    ]
@@ -0,0 +1,43 @@
+# Generated by Django 2.2.28 on 2026-10-18 12:08
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('heyroad', '0011_keyset_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserStats',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('route_count', models.IntegerField(default=0)),
+                ('total_distance', models.FloatField(default=0)),
+                ('duration_seconds', models.FloatField(default=0)),
+                ('longest_distance', models.FloatField(default=0)),
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='stats', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='StatsBucket',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('period', models.CharField(choices=[('week', 'Week'), ('month', 'Month')], max_length=5)),
+                ('start', models.DateField()),
+                ('route_count', models.IntegerField(default=0)),
+                ('distance', models.FloatField(default=0)),
+                ('duration_seconds', models.FloatField(default=0)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='stats_buckets', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ['-start'],
+                'unique_together': {('user', 'period', 'start')},
+            },
+        ),
+    ]
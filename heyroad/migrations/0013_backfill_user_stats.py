@@ -0,0 +1,63 @@
+from collections import defaultdict
+from datetime import timedelta
+
+from django.db import migrations
+from django.utils import timezone
+
+
+def period_starts(date):
+    day = timezone.localtime(date).date()
+    return [('week', day - timedelta(days=day.weekday())),
+            ('month', day.replace(day=1))]
+
+
+def backfill(apps, schema_editor):
+    Route = apps.get_model('heyroad', 'Route')
+    UserStats = apps.get_model('heyroad', 'UserStats')
+    StatsBucket = apps.get_model('heyroad', 'StatsBucket')
+
+    totals = defaultdict(lambda: [0, 0.0, 0.0, 0.0])
+    buckets = defaultdict(lambda: [0, 0.0, 0.0])
+    routes = Route.objects.values_list('user_id', 'date', 'distance',
+                                       'duration')
+    for user_id, date, distance, duration in routes.iterator():
+        seconds = duration.total_seconds()
+        total = totals[user_id]
+        total[0] += 1
+        total[1] += distance
+        total[2] += seconds
+        total[3] = max(total[3], distance)
+        for period, start in period_starts(date):
+            bucket = buckets[(user_id, period, start)]
+            bucket[0] += 1
+            bucket[1] += distance
+            bucket[2] += seconds
+
+    UserStats.objects.bulk_create([
+        UserStats(user_id=user_id, route_count=count, total_distance=distance,
+                  duration_seconds=seconds, longest_distance=longest)
+        for user_id, (count, distance, seconds, longest) in totals.items()
+    ], batch_size=500)
+    StatsBucket.objects.bulk_create([
+        StatsBucket(user_id=user_id, period=period, start=start,
+                    route_count=count, distance=distance,
+                    duration_seconds=seconds)
+        for (user_id, period, start), (count, distance, seconds)
+        in buckets.items()
+    ], batch_size=500)
+
+
+def clear(apps, schema_editor):
+    apps.get_model('heyroad', 'UserStats').objects.all().delete()
+    apps.get_model('heyroad', 'StatsBucket').objects.all().delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('heyroad', '0012_user_stats'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill, clear),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 2.2.28 on 2026-10-18 12:10
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('heyroad', '0013_backfill_user_stats'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RouteMetrics',
+            fields=[
+                ('route', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='metrics', serialize=False, to='heyroad.Route')),
+                ('distance', models.FloatField()),
+                ('elapsed_seconds', models.FloatField(null=True)),
+                ('moving_seconds', models.FloatField(null=True)),
+                ('average_speed', models.FloatField(null=True)),
+                ('max_speed', models.FloatField(null=True)),
+                ('elevation_gain', models.FloatField(null=True)),
+                ('splits', models.BinaryField(null=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='route',
+            name='elevations',
+            field=models.BinaryField(null=True),
+        ),
+        migrations.AddField(
+            model_name='route',
+            name='times',
+            field=models.BinaryField(null=True),
+        ),
+    ]
@@ -0,0 +1,50 @@
+# Generated by Django 2.2.28 on 2026-10-18 12:12
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('heyroad', '0014_route_metrics'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='route',
+            name='max_latitude',
+            field=models.FloatField(null=True),
+        ),
+        migrations.AddField(
+            model_name='route',
+            name='max_longitude',
+            field=models.FloatField(null=True),
+        ),
+        migrations.AddField(
+            model_name='route',
+            name='min_latitude',
+            field=models.FloatField(null=True),
+        ),
+        migrations.AddField(
+            model_name='route',
+            name='min_longitude',
+            field=models.FloatField(null=True),
+        ),
+        migrations.CreateModel(
+            name='RouteCell',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('cell', models.BigIntegerField()),
+                ('route', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='cells', to='heyroad.Route')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='routecell',
+            index=models.Index(fields=['cell', 'route'], name='heyroad_rou_cell_a7f2b3_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='routecell',
+            unique_together={('route', 'cell')},
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 2.2.28 on 2026-10-18 12:13
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('heyroad', '0015_spatial_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RouteJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('running', 'Running'), ('done', 'Done'), ('failed', 'Failed')], default='pending', max_length=8)),
+                ('attempts', models.IntegerField(default=0)),
+                ('run_after', models.DateTimeField(default=django.utils.timezone.now)),
+                ('locked_until', models.DateTimeField(null=True)),
+                ('error', models.TextField(blank=True)),
+                ('updated', models.DateTimeField(auto_now=True)),
+                ('route', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='job', to='heyroad.Route')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='routejob',
+            index=models.Index(fields=['status', 'run_after'], name='heyroad_rou_status_f86442_idx'),
+        ),
+    ]
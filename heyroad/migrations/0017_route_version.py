@@ -0,0 +1,24 @@
+# Generated by Django 2.2.28 on 2026-10-18 12:16
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('heyroad', '0016_route_job'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='route',
+            name='updated',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AddField(
+            model_name='route',
+            name='version',
+            field=models.PositiveIntegerField(default=1),
+        ),
+    ]
@@ -0,0 +1,44 @@
+# Generated by Django 2.2.28 on 2026-10-18 12:35
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('heyroad', '0019_upload_key'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LiveRoute',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('started', models.DateTimeField(default=django.utils.timezone.now)),
+                ('updated', models.DateTimeField(default=django.utils.timezone.now)),
+                ('seq', models.PositiveIntegerField(default=0)),
+                ('finished', models.DateTimeField(null=True)),
+                ('route', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='heyroad.Route')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='live_routes', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='LiveChunk',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('seq', models.PositiveIntegerField()),
+                ('track', models.BinaryField()),
+                ('times', models.BinaryField(null=True)),
+                ('elevations', models.BinaryField(null=True)),
+                ('live', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='chunks', to='heyroad.LiveRoute')),
+            ],
+            options={
+                'ordering': ['seq'],
+                'unique_together': {('live', 'seq')},
+            },
+        ),
+    ]
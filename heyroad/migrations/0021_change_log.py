@@ -0,0 +1,34 @@
+# Generated by Django 2.2.28 on 2026-10-18 12:38
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('heyroad', '0020_live_route'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChangeLog',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('route', 'Route'), ('comment', 'Comment'), ('friendship', 'Friendship')], max_length=10)),
+                ('object_id', models.IntegerField()),
+                ('deleted', models.BooleanField(default=False)),
+                ('owner', models.IntegerField()),
+                ('other', models.IntegerField(null=True)),
+                ('date', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='changelog',
+            index=models.Index(fields=['owner', 'id'], name='heyroad_cha_owner_759ee5_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='changelog',
+            index=models.Index(fields=['other', 'id'], name='heyroad_cha_other_8d6621_idx'),
+        ),
+    ]
@@ -0,0 +1,39 @@
+from django.db import migrations
+
+
+def backfill(apps, schema_editor):
+    Route = apps.get_model('heyroad', 'Route')
+    Comment = apps.get_model('heyroad', 'Comment')
+    Friendship = apps.get_model('heyroad', 'Friendship')
+    ChangeLog = apps.get_model('heyroad', 'ChangeLog')
+
+    # friendships first, then routes and comments oldest first, as if
+    # all were created after the change log
+    friendships = Friendship.objects.order_by('pk') \
+                                    .values_list('pk', 'user1', 'user2')
+    routes = Route.objects.order_by('date', 'pk').values_list('pk', 'user')
+    comments = Comment.objects.order_by('date', 'pk') \
+                              .values_list('pk', 'route__user')
+    entries = [ChangeLog(kind='friendship', object_id=pk, owner=user1,
+                         other=user2)
+               for pk, user1, user2 in friendships.iterator()]
+    entries.extend(ChangeLog(kind='route', object_id=pk, owner=user)
+                   for pk, user in routes.iterator())
+    entries.extend(ChangeLog(kind='comment', object_id=pk, owner=owner)
+                   for pk, owner in comments.iterator())
+    ChangeLog.objects.bulk_create(entries, batch_size=500)
+
+
+def clear(apps, schema_editor):
+    apps.get_model('heyroad', 'ChangeLog').objects.all().delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('heyroad', '0021_change_log'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill, clear),
+    ]
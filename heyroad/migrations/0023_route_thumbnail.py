@@ -0,0 +1,23 @@
+# Generated by Django 2.2.28 on 2026-10-18 12:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('heyroad', '0022_backfill_change_log'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='route',
+            name='thumbnail',
+            field=models.TextField(blank=True, default=''),
+        ),
+        migrations.AddField(
+            model_name='route',
+            name='thumbnail_png',
+            field=models.BinaryField(null=True),
+        ),
+    ]
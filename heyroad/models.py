@@ -3,27 +3,132 @@ from django.db import models
 from django.utils import timezone
 from django.contrib.auth.models import User
 
+from heyroad.geometry import unpack_points
+
 class Route(models.Model):
     user = models.ForeignKey('auth.User', related_name='routes',
                              on_delete=models.CASCADE)
     distance = models.FloatField()
     date = models.DateTimeField(default=timezone.now)
     duration = models.DurationField(default=timedelta(minutes=20))
+    # packed coordinates, see heyroad.geometry; NULL when the track is
+    # stored as LatLng rows
+    track = models.BinaryField(null=True)
+    # optional per-point data: int32 milliseconds since `date` and float32
+    # metres, packed like `track`
+    times = models.BinaryField(null=True)
+    elevations = models.BinaryField(null=True)
+    # bounding box of the track, see heyroad.spatial
+    min_latitude = models.FloatField(null=True)
+    max_latitude = models.FloatField(null=True)
+    min_longitude = models.FloatField(null=True)
+    max_longitude = models.FloatField(null=True)
+    # bumped whenever the API representation changes (comments,
+    # processing), see heyroad.caching
+    version = models.PositiveIntegerField(default=1)
+    updated = models.DateTimeField(default=timezone.now)
+    # SVG markup and optional PNG of the track, see heyroad.thumbnails
+    thumbnail = models.TextField(blank=True, default='')
+    thumbnail_png = models.BinaryField(null=True)
 
     class Meta:
         ordering = ["-date"]
+        indexes = [
+            models.Index(fields=['date', 'id']),
+        ]
 
     def __str__(self):
         return "{}_{}_{}".format(self.user,
                                  self.distance,
                                  self.duration)
 
+    def get_points(self):
+        """
+        Return the track as a list of (latitude, longitude) tuples,
+        whichever storage it uses.
+        """
+        if self.track is not None:
+            return unpack_points(self.track)
+        return list(self.coords.order_by('id')
+                               .values_list('latitude', 'longitude'))
+
 class LatLng(models.Model):
     route = models.ForeignKey('Route', related_name='coords',
                               on_delete=models.CASCADE)
     latitude = models.FloatField()
     longitude = models.FloatField()
 
+class RouteJob(models.Model):
+    """
+    Post-upload processing of a route, run by heyroad.processing workers.
+    """
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = [(PENDING, 'Pending'), (RUNNING, 'Running'),
+                      (DONE, 'Done'), (FAILED, 'Failed')]
+
+    route = models.OneToOneField('Route', related_name='job',
+                                 on_delete=models.CASCADE)
+    status = models.CharField(max_length=8, choices=STATUS_CHOICES,
+                              default=PENDING)
+    attempts = models.IntegerField(default=0)
+    run_after = models.DateTimeField(default=timezone.now)
+    # a running job whose lease expired is picked up again
+    locked_until = models.DateTimeField(null=True)
+    error = models.TextField(blank=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'run_after']),
+        ]
+
+class RouteMetrics(models.Model):
+    """
+    Figures derived from a route's track by heyroad.metrics.
+    """
+    route = models.OneToOneField('Route', related_name='metrics',
+                                 primary_key=True, on_delete=models.CASCADE)
+    # kilometres
+    distance = models.FloatField()
+    # the rest needs per-point times or elevations and is NULL without them
+    elapsed_seconds = models.FloatField(null=True)
+    moving_seconds = models.FloatField(null=True)
+    # km/h, average over moving time
+    average_speed = models.FloatField(null=True)
+    max_speed = models.FloatField(null=True)
+    # metres
+    elevation_gain = models.FloatField(null=True)
+    # float32 seconds taken by each full kilometre
+    splits = models.BinaryField(null=True)
+
+class RouteCell(models.Model):
+    """
+    A grid cell the route passes through, see heyroad.spatial.
+    """
+    route = models.ForeignKey('Route', related_name='cells',
+                              on_delete=models.CASCADE)
+    cell = models.BigIntegerField()
+
+    class Meta:
+        unique_together = [['route', 'cell']]
+        # covers cell range lookups without touching the table
+        indexes = [
+            models.Index(fields=['cell', 'route']),
+        ]
+
+class TrackLevel(models.Model):
+    route = models.ForeignKey('Route', related_name='levels',
+                              on_delete=models.CASCADE)
+    # maximum deviation from the full track, in metres
+    tolerance = models.FloatField()
+    track = models.BinaryField()
+
+    class Meta:
+        unique_together = [['route', 'tolerance']]
+
 class Friendship(models.Model):
     user1 = models.ForeignKey('auth.User', related_name='user_1',
                               on_delete=models.CASCADE)
@@ -40,4 +145,149 @@ class Comment(models.Model):
     text = models.TextField(max_length=512)
 
     class Meta:
-        ordering = ["date"]
\ No newline at end of file
+        ordering = ["date"]
+        indexes = [
+            models.Index(fields=['date', 'id']),
+        ]
+
+class UserStats(models.Model):
+    """
+    Running totals of a user's routes, maintained by heyroad.stats.
+    """
+    user = models.OneToOneField('auth.User', related_name='stats',
+                                on_delete=models.CASCADE)
+    route_count = models.IntegerField(default=0)
+    total_distance = models.FloatField(default=0)
+    # SQLite cannot add durations in an UPDATE, so seconds are kept instead
+    duration_seconds = models.FloatField(default=0)
+    longest_distance = models.FloatField(default=0)
+
+    @property
+    def total_duration(self):
+        return timedelta(seconds=self.duration_seconds)
+
+class StatsBucket(models.Model):
+    """
+    Per-user totals of the routes started within one week or month.
+    """
+    WEEK = 'week'
+    MONTH = 'month'
+    PERIOD_CHOICES = [(WEEK, 'Week'), (MONTH, 'Month')]
+
+    user = models.ForeignKey('auth.User', related_name='stats_buckets',
+                             on_delete=models.CASCADE)
+    period = models.CharField(max_length=5, choices=PERIOD_CHOICES)
+    start = models.DateField()
+    route_count = models.IntegerField(default=0)
+    distance = models.FloatField(default=0)
+    duration_seconds = models.FloatField(default=0)
+
+    class Meta:
+        unique_together = [['user', 'period', 'start']]
+        ordering = ['-start']
+
+    @property
+    def duration(self):
+        return timedelta(seconds=self.duration_seconds)
+
+class TimelineEntry(models.Model):
+    """
+    An item of a user's home feed, written when the user or a friend
+    uploads a route or comments, see heyroad.timeline.
+    """
+    ROUTE = 'route'
+    COMMENT = 'comment'
+    KIND_CHOICES = [(ROUTE, 'Route'), (COMMENT, 'Comment')]
+
+    owner = models.ForeignKey('auth.User', related_name='timeline',
+                              on_delete=models.CASCADE)
+    kind = models.CharField(max_length=7, choices=KIND_CHOICES)
+    # id of the route or comment, unique per owner and kind
+    object_id = models.IntegerField()
+    actor = models.ForeignKey('auth.User', related_name='+',
+                              on_delete=models.CASCADE)
+    route = models.ForeignKey('Route', related_name='+',
+                              on_delete=models.CASCADE)
+    comment = models.ForeignKey('Comment', related_name='+', null=True,
+                                on_delete=models.CASCADE)
+    date = models.DateTimeField()
+
+    class Meta:
+        ordering = ['-date', '-id']
+        unique_together = [('owner', 'kind', 'object_id')]
+        indexes = [
+            models.Index(fields=['owner', 'date', 'id']),
+        ]
+
+class UploadKey(models.Model):
+    """
+    A client-chosen idempotency key of an uploaded route, so that a
+    retried batch upload does not store the route again.
+    """
+    user = models.ForeignKey('auth.User', related_name='upload_keys',
+                             on_delete=models.CASCADE)
+    key = models.CharField(max_length=64)
+    # kept when the route is deleted, a late retry must not bring it back
+    route = models.ForeignKey('Route', related_name='+', null=True,
+                              on_delete=models.SET_NULL)
+    created = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        unique_together = [('user', 'key')]
+
+class LiveRoute(models.Model):
+    """
+    A ride in progress: points are appended in chunks while riding and
+    finishing it stores a Route, see heyroad.live.
+    """
+    user = models.ForeignKey('auth.User', related_name='live_routes',
+                             on_delete=models.CASCADE)
+    started = models.DateTimeField(default=timezone.now)
+    updated = models.DateTimeField(default=timezone.now)
+    # number of chunks appended so far
+    seq = models.PositiveIntegerField(default=0)
+    finished = models.DateTimeField(null=True)
+    route = models.ForeignKey('Route', related_name='+', null=True,
+                              on_delete=models.SET_NULL)
+
+class LiveChunk(models.Model):
+    live = models.ForeignKey('LiveRoute', related_name='chunks',
+                             on_delete=models.CASCADE)
+    # 1, 2, ... in the order the chunks were appended
+    seq = models.PositiveIntegerField()
+    # packed like Route.track, times in milliseconds since `live.started`
+    track = models.BinaryField()
+    times = models.BinaryField(null=True)
+    elevations = models.BinaryField(null=True)
+
+    class Meta:
+        ordering = ['seq']
+        unique_together = [('live', 'seq')]
+
+class ChangeLog(models.Model):
+    """
+    Append-only log of created, changed and deleted routes, comments and
+    friendships. Its ids are the sequence numbers of delta sync, see
+    heyroad.changes.
+    """
+    ROUTE = 'route'
+    COMMENT = 'comment'
+    FRIENDSHIP = 'friendship'
+    KIND_CHOICES = [(ROUTE, 'Route'), (COMMENT, 'Comment'),
+                    (FRIENDSHIP, 'Friendship')]
+
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES)
+    object_id = models.IntegerField()
+    # a tombstone
+    deleted = models.BooleanField(default=False)
+    # whose friends see the change: the owner of the route (commented),
+    # or the users of the friendship. Plain ids, tombstones outlive users
+    owner = models.IntegerField()
+    other = models.IntegerField(null=True)
+    date = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['owner', 'id']),
+            models.Index(fields=['other', 'id']),
+        ]
@@ -0,0 +1,140 @@
+"""
+Keyset (cursor) pagination.
+
+Pages are selected with a WHERE clause on the ordering columns of the last
+row seen instead of OFFSET, so a deep page costs the same as the first
+one. Cursors are opaque url-safe strings encoding those column values.
+"""
+import base64
+import binascii
+import json
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+from rest_framework import pagination
+from rest_framework.exceptions import NotFound
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+class Page:
+
+    def __init__(self, items, next_cursor):
+        self.items = items
+        self.next_cursor = next_cursor
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+
+class Keyset:
+    """
+    Paginates querysets by `ordering`, a sequence of field names with an
+    optional '-' prefix. The last field must be unique (usually 'id').
+    """
+
+    def __init__(self, *ordering):
+        self.ordering = ordering
+        self.fields = [name.lstrip('-') for name in ordering]
+
+    def encode_cursor(self, obj):
+        values = []
+        for name in self.fields:
+            value = getattr(obj, name)
+            if hasattr(value, 'isoformat'):
+                value = value.isoformat()
+            values.append(value)
+        data = json.dumps(values, separators=(',', ':')).encode('ascii')
+        return base64.urlsafe_b64encode(data).decode('ascii').rstrip('=')
+
+    def decode_cursor(self, model, cursor):
+        try:
+            data = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+            values = json.loads(data.decode('ascii'))
+        except (binascii.Error, UnicodeDecodeError, ValueError):
+            raise InvalidCursor('invalid cursor')
+        if not isinstance(values, list) or len(values) != len(self.fields):
+            raise InvalidCursor('invalid cursor')
+        try:
+            return [model._meta.get_field(name).to_python(value)
+                    for name, value in zip(self.fields, values)]
+        except ValidationError:
+            raise InvalidCursor('invalid cursor')
+
+    def after(self, values):
+        """
+        Q object selecting rows that sort after the given ordering values.
+        """
+        query = Q()
+        for i, name in enumerate(self.ordering):
+            field = self.fields[i]
+            lookup = '__lt' if name.startswith('-') else '__gt'
+            condition = Q(**{field + lookup: values[i]})
+            for j in range(i):
+                condition &= Q(**{self.fields[j]: values[j]})
+            query |= condition
+        return query
+
+    def paginate(self, queryset, cursor=None, page_size=DEFAULT_PAGE_SIZE):
+        queryset = queryset.order_by(*self.ordering)
+        if cursor:
+            values = self.decode_cursor(queryset.model, cursor)
+            queryset = queryset.filter(self.after(values))
+        items = list(queryset[:page_size + 1])
+        next_cursor = None
+        if len(items) > page_size:
+            items = items[:page_size]
+            next_cursor = self.encode_cursor(items[-1])
+        return Page(items, next_cursor)
+
+
+def page_size_from(params):
+    default = getattr(settings, 'HEYROAD_PAGE_SIZE', DEFAULT_PAGE_SIZE)
+    try:
+        page_size = int(params.get('page_size', default))
+    except (TypeError, ValueError):
+        page_size = default
+    return max(1, min(page_size, MAX_PAGE_SIZE))
+
+
+class KeysetPagination(pagination.BasePagination):
+    """
+    DRF paginator returning {'next': <url or null>, 'results': [...]}.
+    """
+    cursor_query_param = 'cursor'
+
+    def __init__(self, *ordering):
+        self.keyset = Keyset(*ordering)
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        try:
+            self.page = self.keyset.paginate(
+                queryset,
+                request.query_params.get(self.cursor_query_param),
+                page_size_from(request.query_params)
+            )
+        except InvalidCursor as e:
+            raise NotFound(str(e))
+        return self.page.items
+
+    def get_next_link(self):
+        if self.page.next_cursor is None:
+            return None
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.cursor_query_param,
+                                   self.page.next_cursor)
+
+    def get_paginated_response(self, data):
+        return Response({'next': self.get_next_link(), 'results': data})
@@ -0,0 +1,26 @@
+"""
+Extra parsers for the REST API.
+"""
+import msgpack
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import BaseParser, JSONParser
+
+
+class PolylineJSONParser(JSONParser):
+    """
+    Route uploads whose coords are a Google encoded polyline, see
+    heyroad.ingest.parse_route_payload.
+    """
+    media_type = 'application/vnd.heyroad.polyline+json'
+
+
+class MessagePackParser(BaseParser):
+    media_type = 'application/msgpack'
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        if stream is None:
+            return None
+        try:
+            return msgpack.unpackb(stream.read(), raw=False)
+        except (ValueError, msgpack.UnpackException) as e:
+            raise ParseError('MessagePack parse error - {}'.format(e))
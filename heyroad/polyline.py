@@ -0,0 +1,71 @@
+"""
+Google encoded polyline format.
+
+Coordinates are rounded to `precision` decimal places (5 in Google's
+format, about 1 m), delta encoded and written as printable ASCII, a few
+bytes per point.
+"""
+from django.conf import settings
+
+DEFAULT_PRECISION = 5
+
+
+def default_precision():
+    return getattr(settings, 'HEYROAD_POLYLINE_PRECISION', DEFAULT_PRECISION)
+
+
+def _encode_value(value, chunks):
+    value = ~(value << 1) if value < 0 else value << 1
+    while value >= 0x20:
+        chunks.append(chr((0x20 | (value & 0x1f)) + 63))
+        value >>= 5
+    chunks.append(chr(value + 63))
+
+
+def encode(points, precision=None):
+    """
+    Encode a sequence of (latitude, longitude) pairs.
+    """
+    if precision is None:
+        precision = default_precision()
+    factor = 10 ** precision
+    chunks = []
+    last_latitude = last_longitude = 0
+    for latitude, longitude in points:
+        latitude = int(round(latitude * factor))
+        longitude = int(round(longitude * factor))
+        _encode_value(latitude - last_latitude, chunks)
+        _encode_value(longitude - last_longitude, chunks)
+        last_latitude, last_longitude = latitude, longitude
+    return ''.join(chunks)
+
+
+def decode(value, precision=None):
+    """
+    Decode a polyline into a list of (latitude, longitude) tuples. Raises
+    ValueError on malformed input.
+    """
+    if precision is None:
+        precision = default_precision()
+    factor = 10 ** precision
+    points = []
+    coordinates = [0, 0]
+    index, length = 0, len(value)
+    while index < length:
+        for axis in (0, 1):
+            result = shift = 0
+            while True:
+                if index >= length:
+                    raise ValueError('truncated polyline')
+                byte = ord(value[index]) - 63
+                index += 1
+                if not 0 <= byte < 64:
+                    raise ValueError('invalid polyline character')
+                result |= (byte & 0x1f) << shift
+                shift += 5
+                if byte < 0x20:
+                    break
+            coordinates[axis] += ~(result >> 1) if result & 1 \
+                else result >> 1
+        points.append((coordinates[0] / factor, coordinates[1] / factor))
+    return points
@@ -0,0 +1,175 @@
+"""
+Background processing of uploaded routes.
+
+An upload only stores the route and a pending RouteJob. Workers started
+with `manage.py process_routes` claim jobs from the database and run the
+processing steps (simplified levels, spatial index, metrics,
+thumbnails). Claims are atomic UPDATEs, so any number of worker threads
+or processes can share the queue without a broker.
+"""
+import logging
+import traceback
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from heyroad.caching import touch_route
+from heyroad.metrics import route_series, store_metrics
+from heyroad.models import RouteJob
+from heyroad.simplify import build_levels
+from heyroad.spatial import index_route
+from heyroad.thumbnails import render_thumbnail
+
+logger = logging.getLogger(__name__)
+
+MAX_ATTEMPTS = 5
+# seconds before the first retry, doubled on every further attempt
+RETRY_DELAY = 30
+# seconds a worker may hold a job before it is considered crashed
+LEASE = 10 * 60
+
+
+def _levels(route, points, times, elevations):
+    build_levels(route, points)
+
+
+def _index(route, points, times, elevations):
+    index_route(route, points)
+
+
+def _metrics(route, points, times, elevations):
+    store_metrics(route, points, times, elevations)
+
+
+def _thumbnail(route, points, times, elevations):
+    render_thumbnail(route, points)
+
+
+STEPS = [_levels, _index, _metrics, _thumbnail]
+
+
+def process_inline():
+    return getattr(settings, 'HEYROAD_PROCESS_ROUTES_INLINE', False)
+
+
+def process_route(route, points=None, times=None, elevations=None):
+    """
+    Run every processing step on `route`. The track and per-point series
+    are loaded from the route unless given.
+    """
+    if points is None:
+        points = route.get_points()
+        times, elevations = route_series(route)
+    with transaction.atomic():
+        for step in STEPS:
+            step(route, points, times, elevations)
+
+
+def enqueue(route, **track):
+    """
+    Schedule `route` for processing. With HEYROAD_PROCESS_ROUTES_INLINE
+    the steps run right away; `track` may then pass the already parsed
+    points, times and elevations.
+    """
+    if process_inline():
+        process_route(route, **track)
+        defaults = {'status': RouteJob.DONE, 'error': ''}
+    else:
+        defaults = {'status': RouteJob.PENDING, 'attempts': 0,
+                    'run_after': timezone.now(), 'error': ''}
+    job, created = RouteJob.objects.update_or_create(route=route,
+                                                     defaults=defaults)
+    if not created:
+        touch_route(route.pk)
+    route.job = job
+    return job
+
+
+def _fail_lost_jobs(now):
+    # jobs whose worker died on every attempt would be reclaimed forever
+    lost = RouteJob.objects.filter(status=RouteJob.RUNNING,
+                                   locked_until__lt=now,
+                                   attempts__gte=MAX_ATTEMPTS)
+    for job_id, route_id in lost.values_list('id', 'route'):
+        failed = lost.filter(pk=job_id).update(
+            status=RouteJob.FAILED, locked_until=None, updated=now,
+            error='The worker was lost on every attempt.')
+        if failed:
+            logger.error('Processing route %s failed, workers lost',
+                         route_id)
+            touch_route(route_id)
+
+
+def claim_job():
+    """
+    Atomically take the next runnable job, or return None.
+    """
+    now = timezone.now()
+    _fail_lost_jobs(now)
+    expired = Q(status=RouteJob.RUNNING, locked_until__lt=now,
+                attempts__lt=MAX_ATTEMPTS)
+    runnable = RouteJob.objects.filter(
+        Q(status=RouteJob.PENDING, run_after__lte=now) | expired
+    ).order_by('run_after', 'id')
+    for job_id, status in runnable.values_list('id', 'status')[:10]:
+        claimed = RouteJob.objects.filter(pk=job_id, status=status).filter(
+            Q(status=RouteJob.PENDING) | expired
+        ).update(status=RouteJob.RUNNING,
+                 attempts=F('attempts') + 1,
+                 locked_until=now + timedelta(seconds=LEASE))
+        if claimed:
+            # gone if its route was deleted since the update
+            job = RouteJob.objects.select_related('route') \
+                                  .filter(pk=job_id).first()
+            if job is None:
+                continue
+            touch_route(job.route_id)
+            return job
+    return None
+
+
+def run_job(job):
+    """
+    Process a claimed job and record the outcome, scheduling a retry with
+    exponential backoff on failure.
+    """
+    try:
+        process_route(job.route)
+    except Exception:
+        logger.exception('Processing route %s failed', job.route_id)
+        job.error = traceback.format_exc()
+        if job.attempts >= MAX_ATTEMPTS:
+            job.status = RouteJob.FAILED
+        else:
+            job.status = RouteJob.PENDING
+            job.run_after = timezone.now() + timedelta(
+                seconds=RETRY_DELAY * 2 ** (job.attempts - 1))
+    else:
+        job.status = RouteJob.DONE
+        job.error = ''
+    job.locked_until = None
+    # an update, not save(): the job is gone if the route was deleted
+    # meanwhile, and that must not stop the worker
+    RouteJob.objects.filter(pk=job.pk).update(
+        status=job.status, error=job.error, run_after=job.run_after,
+        locked_until=None, updated=timezone.now())
+    touch_route(job.route_id)
+    return job
+
+
+def run_pending(limit=None):
+    """
+    Run runnable jobs in this thread until there are none left (or
+    `limit` were run). Returns the number of jobs run.
+    """
+    count = 0
+    while limit is None or count < limit:
+        job = claim_job()
+        if job is None:
+            break
+        run_job(job)
+        count += 1
+    return count
@@ -0,0 +1,45 @@
+"""
+Extra renderers for the REST API.
+"""
+import msgpack
+from rest_framework.renderers import BaseRenderer, JSONRenderer
+from rest_framework.utils.encoders import JSONEncoder
+
+
+class PolylineJSONRenderer(JSONRenderer):
+    """
+    JSON in which route coordinates are a Google encoded polyline string,
+    selected with ?format=polyline or by its media type.
+    """
+    media_type = 'application/vnd.heyroad.polyline+json'
+    format = 'polyline'
+
+
+def _msgpack_default(obj):
+    # dates, decimals, lazy strings, ... as they would be in JSON
+    return JSONEncoder().default(obj)
+
+
+class MessagePackRenderer(BaseRenderer):
+    media_type = 'application/msgpack'
+    format = 'msgpack'
+    charset = None
+    render_style = 'binary'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        return msgpack.packb(data, default=_msgpack_default,
+                             use_bin_type=True)
+
+
+class EventStreamRenderer(BaseRenderer):
+    """
+    Lets clients ask for text/event-stream; the stream itself is a
+    StreamingHttpResponse, errors are rendered as JSON.
+    """
+    media_type = 'text/event-stream'
+    format = 'sse'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        return JSONRenderer().render(data)
@@ -1,16 +1,46 @@
 from django.contrib.auth.models import User
 from rest_framework import serializers
 
-from .models import Route, LatLng, Friendship, Comment
+from . import instrumentation, polyline
+from .metrics import split_list
+from .models import Route, LatLng, Friendship, Comment, UserStats, \
+                    StatsBucket, RouteMetrics, RouteJob, TimelineEntry, \
+                    LiveRoute
 
+# shapes of RouteDetailSerializer.coords, chosen with context['coords_format']
+COORDS_OBJECTS = 'objects'
+COORDS_ARRAYS = 'arrays'
+COORDS_POLYLINE = 'polyline'
+COORDS_FORMATS = (COORDS_OBJECTS, COORDS_ARRAYS, COORDS_POLYLINE)
 
-class UserSerializer(serializers.ModelSerializer):
+
+class TimedSerializerMixin:
+    """
+    Count serializing for the 'serialize' phase of the current request,
+    see heyroad.instrumentation.
+    """
+
+    def to_representation(self, instance):
+        phases = instrumentation.current_phases()
+        # nested serializers are timed by the outermost one
+        if phases is None or phases.current == instrumentation.SERIALIZE:
+            return super().to_representation(instance)
+        with phases.phase(instrumentation.SERIALIZE):
+            return super().to_representation(instance)
+
+class ModelSerializer(TimedSerializerMixin, serializers.ModelSerializer):
+    pass
+
+class Serializer(TimedSerializerMixin, serializers.Serializer):
+    pass
+
+class UserSerializer(ModelSerializer):
 
     class Meta:
         model = User
         fields = ['id', 'username', 'email']
 
-class UserDetailSerializer(serializers.ModelSerializer):
+class UserDetailSerializer(ModelSerializer):
     routes = serializers.HyperlinkedRelatedField(many=True,
                                                  view_name='route-detail',
                                                  read_only=True)
@@ -19,35 +49,127 @@ class UserDetailSerializer(serializers.ModelSerializer):
         model = User
         fields = ['id', 'username', 'email', 'routes']
 
-class RouteSerializer(serializers.ModelSerializer):
+class RouteSerializer(ModelSerializer):
 
     class Meta:
         model = Route
         fields = ['id', 'user', 'distance', 'date', 'duration']
 
-class LatLngSerializer(serializers.ModelSerializer):
+class LatLngSerializer(ModelSerializer):
 
     class Meta:
         model = LatLng
         fields = ['latitude', 'longitude']
 
-class CommentSerializer(serializers.ModelSerializer):
+class CommentSerializer(ModelSerializer):
 
     class Meta:
         model = Comment
         fields = ['id', 'user', 'route', 'date', 'text']
 
-class RouteDetailSerializer(serializers.ModelSerializer):
-    coords = LatLngSerializer(many=True, read_only=True)
+class RouteMetricsSerializer(ModelSerializer):
+    splits = serializers.SerializerMethodField()
+
+    class Meta:
+        model = RouteMetrics
+        fields = ['distance', 'elapsed_seconds', 'moving_seconds',
+                  'average_speed', 'max_speed', 'elevation_gain', 'splits']
+
+    def get_splits(self, obj):
+        return split_list(obj)
+
+class RouteJobSerializer(ModelSerializer):
+
+    class Meta:
+        model = RouteJob
+        fields = ['status', 'attempts', 'run_after', 'updated']
+
+class RouteDetailSerializer(ModelSerializer):
+    coords = serializers.SerializerMethodField()
     comments = CommentSerializer(many=True, read_only=True)
+    metrics = RouteMetricsSerializer(read_only=True)
+    processing = serializers.CharField(source='job.status', read_only=True,
+                                       default=None)
 
     class Meta:
         model = Route
         fields = ['id', 'user', 'distance', 'date', 'duration', 'coords',
-                  'comments']
+                  'comments', 'metrics', 'processing']
+
+    def get_coords(self, obj):
+        # views may pass an already simplified track in the context
+        points = self.context.get('points')
+        if points is None:
+            points = obj.get_points()
+        coords_format = self.context.get('coords_format', COORDS_OBJECTS)
+        if coords_format == COORDS_POLYLINE:
+            return polyline.encode(points)
+        if coords_format == COORDS_ARRAYS:
+            # tuples render as [latitude, longitude] arrays
+            return points
+        return [{'latitude': latitude, 'longitude': longitude}
+                for latitude, longitude in points]
+
+class TimelineEntrySerializer(ModelSerializer):
+    route = RouteSerializer(read_only=True)
+    comment = CommentSerializer(read_only=True)
 
-class FriendshipSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = TimelineEntry
+        fields = ['id', 'kind', 'date', 'actor', 'route', 'comment']
+
+class LiveRouteSerializer(ModelSerializer):
+
+    class Meta:
+        model = LiveRoute
+        fields = ['id', 'user', 'started', 'updated', 'seq', 'finished',
+                  'route']
+
+class FriendshipSerializer(ModelSerializer):
 
     class Meta:
         model = Friendship
         fields = ['id', 'user1', 'user2', 'is_accepted']
+
+class StatsBucketSerializer(ModelSerializer):
+    duration = serializers.DurationField(read_only=True)
+
+    class Meta:
+        model = StatsBucket
+        fields = ['start', 'route_count', 'distance', 'duration']
+
+class UserStatsSerializer(ModelSerializer):
+    total_duration = serializers.DurationField(read_only=True)
+    weekly = serializers.SerializerMethodField()
+    monthly = serializers.SerializerMethodField()
+
+    class Meta:
+        model = UserStats
+        fields = ['user', 'route_count', 'total_distance', 'total_duration',
+                  'longest_distance', 'weekly', 'monthly']
+
+    def _buckets(self, obj, period):
+        buckets = StatsBucket.objects.filter(user_id=obj.user_id,
+                                             period=period)
+        limit = self.context.get('bucket_limit', 12)
+        return StatsBucketSerializer(buckets[:limit], many=True).data
+
+    def get_weekly(self, obj):
+        return self._buckets(obj, StatsBucket.WEEK)
+
+    def get_monthly(self, obj):
+        return self._buckets(obj, StatsBucket.MONTH)
+
+class LeaderboardEntrySerializer(Serializer):
+    rank = serializers.IntegerField()
+    user = serializers.IntegerField()
+    username = serializers.CharField()
+    route_count = serializers.IntegerField()
+    distance = serializers.FloatField()
+    duration = serializers.DurationField()
+
+class LeaderboardSerializer(Serializer):
+    period = serializers.CharField()
+    start = serializers.DateField()
+    metric = serializers.CharField()
+    entries = LeaderboardEntrySerializer(many=True)
@@ -0,0 +1,83 @@
+from django.contrib.auth.models import User
+from django.db.models.signals import post_init, post_save, pre_delete, \
+                                     post_delete
+from django.dispatch import receiver
+from rest_framework.authtoken.models import Token
+
+from heyroad import authentication, caching, changes, friends, stats, \
+                    timeline
+from heyroad.models import Route, Friendship, Comment, ChangeLog
+
+
+@receiver(post_save, sender=Friendship)
+def friendship_saved(sender, instance, raw=False, **kwargs):
+    friends.invalidate(instance.user1_id, instance.user2_id)
+    changes.record(ChangeLog.FRIENDSHIP, instance)
+    if instance.is_accepted and not raw:
+        timeline.connect(instance.user1_id, instance.user2_id)
+
+
+@receiver(post_delete, sender=Friendship)
+def friendship_deleted(sender, instance, **kwargs):
+    friends.invalidate(instance.user1_id, instance.user2_id)
+    changes.record(ChangeLog.FRIENDSHIP, instance, deleted=True)
+    if instance.is_accepted:
+        timeline.disconnect(instance.user1_id, instance.user2_id)
+
+
+@receiver(post_save, sender=Route)
+def route_saved(sender, instance, created, raw=False, **kwargs):
+    changes.record(ChangeLog.ROUTE, instance)
+    if created and not raw:
+        stats.route_added(instance)
+        timeline.route_added(instance)
+
+
+@receiver(pre_delete, sender=Route)
+def route_deleting(sender, instance, **kwargs):
+    # its comments are deleted first
+    changes.route_deleting(instance)
+
+
+@receiver(post_delete, sender=Route)
+def route_deleted(sender, instance, **kwargs):
+    stats.route_removed(instance)
+    changes.record(ChangeLog.ROUTE, instance, deleted=True)
+    changes.route_deleted(instance)
+
+
+@receiver(post_save, sender=Comment)
+def comment_saved(sender, instance, created, raw=False, **kwargs):
+    changes.record(ChangeLog.COMMENT, instance)
+    if created and not raw:
+        caching.touch_route(instance.route_id)
+        timeline.comment_added(instance)
+
+
+@receiver(post_delete, sender=Comment)
+def comment_deleted(sender, instance, **kwargs):
+    caching.touch_route(instance.route_id)
+    changes.record(ChangeLog.COMMENT, instance, deleted=True)
+
+
+@receiver(post_delete, sender=Token)
+def token_deleted(sender, instance, **kwargs):
+    authentication.forget_token(instance.key)
+
+
+@receiver(post_init, sender=User)
+def user_loaded(sender, instance, **kwargs):
+    instance._saved_username = instance.username
+
+
+@receiver(post_save, sender=User)
+def user_saved(sender, instance, created, update_fields=None, **kwargs):
+    # deactivated, or permissions changed
+    if not created:
+        authentication.forget_user(instance.pk)
+    # the username is on the leaderboards of their friends; logins only
+    # save last_login
+    if update_fields is None or 'username' in update_fields:
+        if not created and instance.username != instance._saved_username:
+            stats.touch(instance.pk)
+        instance._saved_username = instance.username
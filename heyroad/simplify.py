@@ -0,0 +1,126 @@
+"""
+Track simplification (level of detail).
+
+Each route keeps its full track plus a few Douglas-Peucker simplified
+copies, one per tolerance in HEYROAD_SIMPLIFY_LEVELS. Tolerances are in
+metres. Requests only ever get a stored copy or the full track, nothing is
+simplified while answering them.
+"""
+import math
+
+from django.conf import settings
+
+from heyroad.geometry import pack_points, unpack_points
+from heyroad.models import TrackLevel
+
+DEFAULT_LEVELS = {
+    'low': 50.0,
+    'medium': 10.0,
+    'high': 2.0,
+}
+FULL_DETAIL = 'full'
+METRES_PER_DEGREE = 111320.0
+
+
+def simplify_levels():
+    return getattr(settings, 'HEYROAD_SIMPLIFY_LEVELS', DEFAULT_LEVELS)
+
+
+def _project(points):
+    # equirectangular projection around the track's mean latitude, good
+    # enough for the few kilometres a single segment spans
+    mean_latitude = sum(latitude for latitude, _ in points) / len(points)
+    kx = METRES_PER_DEGREE * math.cos(math.radians(mean_latitude))
+    ky = METRES_PER_DEGREE
+    xs = [longitude * kx for _, longitude in points]
+    ys = [latitude * ky for latitude, _ in points]
+    return xs, ys
+
+
+def simplify(points, tolerance):
+    """
+    Douglas-Peucker simplification of a list of (latitude, longitude)
+    pairs. No dropped point lies further than `tolerance` metres from the
+    simplified track.
+    """
+    count = len(points)
+    if count < 3 or tolerance <= 0:
+        return list(points)
+    xs, ys = _project(points)
+    tolerance_sq = tolerance * tolerance
+    keep = [False] * count
+    keep[0] = keep[-1] = True
+    stack = [(0, count - 1)]
+    while stack:
+        first, last = stack.pop()
+        ax, ay = xs[first], ys[first]
+        dx, dy = xs[last] - ax, ys[last] - ay
+        segment_sq = dx * dx + dy * dy
+        max_sq, index = tolerance_sq, None
+        for i in range(first + 1, last):
+            px, py = xs[i] - ax, ys[i] - ay
+            if segment_sq:
+                t = (px * dx + py * dy) / segment_sq
+                t = 0.0 if t < 0.0 else 1.0 if t > 1.0 else t
+                px, py = px - t * dx, py - t * dy
+            distance_sq = px * px + py * py
+            if distance_sq > max_sq:
+                max_sq, index = distance_sq, i
+        if index is not None:
+            keep[index] = True
+            stack.append((first, index))
+            stack.append((index, last))
+    return [point for point, kept in zip(points, keep) if kept]
+
+
+def build_levels(route, points):
+    """
+    Store a simplified track of `route` for every configured tolerance,
+    replacing any levels it already has.
+    """
+    TrackLevel.objects.filter(route=route).delete()
+    TrackLevel.objects.bulk_create([
+        TrackLevel(route=route, tolerance=tolerance,
+                   track=pack_points(simplify(points, tolerance)))
+        for tolerance in sorted(set(simplify_levels().values()))
+    ])
+
+
+def parse_tolerance(detail=None, tolerance=None):
+    """
+    Translate ?detail= / ?tolerance= query values into a tolerance in
+    metres. Returns None for the full track. A ?tolerance= is snapped down
+    to the nearest configured level, or the full track below the finest.
+    """
+    if tolerance is not None:
+        value = float(tolerance)
+        if not math.isfinite(value) or value < 0:
+            raise ValueError('tolerance must be a non-negative number')
+        return max((level for level in simplify_levels().values()
+                    if level <= value), default=None)
+    if detail is None or detail == FULL_DETAIL:
+        return None
+    levels = simplify_levels()
+    if detail not in levels:
+        raise ValueError('detail must be one of {}'.format(
+            sorted(levels) + [FULL_DETAIL]))
+    return levels[detail]
+
+
+def route_points(route, tolerance=None):
+    """
+    Return the points of `route` simplified to at most `tolerance` metres.
+
+    The coarsest stored level that is still within the tolerance is used;
+    routes whose levels are not built yet get their full track.
+    """
+    if tolerance is None:
+        return route.get_points()
+    level = TrackLevel.objects.filter(route=route,
+                                      tolerance__lte=tolerance) \
+                              .order_by('-tolerance') \
+                              .values_list('track', flat=True) \
+                              .first()
+    if level is not None:
+        return unpack_points(level)
+    return route.get_points()
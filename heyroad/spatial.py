@@ -0,0 +1,193 @@
+"""
+Spatial lookup of routes without a spatial database.
+
+Every route stores its bounding box and the set of fixed-size grid cells
+its simplified track passes through (RouteCell). Cell ids are numbered
+row by row, so the cells of an area form one contiguous id range per grid
+row, and a query becomes a few indexed range scans on RouteCell.
+"""
+import math
+
+from django.conf import settings
+from django.db.models import Q
+
+from heyroad.models import Route, RouteCell
+from heyroad.simplify import simplify
+
+# degrees; changing it requires running index_routes again
+DEFAULT_CELL_SIZE = 0.01
+# metres; tracks are simplified this much before being rasterized
+INDEX_TOLERANCE = 10.0
+# above this many grid rows only the bounding boxes are compared; each row
+# costs two query parameters
+MAX_QUERY_ROWS = 100
+MAX_RADIUS = 100000.0
+METRES_PER_DEGREE = 111320.0
+
+
+def cell_size():
+    return getattr(settings, 'HEYROAD_GRID_CELL_SIZE', DEFAULT_CELL_SIZE)
+
+
+def _grid():
+    size = cell_size()
+    return size, int(math.ceil(360 / size)), int(math.ceil(180 / size))
+
+
+def _row(latitude, size, rows):
+    return min(max(int((latitude + 90) // size), 0), rows - 1)
+
+
+def _column(longitude, size, columns):
+    return min(max(int((longitude + 180) // size), 0), columns - 1)
+
+
+def cell_of(latitude, longitude):
+    size, columns, rows = _grid()
+    return _row(latitude, size, rows) * columns \
+        + _column(longitude, size, columns)
+
+
+def track_cells(points):
+    """
+    Ids of the grid cells a track of (latitude, longitude) points crosses.
+    """
+    size = cell_size()
+    cells = set()
+    if points:
+        cells.add(cell_of(*points[0]))
+    for (lat1, lng1), (lat2, lng2) in zip(points, points[1:]):
+        # sample each segment at least twice per cell it may cross
+        steps = int(max(abs(lat2 - lat1), abs(lng2 - lng1)) / size * 2) + 1
+        for step in range(1, steps + 1):
+            t = step / steps
+            cells.add(cell_of(lat1 + (lat2 - lat1) * t,
+                              lng1 + (lng2 - lng1) * t))
+    return cells
+
+
+def index_route(route, points):
+    """
+    Store the bounding box and grid cells of `route`.
+    """
+    if points:
+        latitudes = [latitude for latitude, _ in points]
+        longitudes = [longitude for _, longitude in points]
+        bbox = {
+            'min_latitude': min(latitudes),
+            'max_latitude': max(latitudes),
+            'min_longitude': min(longitudes),
+            'max_longitude': max(longitudes),
+        }
+    else:
+        bbox = dict.fromkeys(['min_latitude', 'max_latitude',
+                              'min_longitude', 'max_longitude'])
+    Route.objects.filter(pk=route.pk).update(**bbox)
+    for name, value in bbox.items():
+        setattr(route, name, value)
+
+    RouteCell.objects.filter(route=route).delete()
+    RouteCell.objects.bulk_create([
+        RouteCell(route=route, cell=cell)
+        for cell in sorted(track_cells(simplify(points, INDEX_TOLERANCE)))
+    ])
+
+
+def parse_bbox(value):
+    """
+    Parse 'min_lng,min_lat,max_lng,max_lat' (GeoJSON order) into
+    (min_lat, min_lng, max_lat, max_lng).
+    """
+    try:
+        min_lng, min_lat, max_lng, max_lat = \
+            [float(part) for part in value.split(',')]
+    except (AttributeError, ValueError):
+        raise ValueError('bbox must be min_lng,min_lat,max_lng,max_lat')
+    if not (-90 <= min_lat <= max_lat <= 90
+            and -180 <= min_lng <= max_lng <= 180):
+        raise ValueError('bbox out of range')
+    return min_lat, min_lng, max_lat, max_lng
+
+
+def parse_near(near, radius):
+    """
+    Parse ?near=lat,lng&radius=<metres> into (lat, lng, radius).
+    """
+    try:
+        latitude, longitude = [float(part) for part in near.split(',')]
+        radius = float(radius)
+    except (AttributeError, TypeError, ValueError):
+        raise ValueError('near must be lat,lng and radius a number of metres')
+    if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+        raise ValueError('near out of range')
+    if not 0 < radius <= MAX_RADIUS:
+        raise ValueError('radius must be between 0 and {:.0f} m'.format(
+            MAX_RADIUS))
+    return latitude, longitude, radius
+
+
+def _filter(queryset, min_lat, min_lng, max_lat, max_lng, ranges):
+    queryset = queryset.filter(min_latitude__lte=max_lat,
+                               max_latitude__gte=min_lat,
+                               min_longitude__lte=max_lng,
+                               max_longitude__gte=min_lng)
+    if not ranges:
+        return queryset
+    _, columns, _ = _grid()
+    cells = Q()
+    for row, first, last in ranges:
+        cells |= Q(cell__range=(row * columns + first, row * columns + last))
+    return queryset.filter(
+        pk__in=RouteCell.objects.filter(cells).values('route'))
+
+
+def within_bbox(queryset, min_lat, min_lng, max_lat, max_lng):
+    """
+    Routes of `queryset` passing through the given box.
+    """
+    size, columns, rows = _grid()
+    first_row, last_row = _row(min_lat, size, rows), _row(max_lat, size, rows)
+    ranges = None
+    if last_row - first_row < MAX_QUERY_ROWS:
+        first, last = _column(min_lng, size, columns), \
+            _column(max_lng, size, columns)
+        ranges = [(row, first, last)
+                  for row in range(first_row, last_row + 1)]
+    return _filter(queryset, min_lat, min_lng, max_lat, max_lng, ranges)
+
+
+def near(queryset, latitude, longitude, radius):
+    """
+    Routes of `queryset` passing through a grid cell within `radius`
+    metres of the given point.
+    """
+    size, columns, rows = _grid()
+    dlat = radius / METRES_PER_DEGREE
+    min_lat, max_lat = max(latitude - dlat, -90.0), min(latitude + dlat, 90.0)
+    widest = math.cos(math.radians(min(max(abs(min_lat), abs(max_lat)),
+                                       89.9)))
+    dlng = min(radius / (METRES_PER_DEGREE * widest), 180.0)
+    min_lng = max(longitude - dlng, -180.0)
+    max_lng = min(longitude + dlng, 180.0)
+
+    first_row, last_row = _row(min_lat, size, rows), _row(max_lat, size, rows)
+    ranges = None
+    if last_row - first_row < MAX_QUERY_ROWS:
+        ranges = []
+        for row in range(first_row, last_row + 1):
+            south = row * size - 90
+            north = south + size
+            # distance from the centre to the nearest edge of this row
+            dy = 0.0 if south <= latitude <= north else \
+                min(abs(latitude - south), abs(latitude - north)) \
+                * METRES_PER_DEGREE
+            if dy > radius:
+                continue
+            shrink = math.cos(math.radians(min(max(abs(south), abs(north)),
+                                               89.9)))
+            half = math.sqrt(radius * radius - dy * dy) \
+                / (METRES_PER_DEGREE * shrink)
+            ranges.append((row,
+                           _column(longitude - half, size, columns),
+                           _column(longitude + half, size, columns)))
+    return _filter(queryset, min_lat, min_lng, max_lat, max_lng, ranges)
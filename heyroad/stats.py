@@ -0,0 +1,168 @@
+"""
+Per-user route statistics.
+
+UserStats and StatsBucket rows are adjusted in place whenever a route is
+created or deleted (see heyroad.signals), so reading them is a primary
+key lookup instead of an aggregate over all of a user's routes. Each
+change also gives the user a new stats version in the cache, for caches
+of data derived from the stats of several users (see heyroad.leaderboard).
+"""
+import uuid
+from collections import defaultdict
+from datetime import timedelta
+
+from django.core.cache import cache
+from django.db import IntegrityError, transaction
+from django.db.models import F, Max
+from django.utils import timezone
+
+from heyroad.models import Route, UserStats, StatsBucket
+
+PERIODS = (StatsBucket.WEEK, StatsBucket.MONTH)
+VERSION_TIMEOUT = 24 * 60 * 60
+
+
+def period_start(period, date):
+    """
+    First day of the week (Monday) or month containing `date`, in the
+    site's time zone.
+    """
+    day = timezone.localtime(date).date()
+    if period == StatsBucket.WEEK:
+        return day - timedelta(days=day.weekday())
+    return day.replace(day=1)
+
+
+def _version_key(user_id):
+    return 'heyroad:stats-version:{}'.format(user_id)
+
+
+def _new_version():
+    # unique across processes and cache restarts, unlike a counter
+    return uuid.uuid4().hex
+
+
+def touch(user_id):
+    """
+    Give a user a new stats version.
+    """
+    key = _version_key(user_id)
+    cache.set(key, _new_version(), VERSION_TIMEOUT)
+    # again once committed: data derived from the old rows while the
+    # transaction was open must not stay cached under the new version
+    transaction.on_commit(
+        lambda: cache.set(key, _new_version(), VERSION_TIMEOUT))
+
+
+def versions(user_ids):
+    """
+    (user id, stats version) pairs of the given users, sorted.
+    """
+    keys = {_version_key(user_id): user_id for user_id in user_ids}
+    found = cache.get_many(keys)
+    missing = {key: _new_version() for key in keys if key not in found}
+    if missing:
+        cache.set_many(missing, VERSION_TIMEOUT)
+        found.update(missing)
+    return sorted((keys[key], version) for key, version in found.items())
+
+
+def _increment(model, lookup, create=True, **deltas):
+    updates = {name: F(name) + delta for name, delta in deltas.items()}
+    if model.objects.filter(**lookup).update(**updates) or not create:
+        return
+    try:
+        with transaction.atomic():
+            model.objects.create(**lookup, **deltas)
+    except IntegrityError:
+        # created concurrently
+        model.objects.filter(**lookup).update(**updates)
+
+
+def _apply(route, sign):
+    # rows are only created when adding, a removal may be part of the
+    # user's own deletion
+    create = sign > 0
+    seconds = route.duration.total_seconds()
+    _increment(UserStats, {'user_id': route.user_id}, create,
+               route_count=sign,
+               total_distance=sign * route.distance,
+               duration_seconds=sign * seconds)
+    for period in PERIODS:
+        _increment(StatsBucket,
+                   {'user_id': route.user_id,
+                    'period': period,
+                    'start': period_start(period, route.date)},
+                   create,
+                   route_count=sign,
+                   distance=sign * route.distance,
+                   duration_seconds=sign * seconds)
+    touch(route.user_id)
+
+
+def route_added(route):
+    _apply(route, 1)
+    UserStats.objects.filter(user_id=route.user_id,
+                             longest_distance__lt=route.distance) \
+                     .update(longest_distance=route.distance)
+
+
+def route_removed(route):
+    _apply(route, -1)
+    StatsBucket.objects.filter(user_id=route.user_id,
+                               route_count__lte=0).delete()
+    stats = UserStats.objects.filter(user_id=route.user_id,
+                                     longest_distance__lte=route.distance)
+    if stats.exists():
+        longest = Route.objects.filter(user_id=route.user_id) \
+                               .aggregate(longest=Max('distance'))['longest']
+        stats.update(longest_distance=longest or 0)
+
+
+def get_user_stats(user):
+    """
+    The stats record of `user`, or an unsaved empty one.
+    """
+    try:
+        return UserStats.objects.get(user=user)
+    except UserStats.DoesNotExist:
+        return UserStats(user=user)
+
+
+def compute_user_stats(user_id):
+    """
+    Aggregate all routes of a user from scratch. Returns plain data so it
+    can be computed in a worker process.
+    """
+    totals = {'route_count': 0, 'total_distance': 0.0,
+              'duration_seconds': 0.0, 'longest_distance': 0.0}
+    buckets = defaultdict(lambda: [0, 0.0, 0.0])
+    routes = Route.objects.filter(user_id=user_id) \
+                          .values_list('date', 'distance', 'duration')
+    for date, distance, duration in routes.iterator():
+        seconds = duration.total_seconds()
+        totals['route_count'] += 1
+        totals['total_distance'] += distance
+        totals['duration_seconds'] += seconds
+        totals['longest_distance'] = max(totals['longest_distance'],
+                                         distance)
+        for period in PERIODS:
+            bucket = buckets[(period, period_start(period, date))]
+            bucket[0] += 1
+            bucket[1] += distance
+            bucket[2] += seconds
+    return user_id, totals, dict(buckets)
+
+
+def save_user_stats(user_id, totals, buckets):
+    with transaction.atomic():
+        UserStats.objects.filter(user_id=user_id).delete()
+        StatsBucket.objects.filter(user_id=user_id).delete()
+        UserStats.objects.create(user_id=user_id, **totals)
+        StatsBucket.objects.bulk_create([
+            StatsBucket(user_id=user_id, period=period, start=start,
+                        route_count=count, distance=distance,
+                        duration_seconds=seconds)
+            for (period, start), (count, distance, seconds) in buckets.items()
+        ])
+        touch(user_id)
@@ -0,0 +1,30 @@
+"""
+Template backend timing template rendering for the 'template' phase of
+the current request (see heyroad.instrumentation), whether the template
+is rendered by a TemplateResponse or by the render() shortcut.
+"""
+from django.template import TemplateDoesNotExist
+from django.template.backends.django import DjangoTemplates, Template, \
+                                            reraise
+
+from heyroad import instrumentation
+
+
+class TimedTemplate(Template):
+
+    def render(self, context=None, request=None):
+        with instrumentation.phase(instrumentation.TEMPLATE):
+            return super().render(context, request)
+
+
+class TimedDjangoTemplates(DjangoTemplates):
+
+    def from_string(self, template_code):
+        return TimedTemplate(self.engine.from_string(template_code), self)
+
+    def get_template(self, template_name):
+        try:
+            return TimedTemplate(self.engine.get_template(template_name),
+                                 self)
+        except TemplateDoesNotExist as exc:
+            reraise(exc, self)
@@ -1,3 +1,2222 @@
-from django.test import TestCase
+import gzip
+import io
+import json
+import os
+import random
+import sqlite3
+import tempfile
+import threading
+import time
+import zipfile
+import zlib
+from datetime import timedelta
+from unittest import mock
+from xml.etree import ElementTree
 
-# Create your tests here.
+import msgpack
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import IntegrityError, connection, transaction
+from django.db.models import QuerySet
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+
+from heyroad import authentication, caching, changes, db, export, \
+                    friends, geometry, importers, ingest, instrumentation, \
+                    leaderboard, live, metrics, polyline, processing, \
+                    simplify, stats, thumbnails
+from heyroad.management.commands.seed_data import power_law_edges
+from heyroad.middleware import ReadReplicaMiddleware
+from heyroad.models import Route, LatLng, TrackLevel, Friendship, Comment, \
+                           UserStats, StatsBucket, RouteMetrics, RouteJob, \
+                           RouteCell, TimelineEntry, UploadKey, LiveRoute, \
+                           LiveChunk, ChangeLog
+
+
+def make_coords(size, latitude=52.0, longitude=21.0, step=0.0001):
+    return [{'latitude': latitude + i * step,
+             'longitude': longitude + i * step}
+            for i in range(size)]
+
+
+def make_payload(size, **kwargs):
+    payload = {
+        'distance': 12.5,
+        'date': timezone.now().isoformat(),
+        'duration': str(timedelta(minutes=45)),
+        'coords': make_coords(size),
+    }
+    payload.update(kwargs)
+    return payload
+
+
+@override_settings(HEYROAD_PROCESS_ROUTES_INLINE=True)
+class APITestBase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        caching.payload_cache.clear()
+        authentication.token_cache.clear()
+        live.HUB.clear()
+        self.user = User.objects.create_user('rider', 'rider@example.com',
+                                             'secret-pass-123')
+        self.client = APIClient()
+        token = Token.objects.create(user=self.user)
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + token.key)
+
+    def post_route(self, payload):
+        return self.client.post('/api/route/', json.dumps(payload),
+                                content_type='application/json')
+
+
+@override_settings(HEYROAD_ROUTE_STORAGE='rows')
+class RouteIngestTests(APITestBase):
+
+    def test_create_stores_route_and_coords(self):
+        response = self.post_route(make_payload(25))
+        self.assertEqual(response.status_code, 201)
+        route = Route.objects.get(pk=response.data['id'])
+        self.assertEqual(route.user, self.user)
+        self.assertEqual(LatLng.objects.filter(route=route).count(), 25)
+
+    def test_create_batches_coordinate_inserts(self):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.post_route(make_payload(3000))
+        self.assertEqual(response.status_code, 201)
+        inserts = [query for query in ctx.captured_queries
+                   if query['sql'].startswith('INSERT INTO "heyroad_latlng"')]
+        # batches of 2000 rows, which SQLite's 999 parameter limit splits
+        # further into statements of at most 333 rows
+        self.assertLessEqual(len(inserts), 11)
+        self.assertEqual(LatLng.objects.count(), 3000)
+
+    def test_invalid_coordinate_rejects_whole_upload(self):
+        payload = make_payload(10)
+        payload['coords'][5] = {'latitude': 'north', 'longitude': 1.0}
+        response = self.post_route(payload)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data['result'], 'failed_invalid_payload')
+        self.assertFalse(Route.objects.exists())
+        self.assertFalse(LatLng.objects.exists())
+
+    def test_out_of_range_coordinate_is_rejected(self):
+        payload = make_payload(2)
+        payload['coords'][0]['latitude'] = 91.0
+        self.assertEqual(self.post_route(payload).status_code, 400)
+
+    def test_non_finite_values_are_rejected(self):
+        for distance in ('nan', 'inf', '-inf'):
+            response = self.post_route(make_payload(2, distance=distance))
+            self.assertEqual(response.status_code, 400)
+        payload = make_payload(2)
+        for coordinate in payload['coords']:
+            coordinate['elevation'] = 'nan'
+        self.assertEqual(self.post_route(payload).status_code, 400)
+        self.assertFalse(Route.objects.exists())
+
+    def test_coords_are_required(self):
+        payload = make_payload(2)
+        del payload['coords']
+        response = self.post_route(payload)
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('coords', response.data['detail'])
+        self.assertFalse(Route.objects.exists())
+
+    def test_malformed_json_is_rejected(self):
+        response = self.client.post('/api/route/', '{"distance": ',
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+
+
+class GeometryTests(TestCase):
+
+    def test_pack_round_trip_to_micro_degrees(self):
+        points = [(52.2297001, 21.0122004), (-33.8688, 151.2093), (0.0, -0.5)]
+        data = geometry.pack_points(points)
+        self.assertEqual(len(data), 3 * 2 * geometry.ITEMSIZE)
+        self.assertEqual(geometry.point_count(data), 3)
+        for (lat, lng), (lat2, lng2) in zip(points,
+                                            geometry.unpack_points(data)):
+            self.assertAlmostEqual(lat, lat2, places=6)
+            self.assertAlmostEqual(lng, lng2, places=6)
+
+    def test_point_view_does_not_copy(self):
+        data = geometry.pack_points([(1.5, 2.5)])
+        view = geometry.point_view(data)
+        self.assertEqual(list(view), [1500000, 2500000])
+        if geometry.LITTLE_ENDIAN:
+            self.assertIs(view.obj, data)
+
+
+@override_settings(HEYROAD_ROUTE_STORAGE='packed')
+class PackedRouteStorageTests(APITestBase):
+
+    def test_create_packs_track_into_route(self):
+        payload = make_payload(500)
+        response = self.post_route(payload)
+        self.assertEqual(response.status_code, 201)
+        route = Route.objects.get(pk=response.data['id'])
+        self.assertFalse(LatLng.objects.exists())
+        self.assertEqual(geometry.point_count(route.track), 500)
+
+    def test_retrieve_keeps_coordinate_shape(self):
+        payload = make_payload(3)
+        route_id = self.post_route(payload).data['id']
+        response = self.client.get('/api/route/{}/'.format(route_id))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data['coords']), 3)
+        for sent, got in zip(payload['coords'], response.data['coords']):
+            self.assertEqual(set(got), {'latitude', 'longitude'})
+            self.assertAlmostEqual(sent['latitude'], got['latitude'], places=6)
+
+    def test_row_and_packed_routes_read_the_same(self):
+        points = [(52.0, 21.0), (52.5, 21.5)]
+        rows = Route.objects.create(user=self.user, distance=1.0)
+        LatLng.objects.bulk_create([LatLng(route=rows, latitude=lat,
+                                           longitude=lng)
+                                    for lat, lng in points])
+        packed = Route.objects.create(user=self.user, distance=1.0,
+                                      track=geometry.pack_points(points))
+        self.assertEqual(rows.get_points(), packed.get_points())
+
+
+class SimplifyTests(TestCase):
+
+    def test_collinear_points_collapse_to_endpoints(self):
+        points = [(52.0 + i * 0.001, 21.0) for i in range(100)]
+        self.assertEqual(simplify.simplify(points, 1.0),
+                         [points[0], points[-1]])
+
+    def test_deviation_above_tolerance_is_kept(self):
+        # ~111 m detour in the middle of a straight line
+        points = [(52.0, 21.0), (52.0, 21.01), (52.001, 21.02),
+                  (52.0, 21.03), (52.0, 21.04)]
+        self.assertIn((52.001, 21.02), simplify.simplify(points, 50.0))
+        self.assertNotIn((52.001, 21.02), simplify.simplify(points, 200.0))
+
+    def test_parse_tolerance(self):
+        self.assertIsNone(simplify.parse_tolerance())
+        self.assertIsNone(simplify.parse_tolerance('full'))
+        self.assertEqual(simplify.parse_tolerance(tolerance='7.5'),
+                         simplify.DEFAULT_LEVELS['high'])
+        self.assertEqual(simplify.parse_tolerance(tolerance='10.0001'),
+                         simplify.DEFAULT_LEVELS['medium'])
+        self.assertIsNone(simplify.parse_tolerance(tolerance='1.5'))
+        self.assertEqual(simplify.parse_tolerance('low'),
+                         simplify.DEFAULT_LEVELS['low'])
+        with self.assertRaises(ValueError):
+            simplify.parse_tolerance('tiny')
+        with self.assertRaises(ValueError):
+            simplify.parse_tolerance(tolerance='-1')
+
+
+class RouteDetailLevelTests(APITestBase):
+
+    def setUp(self):
+        super().setUp()
+        payload = make_payload(0)
+        payload['coords'] = [{'latitude': 52.0 + i * 0.0001,
+                              'longitude': 21.0 + (i % 2) * 0.00001}
+                             for i in range(1000)]
+        self.route_id = self.post_route(payload).data['id']
+
+    def get_coords(self, query=''):
+        response = self.client.get(
+            '/api/route/{}/{}'.format(self.route_id, query))
+        self.assertEqual(response.status_code, 200)
+        return response.data['coords']
+
+    def test_levels_are_built_on_ingest(self):
+        tolerances = TrackLevel.objects.filter(route_id=self.route_id) \
+                                       .values_list('tolerance', flat=True)
+        self.assertEqual(sorted(tolerances),
+                         sorted(simplify.DEFAULT_LEVELS.values()))
+
+    def test_detail_parameter_returns_smaller_track(self):
+        full = self.get_coords()
+        low = self.get_coords('?detail=low')
+        self.assertEqual(len(full), 1000)
+        self.assertLess(len(low), 10)
+        self.assertEqual(low[0], full[0])
+        self.assertEqual(low[-1], full[-1])
+
+    def test_tolerance_parameter_uses_nearest_finer_level(self):
+        self.assertEqual(self.get_coords('?tolerance=20'),
+                         self.get_coords('?detail=medium'))
+
+    def test_routes_without_levels_get_the_full_track(self):
+        TrackLevel.objects.filter(route_id=self.route_id).delete()
+        with mock.patch('heyroad.simplify.simplify') as simplified:
+            self.assertEqual(len(self.get_coords('?detail=low')), 1000)
+        simplified.assert_not_called()
+
+    def test_tolerances_share_cache_entries(self):
+        self.get_coords()
+        self.get_coords('?tolerance=20')
+        with mock.patch('heyroad.views.route_points') as points:
+            self.get_coords('?tolerance=20.0001')
+            self.get_coords('?tolerance=0.5')
+        points.assert_not_called()
+
+    def test_invalid_detail_is_rejected(self):
+        response = self.client.get(
+            '/api/route/{}/?detail=tiny'.format(self.route_id))
+        self.assertEqual(response.status_code, 400)
+
+
+class FriendServiceTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.alice = User.objects.create_user('alice')
+        self.bob = User.objects.create_user('bob')
+        self.carol = User.objects.create_user('carol')
+        self.friendship = Friendship.objects.create(
+            user1=self.alice, user2=self.bob, is_accepted=True)
+        Friendship.objects.create(user1=self.carol, user2=self.alice,
+                                  is_accepted=False)
+
+    def test_friend_ids_cover_both_directions(self):
+        self.assertEqual(friends.friend_ids(self.alice), {self.bob.pk})
+        self.assertEqual(friends.friend_ids(self.bob), {self.alice.pk})
+        self.assertEqual(friends.friend_ids(self.carol), set())
+
+    def test_friend_ids_are_cached(self):
+        friends.friend_ids(self.alice)
+        with self.assertNumQueries(0):
+            self.assertTrue(friends.can_view(self.alice, self.bob.pk))
+            self.assertFalse(friends.can_view(self.alice, self.carol.pk))
+
+    def test_cache_is_invalidated_by_friendship_changes(self):
+        friends.friend_ids(self.carol)
+        request = Friendship.objects.get(user1=self.carol)
+        request.is_accepted = True
+        request.save()
+        self.assertEqual(friends.friend_ids(self.carol), {self.alice.pk})
+        self.friendship.delete()
+        self.assertEqual(friends.friend_ids(self.bob), set())
+        self.assertEqual(friends.friend_ids(self.alice), {self.carol.pk})
+
+    def test_visible_routes(self):
+        own = Route.objects.create(user=self.alice, distance=1.0)
+        friend = Route.objects.create(user=self.bob, distance=1.0)
+        Route.objects.create(user=self.carol, distance=1.0)
+        self.assertEqual(set(friends.visible_routes(self.alice)),
+                         {own, friend})
+
+    def test_subquery_matches_cached_ids(self):
+        subquery_ids = set(User.objects.filter(
+            pk__in=friends.friends_subquery(self.alice)
+        ).values_list('pk', flat=True))
+        self.assertEqual(subquery_ids, friends.friend_ids(self.alice))
+
+    def test_route_pages_respect_friendship(self):
+        route = Route.objects.create(user=self.carol, distance=1.0)
+        self.client.force_login(self.alice)
+        response = self.client.get('/route/{}/'.format(route.pk))
+        self.assertRedirects(response, '/')
+        self.client.force_login(self.carol)
+        response = self.client.get('/route/{}/'.format(route.pk))
+        self.assertEqual(response.status_code, 200)
+
+    def test_anonymous_user_is_sent_to_login(self):
+        response = self.client.get('/user/{}/'.format(self.alice.pk))
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(response.url.startswith('/login/'))
+
+    @mock.patch.object(friends, 'MAX_INLINE_IDS', 0)
+    def test_large_friend_sets_use_subquery(self):
+        Route.objects.create(user=self.bob, distance=1.0)
+        Route.objects.create(user=self.carol, distance=1.0)
+        self.assertEqual(
+            [route.user for route in friends.visible_routes(self.alice)],
+            [self.bob])
+
+
+class FriendCacheCommitTests(TransactionTestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def test_friends_cached_during_the_transaction_are_dropped(self):
+        alice = User.objects.create_user('alice')
+        bob = User.objects.create_user('bob')
+        with transaction.atomic():
+            Friendship.objects.create(user1=alice, user2=bob,
+                                      is_accepted=True)
+            # a concurrent request still reading the old friends
+            cache.set(friends._cache_key(alice.pk), frozenset())
+        self.assertEqual(friends.friend_ids(alice), {bob.pk})
+
+
+@override_settings(HEYROAD_PAGE_SIZE=3)
+class KeysetPaginationTests(APITestBase):
+
+    def setUp(self):
+        super().setUp()
+        date = timezone.now()
+        # pairs of routes share a date to exercise the id tie-breaker
+        self.routes = [
+            Route.objects.create(user=self.user, distance=i,
+                                 date=date - timedelta(hours=i // 2))
+            for i in range(8)
+        ]
+
+    def collect(self, url):
+        ids, pages = [], 0
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            ids.extend(item['id'] for item in response.data['results'])
+            url = response.data['next']
+            pages += 1
+        return ids, pages
+
+    def test_route_pages_follow_date_then_id(self):
+        ids, pages = self.collect('/api/route/')
+        expected = list(Route.objects.order_by('-date', '-id')
+                                     .values_list('id', flat=True))
+        self.assertEqual(ids, expected)
+        self.assertEqual(pages, 3)
+
+    def test_pages_do_not_use_offset(self):
+        first = self.client.get('/api/route/')
+        with CaptureQueriesContext(connection) as ctx:
+            self.client.get(first.data['next'])
+        sql = ' '.join(query['sql'] for query in ctx.captured_queries)
+        self.assertNotIn('OFFSET', sql)
+
+    def test_invalid_cursor_is_not_found(self):
+        response = self.client.get('/api/route/?cursor=not-a-cursor')
+        self.assertEqual(response.status_code, 404)
+
+    def test_page_size_parameter_is_bounded(self):
+        response = self.client.get('/api/route/?page_size=5')
+        self.assertEqual(len(response.data['results']), 5)
+
+    def test_friend_and_comment_listings_are_paginated(self):
+        for i in range(4):
+            other = User.objects.create_user('friend{}'.format(i))
+            Friendship.objects.create(user1=self.user, user2=other)
+            Comment.objects.create(user=self.user, route=self.routes[0],
+                                   text=str(i))
+        ids, pages = self.collect('/api/friend/')
+        self.assertEqual(len(ids), 4)
+        self.assertEqual(pages, 2)
+        ids, pages = self.collect(
+            '/api/comment/?route={}'.format(self.routes[0].pk))
+        self.assertEqual(ids, list(Comment.objects.values_list('id',
+                                                               flat=True)))
+
+    def test_comments_of_strangers_are_hidden(self):
+        stranger = User.objects.create_user('stranger')
+        route = Route.objects.create(user=stranger, distance=1.0)
+        Comment.objects.create(user=stranger, route=route, text='hidden')
+        response = self.client.get('/api/comment/')
+        self.assertEqual(response.data['results'], [])
+
+    def test_html_feed_links_to_next_page(self):
+        self.client.force_login(self.user)
+        response = self.client.get('/')
+        self.assertEqual(len(response.context['object_list']), 3)
+        cursor = response.context['next_cursor']
+        self.assertContains(response, '?cursor=' + cursor)
+        response = self.client.get('/?cursor=' + cursor)
+        self.assertEqual(response.context['object_list'][0].route,
+                         Route.objects.order_by('-date', '-id')[3])
+
+
+class UserStatsTests(APITestBase):
+
+    def add_route(self, distance, minutes, date=None):
+        return Route.objects.create(user=self.user, distance=distance,
+                                    duration=timedelta(minutes=minutes),
+                                    date=date or timezone.now())
+
+    def test_stats_follow_route_create_and_delete(self):
+        self.add_route(10.0, 30)
+        longest = self.add_route(25.0, 60)
+        self.add_route(5.0, 10, date=timezone.now() - timedelta(days=70))
+        user_stats = UserStats.objects.get(user=self.user)
+        self.assertEqual(user_stats.route_count, 3)
+        self.assertAlmostEqual(user_stats.total_distance, 40.0)
+        self.assertEqual(user_stats.total_duration, timedelta(minutes=100))
+        self.assertEqual(user_stats.longest_distance, 25.0)
+
+        longest.delete()
+        user_stats.refresh_from_db()
+        self.assertEqual(user_stats.route_count, 2)
+        self.assertAlmostEqual(user_stats.total_distance, 15.0)
+        self.assertEqual(user_stats.longest_distance, 10.0)
+
+    def test_buckets_group_by_week_and_month(self):
+        now = timezone.now()
+        self.add_route(10.0, 30, date=now)
+        self.add_route(5.0, 30, date=now)
+        old = self.add_route(7.0, 30, date=now - timedelta(days=70))
+        week = StatsBucket.objects.get(
+            user=self.user, period=StatsBucket.WEEK,
+            start=stats.period_start(StatsBucket.WEEK, now))
+        self.assertEqual(week.route_count, 2)
+        self.assertAlmostEqual(week.distance, 15.0)
+        self.assertEqual(StatsBucket.objects.filter(
+            period=StatsBucket.MONTH).count(), 2)
+        old.delete()
+        self.assertEqual(StatsBucket.objects.filter(
+            period=StatsBucket.MONTH).count(), 1)
+
+    def test_rebuild_command_matches_incremental_stats(self):
+        self.add_route(10.0, 30)
+        self.add_route(3.0, 5, date=timezone.now() - timedelta(days=40))
+        expected = UserStats.objects.values().get(user=self.user)
+        buckets = set(StatsBucket.objects.values_list(
+            'period', 'start', 'route_count', 'distance'))
+        UserStats.objects.all().delete()
+        StatsBucket.objects.all().delete()
+        call_command('rebuild_user_stats', workers=1, stdout=io.StringIO())
+        rebuilt = UserStats.objects.values().get(user=self.user)
+        expected.pop('id')
+        rebuilt.pop('id')
+        self.assertEqual(rebuilt, expected)
+        self.assertEqual(set(StatsBucket.objects.values_list(
+            'period', 'start', 'route_count', 'distance')), buckets)
+
+    def test_stats_endpoint(self):
+        self.add_route(10.0, 30)
+        # start from a cold friend cache
+        cache.clear()
+        with self.assertNumQueries(6):
+            response = self.client.get(
+                '/api/user/{}/stats/'.format(self.user.pk))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['route_count'], 1)
+        self.assertEqual(response.data['total_duration'], '00:30:00')
+        self.assertEqual(len(response.data['weekly']), 1)
+
+    def test_stats_of_strangers_are_hidden(self):
+        stranger = User.objects.create_user('stranger')
+        response = self.client.get('/api/user/{}/stats/'.format(stranger.pk))
+        self.assertEqual(response.status_code, 404)
+
+    def test_profile_page_reads_stats_record(self):
+        self.add_route(10.0, 30)
+        self.client.force_login(self.user)
+        response = self.client.get('/user/{}/'.format(self.user.pk))
+        self.assertContains(response, 'Total distance: 10.0')
+
+
+class RouteMetricsTests(APITestBase):
+
+    def test_haversine_distance(self):
+        # one degree of latitude is ~111.2 km
+        result = metrics.compute_metrics([(52.0, 21.0), (53.0, 21.0)])
+        self.assertAlmostEqual(result['distance'], 111.19, places=1)
+        self.assertIsNone(result['moving_seconds'])
+
+    def test_times_give_speeds_splits_and_moving_time(self):
+        # 100 m every 20 s (18 km/h) for 3 km, with a 60 s stop halfway
+        step = 100 / 111195.0
+        points = [(52.0 + i * step, 21.0) for i in range(31)]
+        times = [i * 20.0 for i in range(31)]
+        points.insert(16, points[15])
+        times = times[:16] + [times[15] + 60] + [t + 60 for t in times[16:]]
+        result = metrics.compute_metrics(points, times)
+        self.assertAlmostEqual(result['distance'], 3.0, places=2)
+        self.assertAlmostEqual(result['elapsed_seconds'], 660.0)
+        self.assertAlmostEqual(result['moving_seconds'], 600.0)
+        self.assertAlmostEqual(result['average_speed'], 18.0, places=1)
+        self.assertAlmostEqual(result['max_speed'], 18.0, places=1)
+        self.assertEqual(len(result['splits']), 3)
+        self.assertAlmostEqual(result['splits'][0], 200.0, places=0)
+        self.assertAlmostEqual(result['splits'][1], 260.0, places=0)
+
+    def test_elevation_gain_ignores_descents(self):
+        elevations = [100.0] * 5 + [110.0] * 5 + [90.0] * 5 + [120.0] * 5
+        result = metrics.compute_metrics([(52.0, 21.0)] * 20,
+                                         elevations=elevations)
+        self.assertAlmostEqual(result['elevation_gain'], 40.0)
+
+    def test_upload_stores_metrics(self):
+        payload = make_payload(0)
+        payload['coords'] = [{'latitude': 52.0 + i * 0.001,
+                              'longitude': 21.0,
+                              'time': i * 10,
+                              'elevation': 100 + i}
+                             for i in range(50)]
+        route_id = self.post_route(payload).data['id']
+        stored = RouteMetrics.objects.get(route_id=route_id)
+        self.assertAlmostEqual(stored.distance, 5.45, places=1)
+        self.assertAlmostEqual(stored.elapsed_seconds, 490.0)
+        self.assertGreater(stored.elevation_gain, 40)
+        response = self.client.get('/api/route/{}/'.format(route_id))
+        self.assertEqual(len(response.data['metrics']['splits']), 5)
+
+    def test_iso_point_times_are_relative_to_route_date(self):
+        start = timezone.now()
+        payload = make_payload(2, date=start.isoformat())
+        payload['coords'][0]['time'] = start.isoformat()
+        payload['coords'][1]['time'] = \
+            (start + timedelta(seconds=30)).isoformat()
+        route_id = self.post_route(payload).data['id']
+        times, _ = metrics.route_series(Route.objects.get(pk=route_id))
+        self.assertEqual(list(times), [0.0, 30.0])
+
+    def test_partial_point_times_are_rejected(self):
+        payload = make_payload(3)
+        payload['coords'][0]['time'] = 0
+        self.assertEqual(self.post_route(payload).status_code, 400)
+
+
+class SpatialQueryTests(APITestBase):
+
+    def upload(self, points, user=None):
+        payload = make_payload(0)
+        payload['coords'] = [{'latitude': lat, 'longitude': lng}
+                             for lat, lng in points]
+        route = ingest.ingest_route(user or self.user, payload)
+        return route.pk
+
+    def setUp(self):
+        super().setUp()
+        # an L-shaped ride in Warsaw: north along 21.0, then east along 52.3
+        self.warsaw = self.upload(
+            [(52.2 + i * 0.001, 21.0) for i in range(101)]
+            + [(52.3, 21.0 + i * 0.001) for i in range(1, 101)])
+        self.krakow = self.upload([(50.06, 19.94), (50.07, 19.95)])
+
+    def ids(self, query):
+        response = self.client.get('/api/route/' + query)
+        self.assertEqual(response.status_code, 200)
+        return {item['id'] for item in response.data['results']}
+
+    def test_route_bounding_box_is_stored(self):
+        route = Route.objects.get(pk=self.warsaw)
+        box = (route.min_latitude, route.max_latitude,
+               route.min_longitude, route.max_longitude)
+        for value, expected in zip(box, (52.2, 52.3, 21.0, 21.1)):
+            self.assertAlmostEqual(value, expected)
+
+    def test_bbox_query(self):
+        self.assertEqual(self.ids('?bbox=20.99,52.24,21.01,52.26'),
+                         {self.warsaw})
+        self.assertEqual(self.ids('?bbox=19,50,22,53'),
+                         {self.warsaw, self.krakow})
+
+    def test_bbox_inside_route_box_but_off_track(self):
+        # south-east corner of the L's bounding box, which the ride avoids
+        self.assertEqual(self.ids('?bbox=21.07,52.2,21.09,52.22'), set())
+
+    def test_near_query(self):
+        self.assertEqual(self.ids('?near=50.065,19.945&radius=500'),
+                         {self.krakow})
+        self.assertEqual(self.ids('?near=50.2,19.945&radius=500'), set())
+
+    def test_area_queries_respect_friendship(self):
+        stranger = User.objects.create_user('stranger')
+        self.upload([(52.25, 21.0), (52.26, 21.0)], user=stranger)
+        self.assertEqual(self.ids('?bbox=20.99,52.24,21.01,52.26'),
+                         {self.warsaw})
+
+    def test_invalid_area_is_rejected(self):
+        for query in ['?bbox=1,2,3', '?bbox=22,52,21,53',
+                      '?near=52,21&radius=0', '?near=52&radius=10']:
+            response = self.client.get('/api/route/' + query)
+            self.assertEqual(response.status_code, 400, query)
+
+
+@override_settings(HEYROAD_PROCESS_ROUTES_INLINE=False)
+class RouteProcessingTests(APITestBase):
+
+    def test_upload_is_queued_not_processed(self):
+        response = self.post_route(make_payload(100))
+        self.assertEqual(response.data['processing'], RouteJob.PENDING)
+        route_id = response.data['id']
+        self.assertFalse(TrackLevel.objects.exists())
+        self.assertFalse(RouteMetrics.objects.exists())
+        response = self.client.get(
+            '/api/route/{}/processing/'.format(route_id))
+        self.assertEqual(response.data['status'], RouteJob.PENDING)
+
+        self.assertEqual(processing.run_pending(), 1)
+        self.assertTrue(TrackLevel.objects.filter(route=route_id).exists())
+        self.assertTrue(RouteMetrics.objects.filter(route=route_id).exists())
+        self.assertTrue(RouteCell.objects.filter(route=route_id).exists())
+        response = self.client.get('/api/route/{}/'.format(route_id))
+        self.assertEqual(response.data['processing'], RouteJob.DONE)
+
+    def test_failed_jobs_are_retried_with_backoff(self):
+        route_id = self.post_route(make_payload(10)).data['id']
+        with mock.patch.object(processing, 'STEPS', [mock.Mock(
+                side_effect=RuntimeError('boom'))]):
+            self.assertEqual(processing.run_pending(), 1)
+        job = RouteJob.objects.get(route=route_id)
+        self.assertEqual(job.status, RouteJob.PENDING)
+        self.assertEqual(job.attempts, 1)
+        self.assertIn('boom', job.error)
+        self.assertGreater(job.run_after, timezone.now())
+        # not runnable again until the backoff expires
+        self.assertIsNone(processing.claim_job())
+
+        RouteJob.objects.update(run_after=timezone.now(),
+                                attempts=processing.MAX_ATTEMPTS)
+        with mock.patch.object(processing, 'STEPS', [mock.Mock(
+                side_effect=RuntimeError('boom'))]):
+            processing.run_pending()
+        self.assertEqual(RouteJob.objects.get().status, RouteJob.FAILED)
+
+    def test_expired_lease_is_reclaimed(self):
+        self.post_route(make_payload(10))
+        job = processing.claim_job()
+        self.assertEqual(job.status, RouteJob.RUNNING)
+        self.assertIsNone(processing.claim_job())
+        RouteJob.objects.update(
+            locked_until=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(processing.claim_job().pk, job.pk)
+
+    def test_jobs_of_lost_workers_fail(self):
+        self.post_route(make_payload(10))
+        RouteJob.objects.update(
+            status=RouteJob.RUNNING, attempts=processing.MAX_ATTEMPTS,
+            locked_until=timezone.now() - timedelta(seconds=1))
+        self.assertIsNone(processing.claim_job())
+        job = RouteJob.objects.get()
+        self.assertEqual(job.status, RouteJob.FAILED)
+        self.assertIsNone(job.locked_until)
+        self.assertTrue(job.error)
+
+    def test_route_deleted_while_processing(self):
+        route_id = self.post_route(make_payload(10)).data['id']
+        self.post_route(make_payload(10))
+
+        def delete(route, *args):
+            Route.objects.filter(pk=route.pk).delete()
+
+        with mock.patch.object(processing, 'STEPS', [delete]):
+            job = processing.claim_job()
+            self.assertEqual(job.route_id, route_id)
+            processing.run_job(job)
+        self.assertFalse(RouteJob.objects.filter(route=route_id).exists())
+        # the worker goes on with the next job
+        self.assertEqual(processing.run_pending(), 1)
+
+    def test_route_deleted_while_claimed(self):
+        first = self.post_route(make_payload(10)).data['id']
+        second = self.post_route(make_payload(10)).data['id']
+        update = QuerySet.update
+
+        def update_then_delete(queryset, **kwargs):
+            count = update(queryset, **kwargs)
+            if kwargs.get('status') == RouteJob.RUNNING:
+                Route.objects.filter(pk=first).delete()
+            return count
+
+        with mock.patch.object(QuerySet, 'update', update_then_delete):
+            job = processing.claim_job()
+        self.assertEqual(job.route_id, second)
+
+    def test_worker_survives_errors(self):
+        out = io.StringIO()
+        with mock.patch.object(processing, 'claim_job', side_effect=[
+                RuntimeError('boom'), None]) as claim, \
+                self.assertLogs('heyroad.management.commands.process_routes',
+                                'ERROR'):
+            call_command('process_routes', workers=1, once=True, poll=0,
+                         stdout=out)
+        self.assertEqual(claim.call_count, 2)
+
+    def test_worker_command_drains_queue(self):
+        for _ in range(3):
+            self.post_route(make_payload(10))
+        out = io.StringIO()
+        call_command('process_routes', workers=1, once=True, stdout=out)
+        self.assertIn('Processed 3 routes', out.getvalue())
+        self.assertEqual(RouteJob.objects.filter(
+            status=RouteJob.DONE).count(), 3)
+
+    def test_processing_status_of_hidden_route_is_not_found(self):
+        stranger = User.objects.create_user('stranger')
+        route = ingest.ingest_route(stranger, make_payload(2))
+        response = self.client.get(
+            '/api/route/{}/processing/'.format(route.pk))
+        self.assertEqual(response.status_code, 404)
+
+
+class ConditionalGetTests(APITestBase):
+
+    def setUp(self):
+        super().setUp()
+        self.route_id = self.post_route(make_payload(50)).data['id']
+        self.url = '/api/route/{}/'.format(self.route_id)
+
+    def test_matching_etag_returns_304_without_serializing(self):
+        response = self.client.get(self.url)
+        etag = response['ETag']
+        self.assertTrue(response.has_header('Last-Modified'))
+        with mock.patch('heyroad.views.RouteDetailSerializer') as serializer:
+            response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+        serializer.assert_not_called()
+
+    def test_detail_levels_have_distinct_etags(self):
+        full = self.client.get(self.url)['ETag']
+        low = self.client.get(self.url, {'detail': 'low'})['ETag']
+        self.assertNotEqual(full, low)
+        response = self.client.get(self.url, {'detail': 'low'},
+                                   HTTP_IF_NONE_MATCH=full)
+        self.assertEqual(response.status_code, 200)
+
+    def test_formats_have_distinct_etags(self):
+        response = self.client.get('/api/user/{}/'.format(self.user.pk))
+        self.assertIn('Accept', response['Vary'])
+        for url in (self.url, '/api/route/'):
+            response = self.client.get(url)
+            self.assertIn('Accept', response['Vary'])
+            etag = response['ETag']
+            response = self.client.get(url, HTTP_ACCEPT='application/msgpack',
+                                       HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 200)
+            self.assertNotEqual(response['ETag'], etag)
+            self.assertEqual(response['Content-Type'], 'application/msgpack')
+            response = self.client.get(url, HTTP_ACCEPT='application/msgpack',
+                                       HTTP_IF_NONE_MATCH=response['ETag'])
+            self.assertEqual(response.status_code, 304)
+            self.assertIn('Accept', response['Vary'])
+
+    def test_comment_changes_etag_and_payload(self):
+        etag = self.client.get(self.url)['ETag']
+        self.client.post('/api/comment/',
+                         json.dumps({'route': self.route_id, 'text': 'hi'}),
+                         content_type='application/json')
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(len(json.loads(response.content)['comments']), 1)
+
+        Comment.objects.get().delete()
+        response = self.client.get(self.url)
+        self.assertEqual(json.loads(response.content)['comments'], [])
+
+    @override_settings(HEYROAD_PROCESS_ROUTES_INLINE=False)
+    def test_processing_changes_etag(self):
+        route_id = self.post_route(make_payload(50)).data['id']
+        url = '/api/route/{}/'.format(route_id)
+        response = self.client.get(url)
+        self.assertEqual(json.loads(response.content)['processing'],
+                         RouteJob.PENDING)
+        processing.run_pending()
+        response = self.client.get(url,
+                                   HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content)['processing'],
+                         RouteJob.DONE)
+
+    def test_payload_size_is_estimated_without_rendering(self):
+        data = self.client.get(self.url).json()
+        size = len(json.dumps(data, separators=(',', ':')))
+        estimate = caching.estimate_size(data)
+        self.assertLess(abs(estimate - size), size * 0.2)
+        caching.payload_cache.clear()
+        with mock.patch('rest_framework.renderers.JSONRenderer.render',
+                        side_effect=AssertionError) as render:
+            caching.cached_data('x', lambda: data)
+        render.assert_not_called()
+        self.assertEqual(caching.payload_cache.size, estimate)
+
+    def test_rendered_payload_is_cached(self):
+        first = self.client.get(self.url)
+        with mock.patch('heyroad.views.route_points') as points:
+            second = self.client.get(self.url)
+        points.assert_not_called()
+        self.assertEqual(first.content, second.content)
+
+    def test_listings_answer_304(self):
+        for url in ['/api/route/', '/api/comment/', '/api/friend/',
+                    '/api/user/{}/'.format(self.user.pk)]:
+            etag = self.client.get(url)['ETag']
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 304, url)
+
+        etag = self.client.get('/api/route/')['ETag']
+        self.post_route(make_payload(10))
+        response = self.client.get('/api/route/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+    def test_lru_evicts_least_recently_used_by_size(self):
+        lru = caching.LRUCache(max_bytes=10)
+        lru.set('a', b'1234')
+        lru.set('b', b'1234')
+        lru.get('a')
+        lru.set('c', b'1234')
+        self.assertIsNone(lru.get('b'))
+        self.assertEqual(lru.get('a'), b'1234')
+        self.assertEqual(lru.size, 8)
+        lru.set('huge', b'x' * 11)
+        self.assertIsNone(lru.get('huge'))
+
+    def test_lru_expires_entries(self):
+        lru = caching.LRUCache(max_entries=2, ttl=60)
+        lru.set('a', 1)
+        with mock.patch('heyroad.caching.time.monotonic',
+                        return_value=10 ** 9):
+            self.assertIsNone(lru.get('a'))
+        self.assertEqual(len(lru), 0)
+
+
+class ExportTests(APITestBase):
+
+    def setUp(self):
+        super().setUp()
+        payload = make_payload(30)
+        for i, coord in enumerate(payload['coords']):
+            coord['time'] = i * 2
+            coord['elevation'] = 100 + i
+        self.route_id = self.post_route(payload).data['id']
+
+    def read(self, response):
+        self.assertTrue(response.streaming)
+        return b''.join(response.streaming_content).decode('utf-8')
+
+    def test_route_gpx(self):
+        response = self.client.get(
+            '/api/route/{}/export/'.format(self.route_id))
+        self.assertEqual(response['Content-Disposition'],
+                         'attachment; filename="route-{}.gpx"'.format(
+                             self.route_id))
+        root = ElementTree.fromstring(self.read(response))
+        ns = {'gpx': 'http://www.topografix.com/GPX/1/1'}
+        points = root.findall('.//gpx:trkpt', ns)
+        self.assertEqual(len(points), 30)
+        self.assertEqual(points[1].get('lat'), '52.000100')
+        self.assertEqual(points[1].find('gpx:ele', ns).text, '101.0')
+        date = Route.objects.get(pk=self.route_id).date
+        self.assertEqual(points[1].find('gpx:time', ns).text,
+                         export._timestamp(date + timedelta(seconds=2)))
+
+    def test_route_geojson(self):
+        response = self.client.get(
+            '/api/route/{}/export/'.format(self.route_id), {'fmt': 'geojson'})
+        data = json.loads(self.read(response))
+        feature = data['features'][0]
+        self.assertEqual(feature['properties']['id'], self.route_id)
+        self.assertEqual(feature['geometry']['coordinates'][0],
+                         [21.0, 52.0, 100.0])
+
+    def test_account_csv_spans_routes_and_storages(self):
+        with override_settings(HEYROAD_ROUTE_STORAGE='rows'):
+            rows_id = self.post_route(make_payload(5)).data['id']
+        with mock.patch('heyroad.export.BUFFER_SIZE', 100):
+            response = self.client.get(
+                '/api/user/{}/export/'.format(self.user.pk), {'fmt': 'csv'})
+            chunks = list(response.streaming_content)
+        self.assertGreater(len(chunks), 1)
+        lines = b''.join(chunks).decode('utf-8').splitlines()
+        self.assertEqual(lines[0],
+                         'route,point,latitude,longitude,time,elevation')
+        self.assertEqual(len(lines), 1 + 30 + 5)
+        self.assertEqual(lines[-1].split(','),
+                         [str(rows_id), '4', '52.000400', '21.000400', '', ''])
+
+    def test_invalid_format_and_foreign_account(self):
+        response = self.client.get(
+            '/api/route/{}/export/'.format(self.route_id), {'fmt': 'kml'})
+        self.assertEqual(response.status_code, 400)
+        other = User.objects.create_user('other')
+        Friendship.objects.create(user1=self.user, user2=other,
+                                  is_accepted=True)
+        response = self.client.get('/api/user/{}/export/'.format(other.pk))
+        self.assertEqual(response.status_code, 401)
+
+
+GPX = '''<?xml version="1.0" encoding="UTF-8"?>
+<gpx version="1.1" creator="test" xmlns="http://www.topografix.com/GPX/1/1">
+<metadata><time>2020-05-01T08:00:00Z</time></metadata>
+<trk><name>Morning</name><trkseg>
+<trkpt lat="52.0" lon="21.0"><ele>100</ele>
+<time>2020-05-01T08:00:00Z</time></trkpt>
+<trkpt lat="52.01" lon="21.0"><ele>110</ele>
+<time>2020-05-01T08:05:00Z</time></trkpt>
+</trkseg><trkseg>
+<trkpt lat="52.02" lon="21.0"><ele>105</ele>
+<time>2020-05-01T08:10:00Z</time></trkpt>
+</trkseg></trk>
+<trk><trkseg>
+<trkpt lat="50.0" lon="19.0"/><trkpt lat="50.0" lon="19.01"/>
+</trkseg></trk>
+</gpx>
+'''
+
+GEOJSON = json.dumps({
+    'type': 'FeatureCollection',
+    'features': [{
+        'type': 'Feature',
+        'properties': {'coordTimes': ['2021-01-01T10:00:00Z',
+                                      '2021-01-01T10:01:00Z']},
+        'geometry': {'type': 'LineString',
+                     'coordinates': [[21.0, 52.0, 90], [21.0, 52.001, 95]]},
+    }],
+})
+
+
+class ImportTests(APITestBase):
+
+    def zip_bytes(self, files):
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, 'w') as archive:
+            for name, content in files.items():
+                archive.writestr(name, content)
+        return buffer.getvalue()
+
+    def test_parse_gpx_tracks(self):
+        first, second = importers.parse_gpx(io.BytesIO(GPX.encode()))
+        self.assertEqual(len(first['points']), 3)
+        self.assertEqual(first['times'], [0.0, 300.0, 600.0])
+        self.assertEqual(first['elevations'], [100.0, 110.0, 105.0])
+        self.assertEqual(first['duration'], timedelta(minutes=10))
+        self.assertAlmostEqual(first['distance'], 2.22, places=2)
+        # no point times: the date comes from the metadata
+        self.assertIsNone(second['times'])
+        self.assertEqual(second['date'], first['date'])
+
+    def test_parse_geojson(self):
+        route, = importers.parse_geojson(io.BytesIO(GEOJSON.encode()))
+        self.assertEqual(route['points'], [(52.0, 21.0), (52.001, 21.0)])
+        self.assertEqual(route['times'], [0.0, 60.0])
+        self.assertEqual(route['elevations'], [90.0, 95.0])
+
+    def test_non_finite_elevation_is_invalid(self):
+        with self.assertRaises(ingest.InvalidRoutePayload):
+            list(importers.parse_gpx(io.BytesIO(
+                GPX.replace('<ele>110</ele>', '<ele>NaN</ele>').encode())))
+
+    def test_malformed_geojson_is_invalid(self):
+        for data in (
+                {'type': 'LineString', 'coordinates': [{'a': 1}, {'a': 2}]},
+                {'type': 'MultiLineString', 'coordinates': [5]},
+                {'type': 'Feature', 'properties': [1],
+                 'geometry': {'type': 'LineString',
+                              'coordinates': [[21.0, 52.0]]}},
+                {'type': 'FeatureCollection', 'features': 5}):
+            upload = io.BytesIO(json.dumps(data).encode())
+            upload.name = 'ride.geojson'
+            ids, (error,) = importers.import_upload(self.user, upload)
+            self.assertEqual(ids, [])
+            self.assertEqual(error['file'], 'ride.geojson')
+            upload.seek(0)
+            response = self.client.post('/api/route/import/',
+                                        {'file': upload})
+            self.assertEqual(response.status_code, 400)
+
+    def test_upload_archive(self):
+        archive = io.BytesIO(self.zip_bytes({
+            'a.gpx': GPX, 'b.geojson': GEOJSON, 'c.gpx': '<gpx>',
+            'notes.txt': 'skipped'}))
+        archive.name = 'export.zip'
+        response = self.client.post('/api/route/import/', {'file': archive})
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(len(response.data['ids']), 3)
+        self.assertEqual([error['file'] for error in response.data['errors']],
+                         ['c.gpx'])
+        self.assertEqual(Route.objects.filter(user=self.user).count(), 3)
+        self.assertEqual(RouteJob.objects.count(), 3)
+        self.assertEqual(self.user.stats.route_count, 3)
+
+    def test_file_is_parsed_while_stored(self):
+        upload = io.BytesIO(GPX.encode())
+        upload.name = 'ride.gpx'
+        (name, routes), = importers.parse_upload(upload)
+        self.assertEqual(next(routes)['times'], [0.0, 300.0, 600.0])
+        self.assertEqual(len(list(routes)), 1)
+
+    def test_invalid_file_stores_nothing(self):
+        # the first track is valid, the file is not
+        upload = io.BytesIO(GPX.replace('</gpx>', '<trk>').encode())
+        upload.name = 'ride.gpx'
+        ids, (error,) = importers.import_upload(self.user, upload)
+        self.assertEqual(ids, [])
+        self.assertFalse(Route.objects.exists())
+
+    def test_oversized_uploads_are_refused(self):
+        files = {'a.gpx': GPX, 'b.gpx': GPX, 'c.gpx': GPX}
+        size = len(GPX.encode())
+        for limits in ({'HEYROAD_MAX_IMPORT_FILES': 2},
+                       {'HEYROAD_MAX_IMPORT_FILE_SIZE': size - 1},
+                       {'HEYROAD_MAX_IMPORT_SIZE': 3 * size - 1}):
+            archive = io.BytesIO(self.zip_bytes(files))
+            archive.name = 'export.zip'
+            with self.settings(**limits):
+                response = self.client.post('/api/route/import/',
+                                            {'file': archive})
+            self.assertEqual(response.status_code, 413)
+            self.assertEqual(response.data['result'],
+                             'failed_import_too_large')
+        upload = io.BytesIO(GPX.encode())
+        upload.name = 'ride.gpx'
+        with self.settings(HEYROAD_MAX_IMPORT_FILE_SIZE=size - 1):
+            response = self.client.post('/api/route/import/',
+                                        {'file': upload})
+        self.assertEqual(response.status_code, 413)
+        self.assertFalse(Route.objects.exists())
+
+    def test_reading_is_capped(self):
+        reader = importers.LimitedReader(io.BytesIO(b'x' * 10), 8)
+        self.assertEqual(reader.read(4), b'xxxx')
+        with self.assertRaises(importers.ImportTooLarge):
+            reader.read()
+
+    def test_upload_without_valid_files(self):
+        response = self.client.post('/api/route/import/', {})
+        self.assertEqual(response.status_code, 400)
+        upload = io.BytesIO(b'not xml')
+        upload.name = 'ride.gpx'
+        response = self.client.post('/api/route/import/', {'file': upload})
+        self.assertEqual(response.data['result'], 'failed_invalid_payload')
+
+    def test_command_imports_directory_with_pool(self):
+        with tempfile.TemporaryDirectory() as directory:
+            with open(os.path.join(directory, 'a.gpx'), 'w') as f:
+                f.write(GPX)
+            with open(os.path.join(directory, 'rides.zip'), 'wb') as f:
+                f.write(self.zip_bytes({'b.geojson': GEOJSON,
+                                        'c.gpx': GPX}))
+            out, err = io.StringIO(), io.StringIO()
+            call_command('import_routes', 'rider', directory, workers=2,
+                         batch_size=2, stdout=out, stderr=err)
+        self.assertIn('Imported 5 routes, 0 files failed.', out.getvalue())
+        self.assertEqual(Route.objects.filter(user=self.user).count(), 5)
+
+
+class CoordsFormatTests(APITestBase):
+
+    def setUp(self):
+        super().setUp()
+        self.route_id = self.post_route(make_payload(20)).data['id']
+        self.url = '/api/route/{}/'.format(self.route_id)
+
+    def test_polyline_reference_example(self):
+        points = [(38.5, -120.2), (40.7, -120.95), (43.252, -126.453)]
+        encoded = polyline.encode(points)
+        self.assertEqual(encoded, '_p~iF~ps|U_ulLnnqC_mqNvxq`@')
+        self.assertEqual(polyline.decode(encoded), points)
+        with self.assertRaises(ValueError):
+            polyline.decode('_p~iF~ps|U_')
+
+    def test_default_shape_is_unchanged(self):
+        coords = self.client.get(self.url).data['coords']
+        self.assertEqual(coords[1], {'latitude': 52.0001,
+                                     'longitude': 21.0001})
+
+    def test_array_coords(self):
+        response = self.client.get(self.url, {'coords': 'arrays'})
+        coords = json.loads(response.content)['coords']
+        self.assertEqual(coords[1], [52.0001, 21.0001])
+        self.assertEqual(len(coords), 20)
+
+    def test_polyline_format(self):
+        expected = [(52.0 + i * 0.0001, 21.0 + i * 0.0001)
+                    for i in range(20)]
+        for response in [
+                self.client.get(self.url, {'format': 'polyline'}),
+                self.client.get(self.url, HTTP_ACCEPT=
+                                'application/vnd.heyroad.polyline+json')]:
+            self.assertEqual(response['Content-Type'],
+                             'application/vnd.heyroad.polyline+json')
+            coords = polyline.decode(json.loads(response.content)['coords'])
+            for point, (latitude, longitude) in zip(coords, expected):
+                self.assertAlmostEqual(point[0], latitude, places=5)
+                self.assertAlmostEqual(point[1], longitude, places=5)
+        plain = self.client.get(self.url)['ETag']
+        encoded = self.client.get(self.url, {'format': 'polyline'})['ETag']
+        self.assertNotEqual(plain, encoded)
+
+    def test_invalid_coords_format(self):
+        response = self.client.get(self.url, {'coords': 'wkt'})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data['result'], 'failed_invalid_coords')
+
+
+class WireFormatTests(APITestBase):
+
+    def setUp(self):
+        super().setUp()
+        self.points = [(52.0 + i * 0.00013, 21.0 - i * 0.00007)
+                       for i in range(50)]
+
+    def compact_payload(self, **kwargs):
+        return make_payload(0, coords=polyline.encode(self.points),
+                            times=list(range(50)), **kwargs)
+
+    def assertStoredPoints(self, route_id):
+        stored = Route.objects.get(pk=route_id).get_points()
+        self.assertEqual(len(stored), len(self.points))
+        for point, expected in zip(stored, self.points):
+            self.assertAlmostEqual(point[0], expected[0], places=5)
+            self.assertAlmostEqual(point[1], expected[1], places=5)
+
+    def test_polyline_upload(self):
+        response = self.client.post(
+            '/api/route/', json.dumps(self.compact_payload()),
+            content_type='application/vnd.heyroad.polyline+json')
+        self.assertEqual(response.status_code, 201)
+        self.assertStoredPoints(response.data['id'])
+        times, _ = metrics.route_series(
+            Route.objects.get(pk=response.data['id']))
+        self.assertEqual(list(times), list(range(50)))
+
+    def test_polyline_upload_validates_series(self):
+        payload = self.compact_payload()
+        payload['times'] = [0, 1]
+        response = self.client.post(
+            '/api/route/', json.dumps(payload),
+            content_type='application/vnd.heyroad.polyline+json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data['result'], 'failed_invalid_payload')
+
+    def test_msgpack_round_trip(self):
+        response = self.client.post(
+            '/api/route/', msgpack.packb(self.compact_payload()),
+            content_type='application/msgpack')
+        self.assertEqual(response.status_code, 201)
+        route_id = response.data['id']
+        self.assertStoredPoints(route_id)
+
+        response = self.client.get('/api/route/{}/'.format(route_id),
+                                   {'coords': 'arrays'},
+                                   HTTP_ACCEPT='application/msgpack')
+        self.assertEqual(response['Content-Type'], 'application/msgpack')
+        data = msgpack.unpackb(response.content, raw=False)
+        self.assertEqual(data['id'], route_id)
+        self.assertEqual(len(data['coords']), 50)
+
+    def test_gzip_request_and_response(self):
+        body = gzip.compress(json.dumps(make_payload(200)).encode())
+        response = self.client.post('/api/route/', body,
+                                    content_type='application/json',
+                                    HTTP_CONTENT_ENCODING='gzip')
+        self.assertEqual(response.status_code, 201)
+        url = '/api/route/{}/'.format(response.data['id'])
+
+        response = self.client.get(url, HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        data = json.loads(gzip.decompress(response.content))
+        self.assertEqual(len(data['coords']), 200)
+
+    def test_bad_gzip_bodies(self):
+        response = self.client.post('/api/route/', b'not gzip',
+                                    content_type='application/json',
+                                    HTTP_CONTENT_ENCODING='gzip')
+        self.assertEqual(response.status_code, 400)
+        body = gzip.compress(b' ' * 5000)
+        with self.settings(HEYROAD_MAX_INFLATED_BODY=1000):
+            response = self.client.post('/api/route/', body,
+                                        content_type='application/json',
+                                        HTTP_CONTENT_ENCODING='gzip')
+        self.assertEqual(response.status_code, 413)
+
+    def test_json_without_content_type_still_accepted(self):
+        response = self.client.post('/api/route/',
+                                    json.dumps(make_payload(5)),
+                                    content_type='text/plain')
+        self.assertEqual(response.status_code, 201)
+
+
+class TimelineTests(APITestBase):
+
+    def setUp(self):
+        super().setUp()
+        self.friend = User.objects.create_user('friend')
+        self.stranger = User.objects.create_user('stranger')
+        Friendship.objects.create(user1=self.user, user2=self.friend,
+                                  is_accepted=True)
+
+    def add_route(self, user, minutes_ago=0):
+        return Route.objects.create(
+            user=user, distance=1.0,
+            date=timezone.now() - timedelta(minutes=minutes_ago))
+
+    def entries(self, user):
+        return list(TimelineEntry.objects.filter(owner=user)
+                    .values_list('kind', 'object_id'))
+
+    def test_route_fans_out_to_friends(self):
+        route = self.add_route(self.friend)
+        self.add_route(self.stranger)
+        self.assertEqual(self.entries(self.user), [('route', route.pk)])
+        self.assertEqual(self.entries(self.friend), [('route', route.pk)])
+
+    def test_comment_reaches_friends_of_both(self):
+        route = self.add_route(self.user)
+        comment = Comment.objects.create(user=self.friend, route=route,
+                                         text='nice')
+        self.assertIn(('comment', comment.pk), self.entries(self.user))
+        self.assertIn(('comment', comment.pk), self.entries(self.friend))
+        self.assertEqual(self.entries(self.stranger), [])
+
+    def test_friendship_changes_update_timelines(self):
+        route = self.add_route(self.stranger)
+        friendship = Friendship.objects.create(
+            user1=self.stranger, user2=self.user, is_accepted=False)
+        self.assertEqual(self.entries(self.user), [])
+        friendship.is_accepted = True
+        friendship.save()
+        self.assertEqual(self.entries(self.user), [('route', route.pk)])
+        friendship.delete()
+        self.assertEqual(self.entries(self.user), [])
+
+    @override_settings(HEYROAD_TIMELINE_LENGTH=5)
+    def test_timelines_are_trimmed(self):
+        with mock.patch('heyroad.timeline.TRIM_SLACK', 2):
+            routes = [self.add_route(self.user, minutes_ago=i)
+                      for i in range(8)]
+        # trimmed back to 5 once 8 entries exceeded 5 + 2
+        self.assertEqual(self.entries(self.user),
+                         [('route', route.pk) for route in routes[:5]])
+
+    def test_rebuild_command_repairs_timelines(self):
+        routes = [self.add_route(self.friend, minutes_ago=i)
+                  for i in range(3)]
+        TimelineEntry.objects.filter(owner=self.user,
+                                     object_id=routes[1].pk).delete()
+        TimelineEntry.objects.create(owner=self.user, kind='route',
+                                     object_id=999, actor=self.stranger,
+                                     route=self.add_route(self.stranger),
+                                     date=timezone.now())
+        out = io.StringIO()
+        call_command('rebuild_timelines', dry_run=True, stdout=out)
+        self.assertIn('Would add 1 and remove 1 entries', out.getvalue())
+        call_command('rebuild_timelines', stdout=io.StringIO())
+        self.assertEqual(self.entries(self.user),
+                         [('route', route.pk) for route in routes])
+
+    def test_feed_endpoint_and_home_page(self):
+        route = self.add_route(self.friend, minutes_ago=10)
+        Comment.objects.create(user=self.friend, route=route, text='ok',
+                               date=timezone.now() - timedelta(minutes=5))
+        for i in range(3):
+            self.add_route(self.user, minutes_ago=i)
+        # token and one joined range read
+        with self.assertNumQueries(2):
+            response = self.client.get('/api/feed/')
+        kinds = [entry['kind'] for entry in response.data['results']]
+        self.assertEqual(kinds, ['route'] * 3 + ['comment', 'route'])
+        self.assertEqual(response.data['results'][3]['comment']['text'],
+                         'ok')
+
+        self.client.force_login(self.user)
+        response = self.client.get('/')
+        self.assertContains(response, 'commented on')
+
+
+class InstrumentationTests(APITestBase):
+
+    def test_server_timing_header(self):
+        response = self.client.get('/api/route/')
+        self.assertRegex(response['Server-Timing'],
+                         r'^db;dur=[\d.]+;desc="\d+ queries", '
+                         r'serialize;dur=[\d.]+, render;dur=[\d.]+, '
+                         r'template;dur=[\d.]+, app;dur=[\d.]+, '
+                         r'total;dur=[\d.]+$')
+
+    def test_requests_are_recorded_per_view(self):
+        histogram = instrumentation.request_seconds
+        before = histogram.count(view='RouteViewSet.list', method='GET')
+        self.client.get('/api/route/')
+        self.assertEqual(
+            histogram.count(view='RouteViewSet.list', method='GET'),
+            before + 1)
+
+        self.client.force_login(self.user)
+        before = instrumentation.render_seconds.count(view='RouteList')
+        self.client.get('/')
+        self.assertEqual(instrumentation.render_seconds.count(
+            view='RouteList'), before + 1)
+
+    def test_phases_are_timed_separately(self):
+        Route.objects.create(user=self.user, distance=1.0)
+        with mock.patch.object(instrumentation.serialize_seconds,
+                               'observe') as serialize, \
+                mock.patch.object(instrumentation.template_seconds,
+                                  'observe') as template:
+            self.client.get('/api/route/')
+            self.client.force_login(self.user)
+            # rendered with the render() shortcut
+            self.client.get('/friends/')
+        self.assertGreater(serialize.call_args_list[0][0][0], 0)
+        self.assertEqual(template.call_args_list[0][0][0], 0)
+        self.assertEqual(template.call_args_list[1][1],
+                         {'view': 'FriendView'})
+        self.assertGreater(template.call_args_list[1][0][0], 0)
+
+    def test_nested_phases_count_once(self):
+        phases = instrumentation.Phases()
+        with phases.phase(instrumentation.SERIALIZE):
+            with phases.phase(instrumentation.DB):
+                time.sleep(0.2)
+            with phases.phase(instrumentation.SERIALIZE):
+                time.sleep(0.01)
+        self.assertGreaterEqual(phases.seconds[instrumentation.DB], 0.2)
+        self.assertGreaterEqual(phases.seconds[instrumentation.SERIALIZE],
+                                0.01)
+        # the database time is not counted again
+        self.assertLess(phases.seconds[instrumentation.SERIALIZE], 0.2)
+
+    def test_metrics_endpoint_is_staff_only(self):
+        response = self.client.get('/metrics/')
+        self.assertEqual(response.status_code, 403)
+        self.user.is_staff = True
+        self.user.save()
+        self.client.get('/api/route/')
+        response = self.client.get('/metrics/')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain'))
+        self.assertIn('heyroad_request_db_queries_bucket{'
+                      'view="RouteViewSet.list",le="',
+                      response.content.decode())
+
+    def test_histogram_text_format(self):
+        registry = instrumentation.Registry()
+        histogram = registry.histogram('test_seconds', 'Test.',
+                                       labels=('view',), buckets=(1, 5))
+        histogram.observe(0.5, view='a')
+        histogram.observe(3, view='a')
+        registry.counter('test_total', 'Test.').inc()
+        self.assertEqual(registry.render(), '\n'.join([
+            '# HELP test_seconds Test.',
+            '# TYPE test_seconds histogram',
+            'test_seconds_bucket{view="a",le="1"} 1',
+            'test_seconds_bucket{view="a",le="5"} 2',
+            'test_seconds_bucket{view="a",le="+Inf"} 2',
+            'test_seconds_sum{view="a"} 3.5',
+            'test_seconds_count{view="a"} 2',
+            '# HELP test_total Test.',
+            '# TYPE test_total counter',
+            'test_total 1',
+        ]) + '\n')
+
+
+class BenchmarkTests(TestCase):
+
+    def test_power_law_edges(self):
+        edges = power_law_edges(300, 2, random.Random(1))
+        self.assertEqual(edges, power_law_edges(300, 2, random.Random(1)))
+        self.assertEqual(len(edges), (300 - 2) * 2)
+        degrees = {}
+        for a, b in edges:
+            self.assertLess(a, b)
+            degrees[a] = degrees.get(a, 0) + 1
+            degrees[b] = degrees.get(b, 0) + 1
+        # a few hubs, most users at the minimum degree
+        self.assertGreater(max(degrees.values()), 20)
+        self.assertLess(sorted(degrees.values())[150], 5)
+
+    @override_settings(HEYROAD_PROCESS_ROUTES_INLINE=True)
+    def test_seed_and_bench(self):
+        out = io.StringIO()
+        call_command('seed_data', users=8, friends=2, routes=2, points=20,
+                     comments=1, stdout=out)
+        self.assertIn('Created 8 users, 12 friendships', out.getvalue())
+        self.assertEqual(User.objects.filter(
+            username__startswith='seed-').count(), 8)
+        self.assertTrue(Route.objects.exists())
+        self.assertTrue(TimelineEntry.objects.exists())
+
+        with tempfile.TemporaryDirectory() as directory:
+            baseline = os.path.join(directory, 'baseline.json')
+            out = io.StringIO()
+            call_command('bench_web', requests=3, warmup=1,
+                         save_baseline=baseline, stdout=out)
+            self.assertIn('api-routes', out.getvalue())
+            with open(baseline) as f:
+                results = json.load(f)
+            self.assertEqual(set(results), {'api-routes', 'api-users',
+                                            'home', 'route', 'friends'})
+
+            results['home']['queries'] = 0
+            with open(baseline, 'w') as f:
+                json.dump(results, f)
+            with self.assertRaisesMessage(CommandError, 'home: '):
+                call_command('bench_web', requests=3, warmup=1,
+                             compare=baseline, tolerance=100,
+                             stdout=io.StringIO())
+
+
+class QueryBudgetTests(APITestBase):
+    """
+    Every view runs a fixed number of queries, however much it shows.
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.route_pk = self.post_route(make_payload(50)).data['id']
+        self.web = APIClient()
+        self.web.force_login(self.user)
+        self.friends = 0
+
+    def grow(self, count):
+        for _ in range(count):
+            self.friends += 1
+            friend = User.objects.create_user('friend{}'.format(self.friends))
+            stranger = User.objects.create_user(
+                'stranger{}'.format(self.friends))
+            Friendship.objects.create(user1=self.user, user2=friend,
+                                      is_accepted=True)
+            Friendship.objects.create(user1=stranger, user2=self.user)
+            route = Route.objects.create(user=friend, distance=1.0)
+            for text in ('Nice', 'Thanks'):
+                Comment.objects.create(user=friend, route_id=self.route_pk,
+                                       date=timezone.now(), text=text)
+                Comment.objects.create(user=self.user, route=route,
+                                       date=timezone.now(), text=text)
+            ingest.write_route(self.user, 1.0, timezone.now(),
+                               timedelta(minutes=5), [(52.0, 21.0)] * 3)
+
+    def assertBudget(self, path, queries, client=None):
+        client = client or self.client
+        for size in (1, 6):
+            self.grow(size)
+            cache.clear()
+            caching.payload_cache.clear()
+            authentication.token_cache.clear()
+            with self.assertNumQueries(queries):
+                response = client.get(path)
+            self.assertEqual(response.status_code, 200)
+            if hasattr(response, 'render'):
+                response.render()
+
+    def test_home(self):
+        self.assertBudget('/', 3, self.web)
+
+    def test_user_detail(self):
+        self.assertBudget('/user/{}/'.format(self.user.pk), 5, self.web)
+
+    def test_route_detail(self):
+        self.assertBudget('/route/{}/'.format(self.route_pk), 4, self.web)
+
+    def test_route_delete(self):
+        self.assertBudget('/route/{}/delete/'.format(self.route_pk), 3,
+                          self.web)
+
+    def test_friends(self):
+        self.assertBudget('/friends/', 4, self.web)
+
+    def test_api_routes(self):
+        self.assertBudget('/api/route/', 3)
+
+    def test_api_route_detail(self):
+        self.assertBudget('/api/route/{}/'.format(self.route_pk), 5)
+
+    def test_api_users(self):
+        self.assertBudget('/api/user/', 3)
+
+    def test_api_user_detail(self):
+        self.assertBudget('/api/user/{}/'.format(self.user.pk), 5)
+
+    def test_api_user_stats(self):
+        self.assertBudget('/api/user/{}/stats/'.format(self.user.pk), 6)
+
+    def test_api_friends(self):
+        self.assertBudget('/api/friend/', 2)
+
+    def test_api_comments(self):
+        self.assertBudget('/api/comment/', 3)
+
+    def test_api_feed(self):
+        self.assertBudget('/api/feed/', 2)
+
+
+class BatchUploadTests(APITestBase):
+
+    def post_batch(self, routes):
+        return self.client.post('/api/route/batch/',
+                                json.dumps({'routes': routes}),
+                                content_type='application/json')
+
+    def test_batch_creates_routes(self):
+        response = self.post_batch([make_payload(5, key='a'),
+                                    make_payload(3, key='b')])
+        self.assertEqual(response.status_code, 200)
+        results = response.data['routes']
+        self.assertEqual([item['result'] for item in results],
+                         ['created', 'created'])
+        self.assertEqual(Route.objects.get(pk=results[0]['id'])
+                         .get_points(), [(52.0 + i * 0.0001,
+                                          21.0 + i * 0.0001)
+                                         for i in range(5)])
+        self.assertEqual(UploadKey.objects.filter(user=self.user).count(),
+                         2)
+
+    def test_retried_batch_is_a_no_op(self):
+        routes = [make_payload(5, key='a'), make_payload(5, key='b')]
+        first = self.post_batch(routes).data['routes']
+        # one key lookup and the savepoint around it
+        with self.assertNumQueries(3):
+            second = self.post_batch(routes).data['routes']
+        self.assertEqual([item['result'] for item in second],
+                         ['duplicate', 'duplicate'])
+        self.assertEqual([item['id'] for item in second],
+                         [item['id'] for item in first])
+        self.assertEqual(Route.objects.count(), 2)
+
+    def test_keys_are_per_user(self):
+        self.post_batch([make_payload(5, key='a')])
+        other = User.objects.create_user('other')
+        self.client.force_authenticate(other)
+        results = self.post_batch([make_payload(5, key='a')]).data['routes']
+        self.assertEqual(results[0]['result'], 'created')
+
+    def test_duplicate_key_in_one_batch(self):
+        results = self.post_batch([make_payload(5, key='a'),
+                                   make_payload(5, key='a')]).data['routes']
+        self.assertEqual([item['result'] for item in results],
+                         ['created', 'duplicate'])
+        self.assertEqual(Route.objects.count(), 1)
+
+    def test_invalid_items_do_not_undo_others(self):
+        results = self.post_batch([
+            make_payload(5, key='a'),
+            make_payload(5, key='b', distance=-1),
+            make_payload(5),
+        ]).data['routes']
+        self.assertEqual([item['result'] for item in results],
+                         ['created', 'failed_invalid_payload',
+                          'failed_invalid_key'])
+        self.assertEqual(Route.objects.count(), 1)
+        # the failed item may be retried with the same key
+        results = self.post_batch([make_payload(5, key='b')]).data['routes']
+        self.assertEqual(results[0]['result'], 'created')
+
+    def test_deleted_route_is_not_uploaded_again(self):
+        results = self.post_batch([make_payload(5, key='a')]).data['routes']
+        Route.objects.filter(pk=results[0]['id']).delete()
+        results = self.post_batch([make_payload(5, key='a')]).data['routes']
+        self.assertEqual(results[0], {'key': 'a', 'result': 'duplicate',
+                                      'id': None})
+        self.assertFalse(Route.objects.exists())
+
+    def test_refused_route_is_not_a_duplicate(self):
+        with mock.patch.object(ingest, 'store_route', side_effect=[
+                IntegrityError('NOT NULL constraint failed')]):
+            results = self.post_batch(
+                [make_payload(5, key='a')]).data['routes']
+        self.assertEqual(results[0]['result'], 'failed_invalid_payload')
+        self.assertFalse(UploadKey.objects.exists())
+        results = self.post_batch([make_payload(5, key='a')]).data['routes']
+        self.assertEqual(results[0]['result'], 'created')
+
+    @override_settings(HEYROAD_MAX_BATCH_ROUTES=2)
+    def test_invalid_batches(self):
+        response = self.post_batch([])
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data['result'], 'failed_invalid_payload')
+        response = self.post_batch([make_payload(1, key=str(i))
+                                    for i in range(3)])
+        self.assertEqual(response.status_code, 413)
+        self.assertEqual(response.data['result'], 'failed_batch_too_large')
+
+
+
+def make_chunk(size, start=0, **kwargs):
+    coords = [{'latitude': 52.0 + i * 0.0001, 'longitude': 21.0,
+               'time': float(i)}
+              for i in range(start, start + size)]
+    chunk = {'coords': coords}
+    chunk.update(kwargs)
+    return chunk
+
+
+class LiveTrackingTests(APITestBase):
+
+    def setUp(self):
+        super().setUp()
+        self.friend = User.objects.create_user('friend')
+        Friendship.objects.create(user1=self.user, user2=self.friend,
+                                  is_accepted=True)
+        self.watcher = APIClient()
+        self.watcher.force_authenticate(self.friend)
+        response = self.client.post('/api/live/')
+        self.assertEqual(response.status_code, 201)
+        self.pk = response.data['id']
+
+    def append(self, chunk):
+        return self.client.post('/api/live/{}/append/'.format(self.pk),
+                                json.dumps(chunk),
+                                content_type='application/json')
+
+    def test_append_and_finish(self):
+        self.assertEqual(self.append(make_chunk(3, seq=1)).data,
+                         {'result': 'success', 'seq': 1})
+        self.assertEqual(self.append(make_chunk(2, 3, seq=2)).data['seq'],
+                         2)
+        response = self.client.post('/api/live/{}/finish/'.format(self.pk))
+        self.assertEqual(response.status_code, 201)
+        route = Route.objects.get(pk=response.data['id'])
+        self.assertEqual(len(route.get_points()), 5)
+        self.assertEqual(route.duration, timedelta(seconds=4))
+        self.assertEqual(list(metrics.route_series(route)[0]),
+                         [0.0, 1.0, 2.0, 3.0, 4.0])
+        self.assertAlmostEqual(route.distance, 4 * 0.0111, places=3)
+        self.assertFalse(LiveChunk.objects.exists())
+        self.assertEqual(LiveRoute.objects.get(pk=self.pk).route, route)
+
+        # a retried finish returns the same route
+        response = self.client.post('/api/live/{}/finish/'.format(self.pk))
+        self.assertEqual(response.data, {'result': 'duplicate',
+                                         'id': route.pk})
+        self.assertEqual(self.append(make_chunk(1)).status_code, 409)
+
+    def test_finish_rejects_non_finite_distance(self):
+        self.append(make_chunk(3))
+        response = self.client.post('/api/live/{}/finish/'.format(self.pk),
+                                    {'distance': 'nan'}, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Route.objects.exists())
+
+    def test_retried_chunk_is_not_stored_twice(self):
+        self.append(make_chunk(3, seq=1))
+        self.assertEqual(self.append(make_chunk(3, seq=1)).data,
+                         {'result': 'duplicate', 'seq': 1})
+        response = self.append(make_chunk(3, seq=3))
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(LiveChunk.objects.count(), 1)
+
+    def test_only_the_rider_appends(self):
+        response = self.watcher.post(
+            '/api/live/{}/append/'.format(self.pk),
+            json.dumps(make_chunk(1)), content_type='application/json')
+        self.assertEqual(response.status_code, 404)
+
+    def test_friends_long_poll(self):
+        self.append(make_chunk(3))
+        self.append(make_chunk(2, 3))
+        response = self.watcher.get('/api/live/{}/'.format(self.pk))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([chunk['seq'] for chunk in response.data['chunks']],
+                         [1, 2])
+        self.assertEqual(response.data['chunks'][1]['times'], [3.0, 4.0])
+        response = self.watcher.get('/api/live/{}/?after=2'.format(self.pk))
+        self.assertEqual(response.data['chunks'], [])
+        self.assertFalse(response.data['finished'])
+
+        response = self.watcher.get('/api/live/')
+        self.assertEqual([ride['id'] for ride in response.data], [self.pk])
+
+        self.watcher.force_authenticate(User.objects.create_user('other'))
+        response = self.watcher.get('/api/live/{}/'.format(self.pk))
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(self.watcher.get('/api/live/').data, [])
+
+    def test_invalid_long_poll_params(self):
+        for query in ('timeout=nan', 'timeout=inf', 'timeout=-inf',
+                      'timeout=soon', 'after=-1'):
+            response = self.watcher.get(
+                '/api/live/{}/?{}'.format(self.pk, query))
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(response.data['result'],
+                             'failed_invalid_params')
+        with self.assertRaises(ValueError):
+            live.HUB.wait(self.pk, timeout=float('nan'))
+
+    @override_settings(HEYROAD_LIVE_STREAM_SECONDS=0.05)
+    def test_event_stream(self):
+        self.append(make_chunk(3))
+        self.append(make_chunk(2, 3))
+        response = self.watcher.get('/api/live/{}/events/'.format(self.pk),
+                                    HTTP_ACCEPT='text/event-stream',
+                                    HTTP_ACCEPT_ENCODING='gzip',
+                                    HTTP_LAST_EVENT_ID='1')
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        self.assertFalse(response.has_header('Content-Encoding'))
+        body = b''.join(response.streaming_content).decode()
+        self.assertTrue(body.startswith('id: 2\nevent: chunk\ndata: '))
+        self.assertNotIn('id: 1\n', body)
+        self.assertTrue(body.endswith(': keepalive\n\n'))
+
+    def test_discard(self):
+        self.append(make_chunk(3))
+        response = self.client.delete('/api/live/{}/'.format(self.pk))
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(LiveRoute.objects.exists())
+        self.assertFalse(LiveChunk.objects.exists())
+
+
+@override_settings(HEYROAD_LIVE_POLL_INTERVAL=60)
+class LiveHubTests(TransactionTestCase):
+
+    def setUp(self):
+        cache.clear()
+        live.HUB.clear()
+        self.user = User.objects.create_user('rider')
+        self.ride = live.start(self.user)
+
+    def test_watchers_share_reads(self):
+        reads = live.HUB.reads
+        for _ in range(5):
+            state = live.HUB.wait(self.ride.pk)
+        self.assertEqual(state['seq'], 0)
+        self.assertEqual(live.HUB.reads, reads + 1)
+
+        # appends of this process are pushed, not read back
+        live.append(self.ride, make_chunk(3))
+        with self.assertNumQueries(0):
+            state = live.HUB.wait(self.ride.pk)
+        self.assertEqual([chunk['seq'] for chunk in state['chunks']], [1])
+        self.assertEqual(live.HUB.reads, reads + 1)
+
+    def test_waiting_watcher_is_woken(self):
+        live.HUB.wait(self.ride.pk)
+        results = []
+        watcher = threading.Thread(target=lambda: results.append(
+            live.HUB.wait(self.ride.pk, 0, timeout=10)))
+        watcher.start()
+        live.append(self.ride, make_chunk(3))
+        watcher.join(5)
+        self.assertFalse(watcher.is_alive())
+        self.assertEqual(results[0]['seq'], 1)
+
+    def test_finish_is_seen(self):
+        live.HUB.wait(self.ride.pk)
+        live.append(self.ride, make_chunk(3))
+        route = live.finish(self.ride)
+        state = live.HUB.wait(self.ride.pk, 1)
+        self.assertTrue(state['finished'])
+        self.assertEqual(state['route'], route.pk)
+        # nothing of the ride is left in memory
+        self.assertEqual(live.HUB.wait(self.ride.pk)['chunks'], [])
+        self.assertEqual(live.HUB._channel(self.ride.pk).chunks, [])
+
+    @override_settings(HEYROAD_LIVE_CHUNKS_KEPT=2)
+    def test_watchers_behind_read_the_database(self):
+        live.HUB.wait(self.ride.pk)
+        for seq in range(1, 6):
+            live.append(self.ride, make_chunk(1, seq, seq=seq))
+        self.assertEqual([chunk['seq'] for chunk in
+                          live.HUB._channel(self.ride.pk).chunks], [4, 5])
+        with self.assertNumQueries(0):
+            state = live.HUB.wait(self.ride.pk, 3)
+        self.assertEqual([chunk['seq'] for chunk in state['chunks']], [4, 5])
+        with self.assertNumQueries(1):
+            state = live.HUB.wait(self.ride.pk, 0)
+        self.assertEqual([chunk['seq'] for chunk in state['chunks']], [1, 2])
+        self.assertEqual(state['seq'], 2)
+        state = live.HUB.wait(self.ride.pk, state['seq'])
+        self.assertEqual([chunk['seq'] for chunk in state['chunks']], [3, 4])
+
+
+class SyncTests(APITestBase):
+
+    def setUp(self):
+        super().setUp()
+        self.friend = User.objects.create_user('friend')
+        self.friendship = Friendship.objects.create(
+            user1=self.user, user2=self.friend, is_accepted=True)
+        self.route = Route.objects.create(user=self.user, distance=1.0)
+        self.friend_route = Route.objects.create(user=self.friend,
+                                                 distance=2.0)
+        Route.objects.create(user=User.objects.create_user('stranger'),
+                             distance=3.0)
+
+    def sync(self, token=None):
+        path = '/api/sync/'
+        if token is not None:
+            path += '?token=' + token
+        response = self.client.get(path)
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def test_first_sync_has_everything_visible(self):
+        data = self.sync().data
+        self.assertEqual({route['id'] for route in data['routes']},
+                         {self.route.pk, self.friend_route.pk})
+        self.assertEqual([friendship['id']
+                          for friendship in data['friendships']],
+                         [self.friendship.pk])
+        self.assertFalse(data['more'])
+
+    def test_nothing_changed(self):
+        token = self.sync().data['token']
+        response = self.sync(token)
+        self.assertEqual(response.data['routes'], [])
+        self.assertEqual(response.data['deleted'],
+                         {'routes': [], 'comments': [], 'friendships': []})
+        self.assertLess(len(response.content), 400)
+
+    def test_changes_and_tombstones(self):
+        token = self.sync().data['token']
+        comment = Comment.objects.create(user=self.friend, route=self.route,
+                                         date=timezone.now(), text='Hi')
+        route = Route.objects.create(user=self.friend, distance=4.0)
+        Route.objects.create(user=User.objects.get(username='stranger'),
+                             distance=5.0)
+        deleted = self.friend_route.pk
+        self.friend_route.delete()
+        data = self.sync(token).data
+        self.assertEqual([item['id'] for item in data['routes']], [route.pk])
+        self.assertEqual([item['id'] for item in data['comments']],
+                         [comment.pk])
+        self.assertEqual(data['deleted']['routes'], [deleted])
+        self.assertEqual(self.sync(data['token']).data['routes'], [])
+
+    def test_friendships_change_what_is_visible(self):
+        token = self.sync().data['token']
+        other = User.objects.create_user('other')
+        route = Route.objects.create(user=other, distance=1.0)
+        friendship = Friendship.objects.create(user1=other, user2=self.user)
+        data = self.sync(token).data
+        # a request alone shows nothing of the requester
+        self.assertEqual(data['routes'], [])
+        self.assertEqual([item['id'] for item in data['friendships']],
+                         [friendship.pk])
+
+        friendship.is_accepted = True
+        friendship.save()
+        data = self.sync(data['token']).data
+        self.assertEqual([item['id'] for item in data['routes']], [route.pk])
+
+        deleted = self.friendship.pk
+        self.friendship.delete()
+        data = self.sync(data['token']).data
+        self.assertEqual(data['deleted']['friendships'], [deleted])
+        self.assertEqual(data['removed_users'], [self.friend.pk])
+
+    @override_settings(HEYROAD_SYNC_LIMIT=2)
+    def test_sync_in_pages(self):
+        for _ in range(3):
+            Route.objects.create(user=self.friend, distance=1.0)
+        routes, token, more = set(), None, True
+        while more:
+            data = self.sync(token).data
+            routes.update(route['id'] for route in data['routes'])
+            token, more = data['token'], data['more']
+        self.assertEqual(routes, set(friends.visible_routes(self.user)
+                                     .values_list('pk', flat=True)))
+
+    def test_invalid_tokens(self):
+        response = self.client.get('/api/sync/?token=nonsense')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data['result'], 'failed_invalid_token')
+        token = self.sync().data['token']
+        self.client.force_authenticate(self.friend)
+        response = self.client.get('/api/sync/?token=' + token)
+        self.assertEqual(response.status_code, 400)
+
+    def test_compaction(self):
+        token = self.sync().data['token']
+        route = Route.objects.create(user=self.friend, distance=4.0)
+        route.distance = 5.0
+        route.save()
+        self.friend_route.delete()
+        ChangeLog.objects.filter(deleted=True).update(
+            date=timezone.now() - timedelta(
+                seconds=changes.DEFAULT_HORIZON + 1))
+        out = io.StringIO()
+        call_command('compact_changes', stdout=out)
+        # the second save, and the creation of the deleted route
+        self.assertIn('Deleted 2 superseded entries and 1 tombstones.',
+                      out.getvalue())
+        self.assertEqual(ChangeLog.objects.filter(
+            kind=ChangeLog.ROUTE, object_id=route.pk).count(), 1)
+        self.assertEqual(
+            [item['id'] for item in self.sync(token).data['routes']],
+            [route.pk])
+        self.assertEqual(
+            {item['id'] for item in self.sync().data['routes']},
+            {self.route.pk, route.pk})
+
+    def test_old_tokens_must_resync(self):
+        token = self.sync().data['token']
+        with self.settings(HEYROAD_SYNC_HORIZON=-1):
+            response = self.client.get('/api/sync/?token=' + token)
+        self.assertEqual(response.status_code, 410)
+        self.assertEqual(response.data['result'], 'failed_resync_required')
+
+    def test_cascaded_comments_do_not_load_their_route(self):
+        for _ in range(3):
+            Comment.objects.create(user=self.user, route=self.route,
+                                   date=timezone.now(), text='Hi')
+        with CaptureQueriesContext(connection) as queries:
+            self.route.delete()
+        self.assertFalse([query for query in queries.captured_queries
+                          if query['sql'].startswith('SELECT')
+                          and 'FROM "heyroad_route" WHERE "heyroad_route"."id"'
+                          in query['sql']])
+        self.assertEqual(ChangeLog.objects.filter(
+            kind=ChangeLog.COMMENT, deleted=True,
+            owner=self.user.pk).count(), 3)
+
+
+
+class TokenCacheTests(APITestBase):
+
+    def test_repeated_requests_skip_the_lookup(self):
+        self.client.get('/api/user/')
+        hits = authentication.token_cache.hits
+        with self.assertNumQueries(1):
+            response = self.client.get('/api/user/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(authentication.token_cache.hits, hits + 1)
+
+    def test_deleted_token_is_refused(self):
+        self.client.get('/api/user/')
+        Token.objects.filter(user=self.user).get().delete()
+        self.assertEqual(self.client.get('/api/user/').status_code, 401)
+
+    def test_deactivated_user_is_refused(self):
+        self.client.get('/api/user/')
+        self.user.is_active = False
+        self.user.save()
+        self.assertEqual(self.client.get('/api/user/').status_code, 401)
+
+    def test_unknown_tokens_are_not_cached(self):
+        self.client.credentials(HTTP_AUTHORIZATION='Token nonsense')
+        self.assertEqual(self.client.get('/api/user/').status_code, 401)
+        self.assertEqual(len(authentication.token_cache), 0)
+
+    def test_counters_are_exposed(self):
+        self.user.is_staff = True
+        self.user.save()
+        hits = authentication.token_cache.hits
+        self.client.get('/api/user/')
+        self.client.get('/metrics/')
+        text = self.client.get('/metrics/').content.decode()
+        self.assertIn('# TYPE heyroad_token_cache_hits_total counter\n'
+                      'heyroad_token_cache_hits_total {}\n'.format(hits + 2),
+                      text)
+        self.assertIn('heyroad_token_cache_entries 1\n', text)
+
+
+@override_settings(HEYROAD_DATABASE_REPLICAS=['replica'])
+class DatabaseProfileTests(TransactionTestCase):
+
+    def setUp(self):
+        self.router = db.ReadReplicaRouter()
+
+    def test_reads_of_read_requests_go_to_a_replica(self):
+        self.assertEqual(self.router.db_for_read(Route), 'default')
+        with db.reading():
+            self.assertEqual(self.router.db_for_read(Route), 'replica')
+            self.assertEqual(self.router.db_for_write(Route), 'default')
+        self.assertEqual(self.router.db_for_read(Route), 'default')
+
+    def test_reads_in_a_transaction_stay_on_default(self):
+        with db.reading(), transaction.atomic():
+            self.assertEqual(self.router.db_for_read(Route), 'default')
+
+    def test_replicas_are_not_migrated(self):
+        self.assertTrue(self.router.allow_migrate('default', 'heyroad'))
+        self.assertFalse(self.router.allow_migrate('replica', 'heyroad'))
+
+    def test_middleware_reads_only_for_safe_methods(self):
+        used = []
+        middleware = ReadReplicaMiddleware(
+            lambda request: used.append(self.router.db_for_read(Route)))
+        middleware(mock.Mock(method='GET'))
+        middleware(mock.Mock(method='POST'))
+        self.assertEqual(used, ['replica', 'default'])
+
+    def test_pragmas_are_applied(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'db.sqlite3')
+            raw = sqlite3.connect(path)
+            for statement in db.pragma_statements(db.RECOMMENDED_PRAGMAS):
+                raw.execute(statement)
+            self.assertEqual(raw.execute('PRAGMA journal_mode').fetchone(),
+                             ('wal',))
+            self.assertEqual(raw.execute('PRAGMA synchronous').fetchone(),
+                             (1,))
+            raw.close()
+
+    @override_settings(HEYROAD_SQLITE_PRAGMAS={'cache_size': -1234},
+                       HEYROAD_DATABASE_REPLICAS=['default'])
+    def test_connections_are_configured(self):
+        try:
+            db.configure_connection(None, connection)
+            with connection.cursor() as cursor:
+                cursor.execute('PRAGMA cache_size')
+                self.assertEqual(cursor.fetchone(), (-1234,))
+                cursor.execute('PRAGMA query_only')
+                self.assertEqual(cursor.fetchone(), (1,))
+        finally:
+            with connection.cursor() as cursor:
+                cursor.execute('PRAGMA query_only = OFF')
+
+    def test_bench_sqlite(self):
+        out = io.StringIO()
+        call_command('bench_sqlite', readers=2, writers=1, seconds=0.2,
+                     rows=50, points=10, stdout=out)
+        lines = out.getvalue().splitlines()
+        self.assertEqual([line.split()[0] for line in lines[1:]],
+                         ['default', 'production'])
+
+
+class LeaderboardTests(APITestBase):
+
+    def setUp(self):
+        super().setUp()
+        self.friend = User.objects.create_user('friend', 'f@example.com',
+                                               'secret-pass-123')
+        self.stranger = User.objects.create_user('stranger',
+                                                 's@example.com',
+                                                 'secret-pass-123')
+        Friendship.objects.create(user1=self.user, user2=self.friend,
+                                  is_accepted=True)
+
+    def add_route(self, user, distance, minutes=30, date=None):
+        return Route.objects.create(user=user, distance=distance,
+                                    duration=timedelta(minutes=minutes),
+                                    date=date or timezone.now())
+
+    def ranking(self, **params):
+        response = self.client.get('/api/leaderboard/', params)
+        self.assertEqual(response.status_code, 200)
+        return [(entry['rank'], entry['username'])
+                for entry in response.json()['entries']]
+
+    def test_friends_are_ranked(self):
+        self.add_route(self.user, 10.0, minutes=90)
+        self.add_route(self.friend, 30.0)
+        self.add_route(self.stranger, 100.0)
+        self.add_route(self.friend, 50.0,
+                       date=timezone.now() - timedelta(days=70))
+        self.assertEqual(self.ranking(), [(1, 'friend'), (2, 'rider')])
+        self.assertEqual(self.ranking(metric='duration'),
+                         [(1, 'rider'), (2, 'friend')])
+        self.assertEqual(self.ranking(period='month', metric='route_count'),
+                         [(1, 'friend'), (1, 'rider')])
+        old = (timezone.now() - timedelta(days=70)).date().isoformat()
+        self.assertEqual(self.ranking(period='month', date=old),
+                         [(1, 'friend')])
+
+    def test_boards_are_cached_until_totals_change(self):
+        self.add_route(self.user, 10.0)
+        board = leaderboard.leaderboard(self.user)
+        with self.assertNumQueries(0):
+            self.assertEqual(leaderboard.leaderboard(self.user), board)
+
+        route = self.add_route(self.friend, 30.0)
+        self.assertEqual(
+            [entry['username']
+             for entry in leaderboard.leaderboard(self.user)['entries']],
+            ['friend', 'rider'])
+        route.delete()
+        self.assertEqual(
+            len(leaderboard.leaderboard(self.user)['entries']), 1)
+
+    def test_only_renames_change_the_users(self):
+        self.add_route(self.friend, 10.0)
+        leaderboard.leaderboard(self.user)
+        self.client.force_login(self.friend)
+        self.friend.save(update_fields=['last_login'])
+        self.friend.email = 'friend@example.com'
+        self.friend.save()
+        with self.assertNumQueries(0):
+            leaderboard.leaderboard(self.user)
+
+        self.friend.username = 'cyclist'
+        self.friend.save()
+        self.assertEqual(
+            [entry['username']
+             for entry in leaderboard.leaderboard(self.user)['entries']],
+            ['cyclist'])
+
+    def test_friendships_change_the_board(self):
+        self.add_route(self.stranger, 10.0)
+        self.assertEqual(self.ranking(), [])
+        Friendship.objects.create(user1=self.stranger, user2=self.user,
+                                  is_accepted=True)
+        self.assertEqual(self.ranking(), [(1, 'stranger')])
+        Friendship.objects.filter(user1=self.stranger).delete()
+        self.assertEqual(self.ranking(), [])
+
+    def test_invalid_parameters(self):
+        for params in ({'period': 'year'}, {'metric': 'speed'},
+                       {'date': 'yesterday'}):
+            response = self.client.get('/api/leaderboard/', params)
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(response.json()['result'],
+                             'failed_invalid_leaderboard')
+
+    def test_page(self):
+        self.add_route(self.friend, 30.0)
+        self.client.force_login(self.user)
+        response = self.client.get('/leaderboard/?period=month')
+        self.assertContains(response, 'friend</a>')
+        self.assertEqual(
+            self.client.get('/leaderboard/?period=year').status_code, 302)
+
+
+class ThumbnailTests(APITestBase):
+
+    def test_fit_keeps_the_track_inside(self):
+        points = [(52.0 + i * 0.001, 21.0 + (i % 7) * 0.002)
+                  for i in range(500)]
+        pixels = thumbnails.fit(points, 96)
+        self.assertLess(len(pixels), len(points))
+        for x, y in pixels:
+            self.assertTrue(thumbnails.PADDING <= x <= 96 - thumbnails.PADDING)
+            self.assertTrue(thumbnails.PADDING <= y <= 96 - thumbnails.PADDING)
+        # north up: the last point is the northernmost
+        self.assertEqual(pixels[-1][1], thumbnails.PADDING)
+        self.assertEqual(thumbnails.fit([(52.0, 21.0)] * 3, 96),
+                         [(48.0, 48.0)])
+
+    def test_svg_and_png(self):
+        pixels = thumbnails.fit([(52.0, 21.0), (52.01, 21.0), (52.0, 21.02)],
+                                32)
+        element = ElementTree.fromstring(thumbnails.svg(pixels, 32))
+        self.assertEqual(element.get('viewBox'), '0 0 32 32')
+        path = element.find('{http://www.w3.org/2000/svg}path').get('d')
+        self.assertTrue(path.startswith('M'))
+
+        data = thumbnails.png(pixels, 32)
+        self.assertEqual(data[:8], b'\x89PNG\r\n\x1a\n')
+        self.assertEqual(data[16:24], b'\x00\x00\x00\x20' * 2)
+        start = data.index(b'IDAT')
+        length = int.from_bytes(data[start - 4:start], 'big')
+        raw = zlib.decompress(data[start + 4:start + 4 + length])
+        self.assertEqual(len(raw), 32 * 33)
+        self.assertIn(1, raw)
+
+    @override_settings(HEYROAD_PROCESS_ROUTES_INLINE=True,
+                       HEYROAD_THUMBNAIL_PNG=True)
+    def test_thumbnails_are_stored_and_embedded(self):
+        route_id = self.post_route(make_payload(200)).data['id']
+        route = Route.objects.get(pk=route_id)
+        self.assertTrue(route.thumbnail.startswith('<svg'))
+        self.assertIsNotNone(route.thumbnail_png)
+
+        self.client.force_login(self.user)
+        with self.assertNumQueries(3):
+            response = self.client.get('/')
+        self.assertContains(response, route.thumbnail, html=True)
+        response = self.client.get('/user/{}/'.format(self.user.pk))
+        self.assertContains(response, route.thumbnail, html=True)
+
+        url = '/route/{}/thumbnail.png'.format(route_id)
+        response = self.client.get(url, {'v': route.version})
+        self.assertEqual(response['Content-Type'], 'image/png')
+        self.assertIn('immutable', response['Cache-Control'])
+        self.assertEqual(response.content, bytes(route.thumbnail_png))
+        self.assertEqual(self.client.get(
+            url, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+        self.assertIn('no-cache', self.client.get(url)['Cache-Control'])
+
+        other = User.objects.create_user('other', 'o@example.com',
+                                         'secret-pass-123')
+        self.client.force_login(other)
+        self.assertEqual(self.client.get(url).status_code, 404)
+
+    @override_settings(HEYROAD_PROCESS_ROUTES_INLINE=False)
+    def test_command_renders_missing_thumbnails(self):
+        route_id = self.post_route(make_payload(20)).data['id']
+        out = io.StringIO()
+        call_command('thumbnail_routes', stdout=out)
+        self.assertIn('Rendered 1 thumbnails.', out.getvalue())
+        route = Route.objects.get(pk=route_id)
+        self.assertTrue(route.thumbnail)
+        self.assertIsNone(route.thumbnail_png)
+        self.assertEqual(route.version, 2)
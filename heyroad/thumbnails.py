@@ -0,0 +1,145 @@
+"""
+Route thumbnails.
+
+A small picture of the track is rendered once, as a processing step, and
+stored on the route: an SVG path that pages embed inline, so showing it
+costs no query beyond the one loading the route, and optionally a PNG
+drawn by the pure-Python rasterizer below, served with the route version
+in its URL so browsers may cache it for good.
+"""
+import math
+import struct
+import zlib
+
+from django.conf import settings
+
+from heyroad.models import Route
+from heyroad.simplify import simplify
+
+# pixels, square
+DEFAULT_SIZE = 96
+PADDING = 4
+COLOR = (0x1f, 0x6f, 0xb4)
+BACKGROUND = (0xff, 0xff, 0xff)
+METRES_PER_DEGREE = 111320.0
+
+
+def thumbnail_size():
+    return getattr(settings, 'HEYROAD_THUMBNAIL_SIZE', DEFAULT_SIZE)
+
+
+def render_png():
+    return getattr(settings, 'HEYROAD_THUMBNAIL_PNG', False)
+
+
+def fit(points, size):
+    """
+    The track as (x, y) pixels of a `size` square, north up, simplified
+    to about a pixel.
+    """
+    if not points:
+        return []
+    mean_latitude = sum(latitude for latitude, _ in points) / len(points)
+    kx = METRES_PER_DEGREE * math.cos(math.radians(mean_latitude))
+    ky = METRES_PER_DEGREE
+    xs = [longitude * kx for _, longitude in points]
+    ys = [latitude * ky for latitude, _ in points]
+    left, top = min(xs), max(ys)
+    width, height = max(xs) - left, top - min(ys)
+    inner = size - 2 * PADDING
+    extent = max(width, height)
+    if not extent:
+        return [(size / 2, size / 2)]
+    scale = inner / extent
+    # centre the shorter side
+    dx = PADDING + (inner - width * scale) / 2
+    dy = PADDING + (inner - height * scale) / 2
+    pixels = []
+    for latitude, longitude in simplify(points, extent / inner):
+        x = round(dx + (longitude * kx - left) * scale, 1)
+        y = round(dy + (top - latitude * ky) * scale, 1)
+        if not pixels or pixels[-1] != (x, y):
+            pixels.append((x, y))
+    return pixels
+
+
+def _number(value):
+    return '{:g}'.format(value)
+
+
+def svg(pixels, size):
+    if not pixels:
+        return ''
+    x, y = pixels[0]
+    path = ['M{} {}'.format(_number(x), _number(y))]
+    path.extend('L{} {}'.format(_number(x), _number(y))
+                for x, y in pixels[1:])
+    if len(pixels) == 1:
+        # a dot
+        path.append('h0')
+    return ('<svg xmlns="http://www.w3.org/2000/svg" class="thumbnail" '
+            'width="{size}" height="{size}" viewBox="0 0 {size} {size}">'
+            '<path d="{path}" fill="none" stroke="#{color}" '
+            'stroke-width="2" stroke-linecap="round" '
+            'stroke-linejoin="round"/></svg>').format(
+                size=size, path=''.join(path),
+                color='{:02x}{:02x}{:02x}'.format(*COLOR))
+
+
+def _line(canvas, size, x0, y0, x1, y1):
+    # Bresenham, with a 2x2 pen to match the SVG stroke
+    dx, dy = abs(x1 - x0), -abs(y1 - y0)
+    sx = 1 if x0 < x1 else -1
+    sy = 1 if y0 < y1 else -1
+    error = dx + dy
+    while True:
+        for px in (x0, x0 + 1):
+            for py in (y0, y0 + 1):
+                if 0 <= px < size and 0 <= py < size:
+                    canvas[py][px] = 1
+        if x0 == x1 and y0 == y1:
+            return
+        double = 2 * error
+        if double >= dy:
+            error += dy
+            x0 += sx
+        if double <= dx:
+            error += dx
+            y0 += sy
+
+
+def _chunk(kind, data):
+    return struct.pack('>I', len(data)) + kind + data \
+        + struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff)
+
+
+def png(pixels, size):
+    """
+    The track as a two-colour palette PNG.
+    """
+    canvas = [bytearray(size) for _ in range(size)]
+    points = [(int(x), int(y)) for x, y in pixels]
+    for (x0, y0), (x1, y1) in zip(points, points[1:] or points):
+        _line(canvas, size, x0, y0, x1, y1)
+    # filter type 0 before every row
+    raw = b''.join(b'\x00' + bytes(row) for row in canvas)
+    return b''.join([
+        b'\x89PNG\r\n\x1a\n',
+        _chunk(b'IHDR', struct.pack('>IIBBBBB', size, size, 8, 3, 0, 0, 0)),
+        _chunk(b'PLTE', bytes(BACKGROUND + COLOR)),
+        _chunk(b'IDAT', zlib.compress(raw, 9)),
+        _chunk(b'IEND', b''),
+    ])
+
+
+def render_thumbnail(route, points):
+    """
+    Render and store the thumbnails of `route`.
+    """
+    size = thumbnail_size()
+    pixels = fit(points, size)
+    route.thumbnail = svg(pixels, size)
+    route.thumbnail_png = png(pixels, size) \
+        if pixels and render_png() else None
+    Route.objects.filter(pk=route.pk).update(
+        thumbnail=route.thumbnail, thumbnail_png=route.thumbnail_png)
@@ -0,0 +1,162 @@
+"""
+Materialized home feeds (fan-out on write).
+
+Every user has a TimelineEntry per route or comment they should see in
+their feed. Entries are written to the timelines of the author and their
+friends when a route is uploaded or a comment posted, so reading a feed
+is one range scan on (owner, date, id). Timelines are trimmed to
+HEYROAD_TIMELINE_LENGTH entries, allowing TRIM_SLACK extra entries
+before a trim so that most writes skip it.
+"""
+from django.conf import settings
+from django.db.models import Count, Q
+
+from heyroad import friends
+from heyroad.models import Route, Comment, TimelineEntry
+
+DEFAULT_LENGTH = 500
+TRIM_SLACK = 50
+# owner ids per query, below SQLite's bound parameter limit
+CHUNK_SIZE = 500
+
+
+def max_length():
+    return getattr(settings, 'HEYROAD_TIMELINE_LENGTH', DEFAULT_LENGTH)
+
+
+def _chunks(ids):
+    ids = list(ids)
+    for start in range(0, len(ids), CHUNK_SIZE):
+        yield ids[start:start + CHUNK_SIZE]
+
+
+def _route_entry(owner_id, route):
+    return TimelineEntry(owner_id=owner_id, kind=TimelineEntry.ROUTE,
+                         object_id=route.pk, actor_id=route.user_id,
+                         route_id=route.pk, date=route.date)
+
+
+def _comment_entry(owner_id, comment):
+    return TimelineEntry(owner_id=owner_id, kind=TimelineEntry.COMMENT,
+                         object_id=comment.pk, actor_id=comment.user_id,
+                         route_id=comment.route_id, comment_id=comment.pk,
+                         date=comment.date)
+
+
+def _write(entries, owner_ids):
+    TimelineEntry.objects.bulk_create(entries, batch_size=CHUNK_SIZE,
+                                      ignore_conflicts=True)
+    trim(owner_ids)
+
+
+def trim(owner_ids, slack=None):
+    """
+    Cut the timelines of `owner_ids` longer than the maximum length plus
+    `slack` (TRIM_SLACK by default) back to the maximum length.
+    """
+    if slack is None:
+        slack = TRIM_SLACK
+    length = max_length()
+    for chunk in _chunks(owner_ids):
+        over = TimelineEntry.objects.filter(owner__in=chunk) \
+                                    .order_by() \
+                                    .values('owner') \
+                                    .annotate(count=Count('id')) \
+                                    .filter(count__gt=length + slack) \
+                                    .values_list('owner', flat=True)
+        for owner_id in over:
+            entries = TimelineEntry.objects.filter(owner_id=owner_id)
+            keep = entries.order_by('-date', '-id').values('pk')[:length]
+            entries.exclude(pk__in=keep).delete()
+
+
+def route_added(route):
+    owner_ids = friends.visible_user_ids(route.user)
+    _write([_route_entry(owner_id, route) for owner_id in owner_ids],
+           owner_ids)
+
+
+def comment_added(comment):
+    # the commenter's friends who may also see the route
+    owner_ids = friends.visible_user_ids(comment.user) \
+        & friends.visible_user_ids(comment.route.user)
+    _write([_comment_entry(owner_id, comment) for owner_id in owner_ids],
+           owner_ids)
+
+
+def connect(user_id, other_id):
+    """
+    Copy the latest routes of two new friends into each other's timeline.
+    """
+    length = max_length()
+    entries = []
+    for owner_id, author_id in ((user_id, other_id), (other_id, user_id)):
+        routes = Route.objects.filter(user_id=author_id) \
+                              .order_by('-date', '-id') \
+                              .only('pk', 'user', 'date')[:length]
+        entries.extend(_route_entry(owner_id, route) for route in routes)
+    _write(entries, [user_id, other_id])
+
+
+def disconnect(user_id, other_id):
+    """
+    Remove from both timelines what the two users no longer may see.
+    """
+    for owner_id, author_id in ((user_id, other_id), (other_id, user_id)):
+        TimelineEntry.objects.filter(
+            Q(actor_id=author_id) | Q(route__user_id=author_id),
+            owner_id=owner_id
+        ).delete()
+
+
+def expected_entries(user):
+    """
+    The entries the timeline of `user` should hold, newest first.
+    """
+    length = max_length()
+    visible = friends.visible_q(user)
+    routes = Route.objects.filter(visible).order_by('-date', '-id') \
+                          .only('pk', 'user', 'date')[:length]
+    comments = Comment.objects.filter(
+        visible, friends.visible_q(user, field='route__user')
+    ).order_by('-date', '-id').only('pk', 'user', 'route', 'date')[:length]
+    entries = [_route_entry(user.pk, route) for route in routes] \
+        + [_comment_entry(user.pk, comment) for comment in comments]
+    entries.sort(key=lambda entry: (entry.date, entry.object_id),
+                 reverse=True)
+    return entries[:length]
+
+
+def rebuild(user, dry_run=False):
+    """
+    Make the timeline of `user` match expected_entries(), adding what is
+    missing and deleting what should not be there. Returns the number of
+    entries (added, removed).
+    """
+    expected = {(entry.kind, entry.object_id): entry
+                for entry in expected_entries(user)}
+    existing = dict(
+        ((kind, object_id), pk) for kind, object_id, pk in
+        TimelineEntry.objects.filter(owner=user)
+                             .values_list('kind', 'object_id', 'pk'))
+    missing = [entry for key, entry in expected.items()
+               if key not in existing]
+    extra = [pk for key, pk in existing.items() if key not in expected]
+    if not dry_run:
+        for chunk in _chunks(extra):
+            TimelineEntry.objects.filter(pk__in=chunk).delete()
+        TimelineEntry.objects.bulk_create(missing, batch_size=CHUNK_SIZE,
+                                          ignore_conflicts=True)
+    return len(missing), len(extra)
+
+
+def feed(user):
+    """
+    The timeline of `user`, with what the feed displays joined in.
+    """
+    return TimelineEntry.objects.filter(owner=user) \
+                                .select_related('actor', 'route',
+                                                'route__user', 'comment') \
+                                .defer('route__track', 'route__times',
+                                       'route__elevations',
+                                       'route__thumbnail_png')
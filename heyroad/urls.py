@@ -9,16 +9,26 @@ router.register(r'user', views.UserViewSet, basename='user')
 router.register(r'route', views.RouteViewSet, basename='route')
 router.register(r'friend', views.FriendViewSet, basename='friend')
 router.register(r'comment', views.CommentViewSet, basename='comment')
+router.register(r'feed', views.FeedViewSet, basename='feed')
+router.register(r'live', views.LiveViewSet, basename='live')
+router.register(r'sync', views.SyncViewSet, basename='sync')
+router.register(r'leaderboard', views.LeaderboardViewSet,
+                basename='leaderboard')
 
 urlpatterns = [
     path('', views.RouteList.as_view(), name='home'),
     path('user/<int:pk>/', views.UserDetail.as_view(), name='user'),
     path('route/<int:pk>/', views.RouteDetail.as_view(), name='route'),
+    path('route/<int:pk>/thumbnail.png',
+         views.RouteThumbnail.as_view(),
+         name='route-thumbnail'),
     path('route/<int:pk>/delete/',
          views.RouteDelete.as_view(),
          name='route-delete'),
     path('register/', views.UserRegister.as_view(), name='register'),
     path('friends/', views.FriendView.as_view(), name='friends'),
+    path('leaderboard/', views.LeaderboardView.as_view(),
+         name='leaderboard'),
     path('comment/', views.CommentCreateView.as_view(), name='add-comment'),
     path('comment/delete/',
         views.CommentDeleteView.as_view(),
@@ -26,4 +36,5 @@ urlpatterns = [
     path('api/', include(router.urls)),
     path('api-auth/login/', obtain_auth_token),
     path('api-auth/register/', views.RegisterAPIView.as_view()),
+    path('metrics/', views.MetricsView.as_view(), name='metrics'),
 ]
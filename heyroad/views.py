@@ -1,31 +1,81 @@
 import json
-from itertools import chain
+import math
+from django.conf import settings
 from django.utils import timezone
-from django.utils.dateparse import parse_datetime, parse_duration
+from django.utils.dateparse import parse_datetime
+from django.http import Http404, HttpResponse, StreamingHttpResponse
 from django.shortcuts import render, get_object_or_404, redirect
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.contrib.auth.models import User
 from django.views.generic import ListView, DetailView, CreateView, FormView, \
                                  DeleteView, View
-from django.db.models import Sum, Q
+from django.db import IntegrityError, transaction
+from django.db.models import Q, Count, Max
 from django.middleware.csrf import CsrfViewMiddleware
 
 from rest_framework import viewsets, permissions, status
+from rest_framework.decorators import action
 from rest_framework.response import Response
-from rest_framework.authentication import TokenAuthentication
+from rest_framework.authentication import SessionAuthentication
+from rest_framework.exceptions import ParseError, UnsupportedMediaType
+from rest_framework.parsers import JSONParser, MultiPartParser
+from rest_framework.settings import api_settings
 from rest_framework.views import APIView
 
+from heyroad import caching, changes, export, friends, importers, \
+                    instrumentation, leaderboard, live, spatial, stats, \
+                    timeline
+from heyroad.authentication import CachedTokenAuthentication
 from heyroad.permissions import IsOwnerOrReadOnly
-from heyroad.models import Route, LatLng, Friendship, Comment
+from heyroad.ingest import ingest_route, ingest_batch, InvalidRoutePayload
+from heyroad.parsers import PolylineJSONParser, MessagePackParser
+from heyroad.renderers import PolylineJSONRenderer, MessagePackRenderer, \
+                              EventStreamRenderer
+from heyroad.pagination import Keyset, KeysetPagination, InvalidCursor, \
+                               page_size_from
+from heyroad.simplify import parse_tolerance, route_points
+from heyroad.models import Route, LatLng, Friendship, Comment, RouteJob, \
+                           LiveRoute
 from heyroad.forms import UserRegisterForm, FriendshipInviteForm, CommentForm       
 from heyroad.serializers import (
     UserSerializer,
     RouteSerializer,
     UserDetailSerializer,
     RouteDetailSerializer,
-    FriendshipSerializer
+    FriendshipSerializer,
+    CommentSerializer,
+    UserStatsSerializer,
+    RouteJobSerializer,
+    TimelineEntrySerializer,
+    LiveRouteSerializer,
+    LeaderboardSerializer,
+    COORDS_OBJECTS,
+    COORDS_POLYLINE,
+    COORDS_FORMATS
 )
-                        
+
+ROUTE_KEYSET = Keyset('-date', '-id')
+DEFAULT_MAX_BATCH_ROUTES = 100
+# packed per-point data, only needed when a single track is shown
+TRACK_FIELDS = ('track', 'times', 'elevations')
+# pages embed the SVG thumbnail, the PNG is served on its own
+THUMBNAIL_FIELDS = ('thumbnail', 'thumbnail_png')
+TIMELINE_KEYSET = Keyset('-date', '-id')
+
+
+def _page_etag(request, kind, paginator, tokens):
+    return caching.negotiated_etag(request, kind,
+                                   paginator.page.next_cursor, *tokens)
+
+
+def _export(request, routes, name):
+    try:
+        return export.export_response(
+            routes, request.query_params.get('fmt', 'gpx'), name)
+    except ValueError as e:
+        result = {'result': 'failed_invalid_format', 'detail': str(e)}
+        return Response(result, status=status.HTTP_400_BAD_REQUEST)
+
 
 class RouteList(LoginRequiredMixin, ListView):
     # model = Route
@@ -34,20 +84,20 @@ class RouteList(LoginRequiredMixin, ListView):
     redirect_field_name = 'redirect_to'
 
     def get_queryset(self):
-        if self.request.user.is_superuser:
-            return Route.objects.all()
-        friends1 = Friendship.objects                   \
-                   .filter(user1=self.request.user)     \
-                   .filter(is_accepted=True)            \
-                   .values_list('user2', flat=True)
-        friends2 = Friendship.objects                   \
-                   .filter(user2=self.request.user)     \
-                   .filter(is_accepted=True)            \
-                   .values_list('user1', flat=True)
-        all_friends = list(chain(friends1, friends2))
-        all_friends.append(self.request.user)
-        queryset = Route.objects.filter(user__in=all_friends)
-        return queryset
+        try:
+            self.page = TIMELINE_KEYSET.paginate(
+                timeline.feed(self.request.user),
+                self.request.GET.get('cursor'),
+                page_size_from(self.request.GET)
+            )
+        except InvalidCursor:
+            raise Http404('Invalid cursor')
+        return self.page.items
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['next_cursor'] = self.page.next_cursor
+        return context
 
 class UserDetail(LoginRequiredMixin, DetailView):
     model = User
@@ -56,28 +106,29 @@ class UserDetail(LoginRequiredMixin, DetailView):
     login_url = '/login/'
     redirect_field_name = 'redirect_to'
 
+    def get_object(self, queryset=None):
+        # already fetched by dispatch()
+        return self.owner
+
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        user = get_object_or_404(User, pk=self.kwargs.get('pk'))
         # Get user routes
-        user_routes = Route.objects.filter(user=user)
-        context['route_list'] = user_routes
+        context['route_list'] = Route.objects.filter(user=self.object) \
+                                             .select_related('user') \
+                                             .defer(*TRACK_FIELDS,
+                                                    'thumbnail_png')
         # Get user stats
-        context['user_stats'] = user_routes.aggregate(
-                                total_duration=Sum('duration'),
-                                total_distance=Sum('distance'))
+        context['user_stats'] = stats.get_user_stats(self.object)
         return context
 
     def dispatch(self, request, *args, **kwargs):
         """
         Redirect if requested resource owner is not friend of user
         """
-        user = get_object_or_404(User, pk=self.kwargs.get('pk'))
-        if (user == self.request.user or Friendship.objects.filter(
-            Q(user1=self.request.user, user2=user) |
-            Q(user2=self.request.user, user1=user)
-           ).filter(is_accepted=True).exists()
-           or self.request.user.is_superuser):
+        if not request.user.is_authenticated:
+            return self.handle_no_permission()
+        self.owner = get_object_or_404(User, pk=self.kwargs.get('pk'))
+        if friends.can_view(request.user, self.owner.pk):
            return super(UserDetail, self).dispatch(request, *args, **kwargs)
         return redirect('home')
 
@@ -88,12 +139,25 @@ class RouteDetail(LoginRequiredMixin, DetailView):
     login_url = '/login/'
     redirect_field_name = 'redirect_to'
 
+    def get_object(self, queryset=None):
+        # already fetched by dispatch()
+        return self.route
+
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        route = get_object_or_404(Route, pk=self.kwargs.get('pk'))
-        # Get route coordinates
-        context['latlng_list'] = LatLng.objects.filter(route=route)
-        context['comment_list'] = Comment.objects.filter(route=route)
+        route = self.object
+        # Get route coordinates, simplified if ?detail= asks for it
+        try:
+            tolerance = parse_tolerance(self.request.GET.get('detail'),
+                                        self.request.GET.get('tolerance'))
+        except ValueError:
+            tolerance = None
+        context['latlng_list'] = [
+            {'latitude': latitude, 'longitude': longitude}
+            for latitude, longitude in route_points(route, tolerance)
+        ]
+        context['comment_list'] = Comment.objects.filter(route=route) \
+                                                 .select_related('user')
         context['comment_form'] = CommentForm()
         return context
 
@@ -101,13 +165,11 @@ class RouteDetail(LoginRequiredMixin, DetailView):
         """
         Redirect if requested resource owner is not friend of user
         """
-        route = get_object_or_404(Route, pk=self.kwargs.get('pk'))
-        user = route.user
-        if (user == self.request.user or Friendship.objects.filter(
-            Q(user1=self.request.user, user2=user) |
-            Q(user2=self.request.user, user1=user)
-           ).filter(is_accepted=True).exists()
-           or self.request.user.is_superuser):
+        if not request.user.is_authenticated:
+            return self.handle_no_permission()
+        self.route = get_object_or_404(Route.objects.select_related('user'),
+                                       pk=self.kwargs.get('pk'))
+        if friends.can_view(request.user, self.route.user_id):
            return super(RouteDetail, self).dispatch(request, *args, **kwargs)
         return redirect('home')
 
@@ -123,6 +185,33 @@ class UserRegister(FormView):
     def form_invalid(self, form):
         return super().form_invalid(form)
 
+class RouteThumbnail(LoginRequiredMixin, View):
+    """
+    The PNG thumbnail of a route; with the current ?v=<route version> it
+    may be cached for good, a new version gets a new URL.
+    """
+    login_url = '/login/'
+    redirect_field_name = 'redirect_to'
+
+    def get(self, request, pk):
+        route = get_object_or_404(
+            Route.objects.only('user', 'version', 'thumbnail_png'), pk=pk)
+        if not friends.can_view(request.user, route.user_id) \
+                or route.thumbnail_png is None:
+            raise Http404
+        etag = caching.make_etag('thumbnail', route.pk, route.version)
+        response = caching.not_modified(request, etag)
+        if response is None:
+            response = HttpResponse(bytes(route.thumbnail_png),
+                                    content_type='image/png')
+        if request.GET.get('v') == str(route.version):
+            response['Cache-Control'] = 'private, max-age=31536000, ' \
+                                        'immutable'
+        else:
+            response['Cache-Control'] = 'private, no-cache'
+        return caching.set_validators(response, etag)
+
+
 class RouteDelete(LoginRequiredMixin, DeleteView):
     model = Route
     template_name = 'heyroad/route_delete.html'
@@ -136,24 +225,45 @@ class RouteDelete(LoginRequiredMixin, DeleteView):
             return self.model.objects.filter(pk=pk)
         return self.model.objects.filter(pk=pk).filter(user=owner)
 
-class FriendView(LoginRequiredMixin, View):
+class LeaderboardView(LoginRequiredMixin, View):
     login_url = '/login/'
     redirect_field_name = 'redirect_to'
 
     def get(self, request):
+        try:
+            period = leaderboard.parse_period(request.GET.get('period'))
+            metric = leaderboard.parse_metric(request.GET.get('metric'))
+        except leaderboard.InvalidLeaderboard:
+            return redirect('leaderboard')
+        return render(request, 'heyroad/leaderboard.html', {
+            'board': leaderboard.leaderboard(request.user, period, metric),
+            'periods': stats.PERIODS,
+            'metrics': leaderboard.METRICS,
+        })
+
+
+class FriendView(LoginRequiredMixin, View):
+    login_url = '/login/'
+    redirect_field_name = 'redirect_to'
+
+    def _render(self, request, error=None):
         friend_list = Friendship.objects.filter(
             Q(user2=request.user) |  Q(user1=request.user),
             is_accepted=True
-        )
+        ).select_related('user1', 'user2')
         request_list = Friendship.objects.filter(
             user2=request.user,
             is_accepted=False
-        )
+        ).select_related('user1')
         invite_form = FriendshipInviteForm()
         return render(request, 'heyroad/friends.html',
                       {'friend_list': friend_list,
                        'request_list': request_list,
-                       'invite_form': invite_form})
+                       'invite_form': invite_form,
+                       'error': error})
+
+    def get(self, request):
+        return self._render(request)
 
     def post(self, request):
         error = None
@@ -191,40 +301,14 @@ class FriendView(LoginRequiredMixin, View):
         except Exception as e:
             error = 'Error: ' + str(e)
 
-        friend_list = Friendship.objects.filter(
-            Q(user2=request.user) |  Q(user1=request.user),
-            is_accepted=True
-        )
-        request_list = Friendship.objects.filter(
-            user2=request.user,
-            is_accepted=False
-        )
-        invite_form = FriendshipInviteForm()
-        return render(request, 'heyroad/friends.html',
-                      {'friend_list': friend_list,
-                       'request_list': request_list,
-                       'invite_form': invite_form,
-                       'error': error})
+        return self._render(request, error)
 
 class CommentCreateView(LoginRequiredMixin, View):
     login_url = '/login/'
     redirect_field_name = 'redirect_to'
 
     def _get_queryset(self, request):
-        if request.user.is_superuser:
-            return Route.objects.all()
-        friends1 = Friendship.objects                   \
-                   .filter(user1=request.user)          \
-                   .filter(is_accepted=True)            \
-                   .values_list('user2', flat=True)
-        friends2 = Friendship.objects                   \
-                   .filter(user2=request.user)          \
-                   .filter(is_accepted=True)            \
-                   .values_list('user1', flat=True)
-        all_friends = list(chain(friends1, friends2))
-        all_friends.append(request.user)
-        queryset = Route.objects.filter(user__in=all_friends)
-        return queryset
+        return friends.visible_routes(request.user)
 
     def get(self, request):
         return redirect('home')
@@ -274,24 +358,11 @@ class CommentDeleteView(LoginRequiredMixin, View):
 # -------------- REST API ----------------
 
 class UserViewSet(viewsets.ViewSet):
-    authentication_classes = [TokenAuthentication]
+    authentication_classes = [CachedTokenAuthentication]
     permission_classes = [permissions.IsAuthenticated]
 
     def _get_queryset(self, request):
-        if request.user.is_superuser:
-            return User.objects.all()
-        friends1 = Friendship.objects                   \
-                   .filter(user1=request.user)          \
-                   .filter(is_accepted=True)            \
-                   .values_list('user2', flat=True)
-        friends2 = Friendship.objects                   \
-                   .filter(user2=request.user)          \
-                   .filter(is_accepted=True)            \
-                   .values_list('user1', flat=True)
-        all_friends = list(chain(friends1, friends2))
-        all_friends.append(request.user.pk)
-        queryset = User.objects.filter(pk__in=all_friends)
-        return queryset
+        return friends.visible_users(request.user)
 
     def list(self, request):
         queryset = self._get_queryset(request)
@@ -303,63 +374,222 @@ class UserViewSet(viewsets.ViewSet):
     def retrieve(self, request, pk=None):
         queryset = self._get_queryset(request)
         user = get_object_or_404(queryset, pk=pk)
-        serializer = UserDetailSerializer(user, context={'request': request})
+        # the route list only changes when a route is added or removed
+        routes = Route.objects.filter(user=user).aggregate(
+            count=Count('id'), last=Max('id'))
+        etag = caching.negotiated_etag(request, 'user', user.pk,
+                                       user.username, user.email,
+                                       routes['count'], routes['last'])
+        response = caching.not_modified(request, etag)
+        if response is None:
+            serializer = UserDetailSerializer(user,
+                                              context={'request': request})
+            response = Response(serializer.data)
+        return caching.set_validators(response, etag, negotiated=True)
+
+    @action(detail=True)
+    def stats(self, request, pk=None):
+        queryset = self._get_queryset(request)
+        user = get_object_or_404(queryset, pk=pk)
+        serializer = UserStatsSerializer(stats.get_user_stats(user),
+                                         context={'request': request})
         return Response(serializer.data)
 
+    @action(detail=True)
+    def export(self, request, pk=None):
+        """
+        Stream all of the user's own routes, ?fmt=gpx|geojson|csv
+        """
+        queryset = self._get_queryset(request)
+        user = get_object_or_404(queryset, pk=pk)
+        if user != request.user and not request.user.is_superuser:
+            result = {'result': 'failed_unauthorized'}
+            return Response(result, status=status.HTTP_401_UNAUTHORIZED)
+        return _export(request, export.account_routes(user),
+                       'heyroad-{}'.format(user.username))
+
 class RouteViewSet(viewsets.ViewSet):
-    authentication_classes = [TokenAuthentication]
+    authentication_classes = [CachedTokenAuthentication]
     permission_classes = [permissions.IsAuthenticated, IsOwnerOrReadOnly]
+    renderer_classes = api_settings.DEFAULT_RENDERER_CLASSES \
+        + [PolylineJSONRenderer, MessagePackRenderer]
+    parser_classes = [JSONParser, PolylineJSONParser, MessagePackParser]
 
     def _get_queryset(self, request):
-        if request.user.is_superuser:
-            return Route.objects.all()
-        friends1 = Friendship.objects                   \
-                   .filter(user1=request.user)          \
-                   .filter(is_accepted=True)            \
-                   .values_list('user2', flat=True)
-        friends2 = Friendship.objects                   \
-                   .filter(user2=request.user)          \
-                   .filter(is_accepted=True)            \
-                   .values_list('user1', flat=True)
-        all_friends = list(chain(friends1, friends2))
-        all_friends.append(request.user)
-        queryset = Route.objects.filter(user__in=all_friends)
+        return friends.visible_routes(request.user)
+
+    def _spatial_filter(self, request, queryset):
+        params = request.query_params
+        if 'bbox' in params:
+            queryset = spatial.within_bbox(
+                queryset, *spatial.parse_bbox(params['bbox']))
+        if 'near' in params:
+            queryset = spatial.near(
+                queryset,
+                *spatial.parse_near(params['near'], params.get('radius')))
         return queryset
 
     def list(self, request):
         queryset = self._get_queryset(request)
-        serializer = RouteSerializer(queryset,
-                                     context={'request': request},
-                                     many=True)
-        return Response(serializer.data)
+        try:
+            queryset = self._spatial_filter(request, queryset)
+        except ValueError as e:
+            result = {'result': 'failed_invalid_area', 'detail': str(e)}
+            return Response(result, status=status.HTTP_400_BAD_REQUEST)
+        paginator = KeysetPagination(*ROUTE_KEYSET.ordering)
+        page = paginator.paginate_queryset(queryset.defer(*TRACK_FIELDS,
+                                                          *THUMBNAIL_FIELDS),
+                                           request, view=self)
+        etag = _page_etag(request, 'routes', paginator,
+                          ['{}.{}'.format(route.pk, route.version)
+                           for route in page])
+        response = caching.not_modified(request, etag)
+        if response is None:
+            serializer = RouteSerializer(page,
+                                         context={'request': request},
+                                         many=True)
+            response = paginator.get_paginated_response(serializer.data)
+        return caching.set_validators(response, etag, negotiated=True)
 
     def retrieve(self, request, pk=None):
+        try:
+            tolerance = parse_tolerance(
+                request.query_params.get('detail'),
+                request.query_params.get('tolerance'))
+        except ValueError as e:
+            result = {'result': 'failed_invalid_detail', 'detail': str(e)}
+            return Response(result, status=status.HTTP_400_BAD_REQUEST)
+        # ?coords=arrays|polyline, or ?format=polyline for the renderer
+        coords_format = request.query_params.get('coords', COORDS_OBJECTS)
+        if request.accepted_renderer.format == PolylineJSONRenderer.format:
+            coords_format = COORDS_POLYLINE
+        if coords_format not in COORDS_FORMATS:
+            result = {'result': 'failed_invalid_coords',
+                      'detail': 'coords must be one of {}'.format(
+                          ', '.join(COORDS_FORMATS))}
+            return Response(result, status=status.HTTP_400_BAD_REQUEST)
+        queryset = self._get_queryset(request)
+        route_pk, version, updated = get_object_or_404(
+            queryset.values_list('pk', 'version', 'updated'), pk=pk)
+        # `updated` tells apart a new route reusing the id of a deleted one
+        etag = caching.negotiated_etag(request, 'route', route_pk, version,
+                                       updated.isoformat(), tolerance,
+                                       coords_format)
+        response = caching.not_modified(request, etag, updated)
+        if response is not None:
+            return caching.set_validators(response, etag, updated,
+                                          negotiated=True)
+
+        def build():
+            route = get_object_or_404(
+                queryset.select_related('metrics', 'job')
+                        .prefetch_related('comments'),
+                pk=route_pk)
+            points = route_points(route, tolerance)
+            serializer = RouteDetailSerializer(
+                route, context={'request': request, 'points': points,
+                                'coords_format': coords_format}
+            )
+            return serializer.data
+
+        data = caching.cached_data(
+            ('route', route_pk, version, updated, tolerance, coords_format,
+             request.accepted_renderer.format),
+            build)
+        return caching.set_validators(Response(data), etag, updated,
+                                      negotiated=True)
+
+    @action(detail=True)
+    def export(self, request, pk=None):
+        """
+        Stream the route, ?fmt=gpx|geojson|csv
+        """
         queryset = self._get_queryset(request)
         route = get_object_or_404(queryset, pk=pk)
-        serializer = RouteDetailSerializer(route, context={'request': request})
+        return _export(request, [route], 'route-{}'.format(route.pk))
+
+    @action(detail=True)
+    def processing(self, request, pk=None):
+        queryset = RouteJob.objects.filter(
+            route__in=self._get_queryset(request))
+        job = get_object_or_404(queryset, route=pk)
+        serializer = RouteJobSerializer(job, context={'request': request})
         return Response(serializer.data)
 
     def create(self, request):
-        body_unicode = request.body.decode('utf-8')
-        body = json.loads(body_unicode)
-        
-        # create route object
-        distance = float(body['distance'])
-        date = parse_datetime(body['date'])
-        duration = parse_duration(body['duration'])
-        new_route = Route.objects.create(user=request.user,
-                                         distance=distance,
-                                         duration=duration,
-                                         date=date)
-        new_route.save()
-        # create latlngs
-        for coordinate in body['coords']:
-            latlng = LatLng.objects.create(route=new_route,
-                                           latitude=coordinate['latitude'],
-                                           longitude=coordinate['longitude'])
-            latlng.save()
+        """
+        Upload a route as JSON, MessagePack or JSON with polyline coords,
+        optionally gzip compressed
+        """
+        try:
+            try:
+                body = request.data
+            except UnsupportedMediaType:
+                # older clients post JSON without a content type
+                body = json.loads(request.body.decode('utf-8'))
+            new_route = ingest_route(request.user, body)
+        except (ParseError, ValueError) as e:
+            result = {'result': 'failed_invalid_payload', 'detail': str(e)}
+            return Response(result, status=status.HTTP_400_BAD_REQUEST)
+
+        result = {'result': 'success', 'id': new_route.pk,
+                  'processing': new_route.job.status}
+        return Response(result, status=status.HTTP_201_CREATED)
 
-        result = {'result': 'success'}
+    @action(detail=False, methods=['post'])
+    def batch(self, request):
+        """
+        Upload many routes at once, {"routes": [{"key": ..., <route>}]};
+        routes whose key was already uploaded are not stored again
+        """
+        try:
+            routes = request.data.get('routes')
+        except (ParseError, AttributeError):
+            routes = None
+        if not isinstance(routes, list) or not routes:
+            result = {'result': 'failed_invalid_payload',
+                      'detail': "'routes' must be a non-empty list"}
+            return Response(result, status=status.HTTP_400_BAD_REQUEST)
+        limit = getattr(settings, 'HEYROAD_MAX_BATCH_ROUTES',
+                        DEFAULT_MAX_BATCH_ROUTES)
+        if len(routes) > limit:
+            result = {'result': 'failed_batch_too_large',
+                      'detail': 'at most {} routes per batch'.format(limit)}
+            return Response(result,
+                            status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+        result = {'result': 'success',
+                  'routes': ingest_batch(request.user, routes)}
+        return Response(result, status=status.HTTP_200_OK)
+
+    @action(detail=False, methods=['post'], url_path='import',
+            parser_classes=[MultiPartParser])
+    def import_files(self, request):
+        """
+        Import GPX and GeoJSON files, or zip archives of them, sent as
+        multipart 'file' fields
+        """
+        uploads = request.FILES.getlist('file')
+        if not uploads:
+            result = {'result': 'failed_no_files'}
+            return Response(result, status=status.HTTP_400_BAD_REQUEST)
+        ids, errors = [], []
+        try:
+            # all or nothing once an upload turns out too large
+            with transaction.atomic():
+                for upload in uploads:
+                    new, failed = importers.import_upload(request.user,
+                                                          upload)
+                    ids.extend(new)
+                    errors.extend(failed)
+        except importers.ImportTooLarge as e:
+            result = {'result': 'failed_import_too_large',
+                      'detail': str(e)}
+            return Response(result,
+                            status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+        if not ids:
+            result = {'result': 'failed_invalid_payload', 'errors': errors}
+            return Response(result, status=status.HTTP_400_BAD_REQUEST)
+        result = {'result': 'success', 'ids': ids, 'errors': errors}
         return Response(result, status=status.HTTP_201_CREATED)
 
     def destroy(self, request, pk=None):
@@ -394,7 +624,7 @@ class RegisterAPIView(APIView):
             return Response(result, status=status.HTTP_201_CREATED)
 
 class FriendViewSet(viewsets.ViewSet):
-    authentication_classes = [TokenAuthentication]
+    authentication_classes = [CachedTokenAuthentication]
     permission_classes = [permissions.IsAuthenticated]
 
     def _get_queryset(self, request):
@@ -405,10 +635,19 @@ class FriendViewSet(viewsets.ViewSet):
 
     def list(self, request):
         queryset = self._get_queryset(request)
-        serializer = FriendshipSerializer(
-            queryset, context={'request': request}, many=True
-        )
-        return Response(serializer.data)
+        paginator = KeysetPagination('-id')
+        page = paginator.paginate_queryset(queryset, request, view=self)
+        etag = _page_etag(request, 'friends', paginator,
+                          ['{}.{}'.format(friendship.pk,
+                                          friendship.is_accepted)
+                           for friendship in page])
+        response = caching.not_modified(request, etag)
+        if response is None:
+            serializer = FriendshipSerializer(
+                page, context={'request': request}, many=True
+            )
+            response = paginator.get_paginated_response(serializer.data)
+        return caching.set_validators(response, etag, negotiated=True)
 
     def retrieve(self, request, pk=None):
         queryset = self._get_queryset(request)
@@ -454,33 +693,264 @@ class FriendViewSet(viewsets.ViewSet):
         result = {'result': 'success'}
         return Response(result, status=status.HTTP_200_OK)
         
+class FeedViewSet(viewsets.ViewSet):
+    authentication_classes = [CachedTokenAuthentication]
+    permission_classes = [permissions.IsAuthenticated]
+
+    def list(self, request):
+        """
+        Routes and comments of the user and their friends, newest first
+        """
+        paginator = KeysetPagination(*TIMELINE_KEYSET.ordering)
+        page = paginator.paginate_queryset(timeline.feed(request.user),
+                                           request, view=self)
+        serializer = TimelineEntrySerializer(
+            page, context={'request': request}, many=True
+        )
+        return paginator.get_paginated_response(serializer.data)
+
+class LeaderboardViewSet(viewsets.ViewSet):
+    authentication_classes = [CachedTokenAuthentication]
+    permission_classes = [permissions.IsAuthenticated]
+
+    def list(self, request):
+        """
+        The user and their friends ranked over a week or month,
+        ?period=week|month&metric=distance|duration|route_count&date=
+        """
+        params = request.query_params
+        try:
+            board = leaderboard.leaderboard(
+                request.user,
+                period=leaderboard.parse_period(params.get('period')),
+                metric=leaderboard.parse_metric(params.get('metric')),
+                date=leaderboard.parse_day(params.get('date')))
+        except leaderboard.InvalidLeaderboard as e:
+            result = {'result': 'failed_invalid_leaderboard',
+                      'detail': str(e)}
+            return Response(result, status=status.HTTP_400_BAD_REQUEST)
+        return Response(LeaderboardSerializer(board).data)
+
+class SyncViewSet(viewsets.ViewSet):
+    authentication_classes = [CachedTokenAuthentication]
+    permission_classes = [permissions.IsAuthenticated]
+
+    def list(self, request):
+        """
+        Routes, comments and friendships changed since ?token=, or all of
+        them without one; ask again with the new token while 'more' is true
+        """
+        token = request.query_params.get('token')
+        try:
+            seq = changes.read_token(request.user, token) if token else 0
+        except changes.ResyncRequired as e:
+            result = {'result': 'failed_resync_required', 'detail': str(e)}
+            return Response(result, status=status.HTTP_410_GONE)
+        except changes.InvalidToken as e:
+            result = {'result': 'failed_invalid_token', 'detail': str(e)}
+            return Response(result, status=status.HTTP_400_BAD_REQUEST)
+        delta = changes.changes(request.user, seq)
+        context = {'request': request}
+        return Response({
+            'token': changes.make_token(request.user, delta['seq']),
+            'more': delta['more'],
+            'routes': RouteSerializer(delta['routes'], many=True,
+                                      context=context).data,
+            'comments': CommentSerializer(delta['comments'], many=True,
+                                          context=context).data,
+            'friendships': FriendshipSerializer(delta['friendships'],
+                                                many=True,
+                                                context=context).data,
+            'deleted': delta['deleted'],
+            'removed_users': delta['removed_users'],
+        })
+
+class LiveViewSet(viewsets.ViewSet):
+    """
+    Rides in progress: the rider appends points, friends watch them
+    """
+    authentication_classes = [CachedTokenAuthentication]
+    permission_classes = [permissions.IsAuthenticated]
+    lookup_value_regex = r'\d+'
+
+    def _get_own(self, request, pk):
+        queryset = LiveRoute.objects.filter(user=request.user)
+        return get_object_or_404(queryset, pk=pk)
+
+    def _check_watcher(self, request, pk):
+        # the rider is cached by the hub, watching costs no extra query
+        owner_id = live.HUB.owner(int(pk))
+        if owner_id is None or not friends.can_view(request.user, owner_id):
+            raise Http404
+
+    def _after(self, value):
+        if value is None or value == '':
+            return 0
+        if not value.isdigit():
+            raise ValueError('after must be a chunk number')
+        return int(value)
+
+    def _timeout(self, value):
+        timeout = float(value or 0)
+        if not math.isfinite(timeout):
+            raise ValueError('timeout must be a number of seconds')
+        return min(max(timeout, 0), live.MAX_WAIT)
+
+    def list(self, request):
+        """
+        Rides of the user and their friends still in progress
+        """
+        queryset = LiveRoute.objects.filter(friends.visible_q(request.user),
+                                            finished=None)
+        serializer = LiveRouteSerializer(queryset, many=True,
+                                         context={'request': request})
+        return Response(serializer.data)
+
+    def create(self, request):
+        """
+        Start a ride, optionally {"date": <start>}
+        """
+        body = request.data or {}
+        date = None
+        if isinstance(body, dict) and body.get('date') is not None:
+            try:
+                date = parse_datetime(str(body['date']))
+            except ValueError:
+                pass
+            if date is None:
+                result = {'result': 'failed_invalid_payload',
+                          'detail': 'invalid date'}
+                return Response(result, status=status.HTTP_400_BAD_REQUEST)
+        ride = live.start(request.user, date)
+        result = {'result': 'success', 'id': ride.pk}
+        return Response(result, status=status.HTTP_201_CREATED)
+
+    def retrieve(self, request, pk=None):
+        """
+        Long-poll the chunks after ?after=N, waiting up to ?timeout=
+        seconds for new ones
+        """
+        self._check_watcher(request, pk)
+        try:
+            after = self._after(request.query_params.get('after'))
+            timeout = self._timeout(request.query_params.get('timeout'))
+        except ValueError as e:
+            result = {'result': 'failed_invalid_params', 'detail': str(e)}
+            return Response(result, status=status.HTTP_400_BAD_REQUEST)
+        return Response(live.HUB.wait(int(pk), after, timeout))
+
+    @action(detail=True, renderer_classes=[EventStreamRenderer])
+    def events(self, request, pk=None):
+        """
+        Server-Sent Events of the chunks, resumed after Last-Event-ID
+        """
+        self._check_watcher(request, pk)
+        try:
+            after = self._after(request.META.get(
+                'HTTP_LAST_EVENT_ID', request.query_params.get('after')))
+        except ValueError as e:
+            result = {'result': 'failed_invalid_params', 'detail': str(e)}
+            return Response(result, status=status.HTTP_400_BAD_REQUEST)
+        response = StreamingHttpResponse(live.events(int(pk), after),
+                                         content_type='text/event-stream')
+        response['Cache-Control'] = 'no-cache'
+        # let nginx pass events through as they come
+        response['X-Accel-Buffering'] = 'no'
+        return response
+
+    @action(detail=True, methods=['post'])
+    def append(self, request, pk=None):
+        """
+        Append a chunk of points, {"seq": N, "coords": [...]}
+        """
+        ride = self._get_own(request, pk)
+        if ride.finished is not None:
+            result = {'result': 'failed_finished', 'route': ride.route_id}
+            return Response(result, status=status.HTTP_409_CONFLICT)
+        try:
+            chunk = live.append(ride, request.data)
+        except (ParseError, InvalidRoutePayload) as e:
+            result = {'result': 'failed_invalid_payload', 'detail': str(e)}
+            return Response(result, status=status.HTTP_400_BAD_REQUEST)
+        except IntegrityError:
+            result = {'result': 'failed_conflict',
+                      'detail': 'a chunk was appended concurrently'}
+            return Response(result, status=status.HTTP_409_CONFLICT)
+        result = {'result': 'success' if chunk else 'duplicate',
+                  'seq': ride.seq}
+        return Response(result, status=status.HTTP_200_OK)
+
+    @action(detail=True, methods=['post'])
+    def finish(self, request, pk=None):
+        """
+        Store the ride as a route, optionally with its {"distance": km}
+        """
+        ride = self._get_own(request, pk)
+        if ride.finished is not None:
+            result = {'result': 'duplicate', 'id': ride.route_id}
+            return Response(result, status=status.HTTP_200_OK)
+        try:
+            distance = request.data.get('distance') if request.data \
+                else None
+            if distance is not None:
+                distance = float(distance)
+                if not math.isfinite(distance):
+                    raise ValueError('distance must be a finite number')
+                if distance < 0:
+                    raise ValueError('distance must not be negative')
+            route = live.finish(ride, distance)
+        except (ParseError, AttributeError, TypeError, ValueError) as e:
+            result = {'result': 'failed_invalid_payload', 'detail': str(e)}
+            return Response(result, status=status.HTTP_400_BAD_REQUEST)
+        result = {'result': 'success', 'id': route.pk}
+        return Response(result, status=status.HTTP_201_CREATED)
+
+    def destroy(self, request, pk=None):
+        ride = self._get_own(request, pk)
+        if ride.finished is not None:
+            result = {'result': 'failed_finished', 'route': ride.route_id}
+            return Response(result, status=status.HTTP_409_CONFLICT)
+        live.discard(ride)
+        result = {'result': 'success'}
+        return Response(result, status=status.HTTP_200_OK)
+
 class CommentViewSet(viewsets.ViewSet):
-    authentication_classess = [TokenAuthentication]
-    permission_classess = [permissions.IsAuthenticated]
+    authentication_classes = [CachedTokenAuthentication]
+    permission_classes = [permissions.IsAuthenticated]
+
+    def list(self, request):
+        """
+        Comments on routes visible to the user, optionally of one ?route=
+        """
+        queryset = Comment.objects.all()
+        if not request.user.is_superuser:
+            queryset = queryset.filter(
+                friends.visible_q(request.user, field='route__user'))
+        route = request.query_params.get('route')
+        if route is not None:
+            if not route.isdigit():
+                result = {'result': 'failed_invalid_route'}
+                return Response(result, status=status.HTTP_400_BAD_REQUEST)
+            queryset = queryset.filter(route=route)
+        paginator = KeysetPagination('date', 'id')
+        page = paginator.paginate_queryset(queryset, request, view=self)
+        # comments cannot be edited, their ids identify the page
+        etag = _page_etag(request, 'comments', paginator,
+                          [comment.pk for comment in page])
+        response = caching.not_modified(request, etag)
+        if response is None:
+            serializer = CommentSerializer(
+                page, context={'request': request}, many=True
+            )
+            response = paginator.get_paginated_response(serializer.data)
+        return caching.set_validators(response, etag, negotiated=True)
 
-    # TODO z jakiegos powodu request bez tokena wchodzi do create
-    # i wywala sie na filtrze
     def create(self, request):
         body_unicode = request.body.decode('utf-8')
         body = json.loads(body_unicode)
 
         # get routes
-        queryset = None
-        # admin access
-        if request.user.is_superuser:
-            queryset = Route.objects.all()
-        else:
-            friends1 = Friendship.objects                   \
-                       .filter(user1=request.user)          \
-                       .filter(is_accepted=True)            \
-                       .values_list('user2', flat=True)
-            friends2 = Friendship.objects                   \
-                       .filter(user2=request.user)          \
-                       .filter(is_accepted=True)            \
-                       .values_list('user1', flat=True)
-            all_friends = list(chain(friends1, friends2))
-            all_friends.append(request.user)
-            queryset = Route.objects.filter(user__in=all_friends)
+        queryset = friends.visible_routes(request.user)
 
         # create comment object
         route = get_object_or_404(queryset, pk=body['route'])
@@ -502,3 +972,16 @@ class CommentViewSet(viewsets.ViewSet):
         comment.delete()
         result = {'result': 'success'}
         return Response(result, status=status.HTTP_200_OK)
+
+class MetricsView(APIView):
+    """
+    Request metrics of this process in the Prometheus text format
+    """
+    authentication_classes = [CachedTokenAuthentication,
+                              SessionAuthentication]
+    permission_classes = [permissions.IsAdminUser]
+
+    def get(self, request, format=None):
+        return HttpResponse(instrumentation.REGISTRY.render(),
+                            content_type='text/plain; version=0.0.4; '
+                                         'charset=utf-8')
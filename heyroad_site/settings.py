@@ -43,7 +43,9 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'heyroad.middleware.PerformanceMiddleware',
     'django.middleware.security.SecurityMiddleware',
+    'heyroad.middleware.GZipAPIMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -56,7 +58,8 @@ ROOT_URLCONF = 'heyroad_site.urls'
 
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        # DjangoTemplates, timing rendering for heyroad.instrumentation
+        'BACKEND': 'heyroad.template_backends.TimedDjangoTemplates',
         'DIRS': [],
         'APP_DIRS': True,
         'OPTIONS': {
@@ -125,9 +128,56 @@ STATIC_ROOT = os.path.join(BASE_DIR, 'static')
 
 LOGIN_REDIRECT_URL = '/'
 
+# How route coordinates are stored: 'rows' (one LatLng per point) or
+# 'packed' (a single binary column on Route, see heyroad.geometry). With
+# 'packed', migration 0009 converts the existing routes too
+HEYROAD_ROUTE_STORAGE = 'packed'
+
+# Uploaded routes are simplified, indexed, measured and thumbnailed by
+# background workers (`manage.py process_routes`); set to True to do it
+# during the upload request instead
+HEYROAD_PROCESS_ROUTES_INLINE = False
+
+# Limits of /api/route/import/: files in an archive, inflated bytes of one
+# file and of all files of an upload; larger uploads are refused with 413
+HEYROAD_MAX_IMPORT_FILES = 1000
+HEYROAD_MAX_IMPORT_FILE_SIZE = 64 * 1024 * 1024
+HEYROAD_MAX_IMPORT_SIZE = 256 * 1024 * 1024
+
+# Also store a PNG of every route thumbnail, next to the SVG pages embed
+HEYROAD_THUMBNAIL_PNG = False
+
+# Send a Server-Timing header (SQL, rendering and total time) with every
+# response; the numbers are also collected for the staff-only /metrics/
+HEYROAD_SERVER_TIMING = True
+
+# Seconds the friend ids of a user stay cached. Without CACHES the cache is
+# local to each server process, and a friendship change only clears it in
+# the process that made it: the others may show an ex-friend's routes this
+# long. With a cache shared by all processes (memcached, redis) this can be
+# raised to an hour.
+HEYROAD_FRIENDS_CACHE_TIMEOUT = 60
+
+# Seconds a friends leaderboard stays cached. A new route only drops the
+# boards cached by the process that stored it, unless all processes share
+# the cache (see above); the others may show old totals this long.
+HEYROAD_LEADERBOARD_CACHE_TIMEOUT = 60
+
+# Seconds an API token stays cached in each server process; other
+# processes may accept a deleted token or deactivated user this long
+HEYROAD_TOKEN_CACHE_TTL = 300
+
+# Seconds delta sync tombstones are kept by `manage.py compact_changes`;
+# sync tokens older than this are refused and clients sync from scratch
+HEYROAD_SYNC_HORIZON = 30 * 24 * 60 * 60
+
+# Decimal places of encoded polylines sent to and from the API; 5 is
+# Google's format (~1 m), 6 keeps the full precision of packed tracks
+HEYROAD_POLYLINE_PRECISION = 5
+
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [
-        'rest_framework.authentication.TokenAuthentication',
+        'heyroad.authentication.CachedTokenAuthentication',
     ],
     'DEFAULT_THROTTLE_CLASSES': [
         'rest_framework.throttling.AnonRateThrottle',
@@ -0,0 +1,45 @@
+"""
+Database profile for running heyroad on SQLite in production.
+
+The database is opened in WAL mode with tuned pragmas, connections are
+kept between requests, and the reads of GET requests go through a
+second, read-only connection ('replica') so they never queue behind a
+writer's transaction. Select it with
+DJANGO_SETTINGS_MODULE=heyroad_site.settings_production; the path of the
+database file may be set with HEYROAD_DATABASE.
+
+With a real replica (e.g. a LiteFS or Litestream copy), point the
+'replica' alias at it instead.
+"""
+import os
+
+from heyroad.db import RECOMMENDED_PRAGMAS
+from heyroad_site.settings import *  # noqa: F401,F403
+from heyroad_site.settings import BASE_DIR, MIDDLEWARE
+
+DATABASE_PATH = os.environ.get('HEYROAD_DATABASE',
+                               os.path.join(BASE_DIR, 'db.sqlite3'))
+
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': DATABASE_PATH,
+        # seconds a connection is reused, instead of reopening the file
+        # for every request
+        'CONN_MAX_AGE': 600,
+        'OPTIONS': {'timeout': 20},
+    },
+    'replica': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': DATABASE_PATH,
+        'CONN_MAX_AGE': 600,
+        'TEST': {'MIRROR': 'default'},
+    },
+}
+DATABASE_ROUTERS = ['heyroad.db.ReadReplicaRouter']
+
+HEYROAD_SQLITE_PRAGMAS = RECOMMENDED_PRAGMAS
+HEYROAD_DATABASE_REPLICAS = ['replica']
+
+MIDDLEWARE = MIDDLEWARE[:1] + ['heyroad.middleware.ReadReplicaMiddleware'] \
+    + MIDDLEWARE[1:]